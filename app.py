@@ -1,6 +1,21 @@
-from flask import Flask, request, abort
+import calendar
+import math
+import os
+import time
+import requests
+from collections import OrderedDict
+from flask import Flask, Response, request, g
 import smartcar
-import json
+import batch
+import query
+import config
+import changefeed
+import utility
+import encoder
+import metrics
+import circuit
+import ratelimit
+import errors
 
 """
 This is the Flask instance that runs locally on localhost:5000. We can perform
@@ -9,73 +24,339 @@ GET/POST requests using curl on the routes that have been defined below.
 
 app = Flask("Smartcar API")
 
-#Route for getting vehicle info based on ID
+NDJSON = 'application/x-ndjson'
+
+#Compact JSON by default; clients can ask for pretty-printed JSON with ?pretty=1
+response_encoder = encoder.ResponseEncoder()
+
+#Last body encoded for each path (and query string) of the vehicle lookup routes, with its ETag
+encoded_bodies = encoder.EncodedBodies()
+
+def json_response(ret, age=None, conditional=False):
+	"""
+	Serialize a result into an application/json response, pretty-printed if the client
+	asked for it with ?pretty=1 and compressed if its Accept-Encoding allows
+	:param age: Seconds since the result was fetched from the GM API, sent as the Age header
+	:param conditional: Send ETag and Last-Modified headers and answer 304 Not Modified when
+	the client's If-None-Match (or If-Modified-Since) shows it has the result already. A
+	result that has not changed since the last request for the same path is not encoded again
+	"""
+	pretty = request.args.get('pretty') in ('1', 'true')
+	encoded = None
+	if (conditional):
+		key = (request.full_path, pretty)
+		encoded = encoded_bodies.get(key, ret)
+		if (encoded is None):
+			start = metrics.now()
+			body = response_encoder.encode(ret, pretty=pretty)
+			tag = encoder.result_tag(ret)
+			metrics.phase_seconds.observe(("encode",), metrics.now() - start)
+			encoded = encoded_bodies.put(key, ret, body, tag, time.time() - (age or 0))
+		if (not_modified(encoded)):
+			response = Response(status=304)
+			validators(response, encoded, age)
+			return response
+		body = encoded.body
+	else:
+		start = metrics.now()
+		body = response_encoder.encode(ret, pretty=pretty)
+		metrics.phase_seconds.observe(("encode",), metrics.now() - start)
+	compressing = metrics.now()
+	body, coding = response_encoder.compress(body, request.headers.get('Accept-Encoding'))
+	if (coding is not None):
+		metrics.phase_seconds.observe(("compress",), metrics.now() - compressing)
+	response = Response(body, mimetype='application/json')
+	if (coding is not None):
+		response.headers['Content-Encoding'] = coding
+	response.vary.add('Accept-Encoding')
+	if (encoded is not None):
+		validators(response, encoded, age)
+	elif (age is not None):
+		response.headers['Age'] = str(int(age))
+	return response
+
+def not_modified(encoded):
+	"""
+	Whether the client already has the result, going by If-None-Match if it sent one and
+	by If-Modified-Since otherwise
+	"""
+	if (request.if_none_match):
+		return request.if_none_match.contains_weak(encoded.tag)
+	since = request.if_modified_since
+	if (since is not None):
+		return int(encoded.modified) <= calendar.timegm(since.utctimetuple())
+	return False
+
+def validators(response, encoded, age):
+	"""
+	Set the ETag, Last-Modified and Age headers of a response. The ETag is weak since the
+	same result can be sent with different content codings
+	"""
+	response.set_etag(encoded.tag, weak=True)
+	response.last_modified = int(encoded.modified)
+	if (age is not None):
+		response.headers['Age'] = str(int(age))
+
+def wants_ndjson():
+	"""
+	Whether the client asked for a streamed, newline-delimited JSON response, either
+	with ?format=ndjson or by preferring application/x-ndjson in its Accept header
+	"""
+	if (request.args.get('format') == 'ndjson'):
+		return True
+	return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+#Shared poller of the door status and energy of the vehicles subscribed to on /vehicles/changes
+change_feed = changefeed.ChangeFeed([
+	("doors", lambda id: smartcar.refresh("door_status", id), smartcar.get_door_status),
+	("energy", lambda id: smartcar.refresh("energy", id), smartcar.get_energy)
+], interval=config.CHANGES_INTERVAL, linger=config.CHANGES_LINGER)
+
+def _change_feed_metrics():
+	stats = change_feed.stats()
+	return [
+		("smartcar_change_feed_vehicles", "gauge", "Vehicles subscribed to on the change feed.", stats['vehicles']),
+		("smartcar_change_feed_changes_total", "counter", "Door status and energy changes found by the change feed.", stats['changes']),
+		("smartcar_change_feed_polls_total", "counter", "Polls of the subscribed vehicles.", stats['polls'])
+	]
+
+metrics.registry.collect(_change_feed_metrics)
+
+INVALID_IDS = errors.preallocate("Please provide the vehicle ids as a comma separated list of integers")
+TOO_MANY_IDS = errors.preallocate("Please provide between 1 and %d vehicle ids" % config.CHANGES_MAX_VEHICLES)
+INVALID_TIMEOUT = errors.preallocate("Please provide the timeout in seconds")
+
+def parse_ids(value):
+	"""
+	Parse the comma separated vehicle IDs of a subscription
+	:rtype: ids: List of vehicle IDs without duplicates
+	"""
+	try:
+		ids = [int(id) for id in (value or '').split(',') if (id.strip())]
+	except ValueError:
+		raise errors.InvalidInput(INVALID_IDS)
+	if (not ids or len(ids) > config.CHANGES_MAX_VEHICLES):
+		raise errors.InvalidInput(TOO_MANY_IDS)
+	return list(OrderedDict.fromkeys(ids))
+
+def wants_event_stream():
+	"""
+	Whether the client asked for Server-Sent Events, with ?format=sse or by accepting
+	text/event-stream
+	"""
+	if (request.args.get('format') == 'sse'):
+		return True
+	return request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream'
+
+def changes_response(ids):
+	"""
+	Answer a subscription to the door status and energy changes of some vehicles. By
+	default this is a long-poll: the response comes as soon as a vehicle changes (or
+	after ?timeout= seconds) with the changes and the cursor to send back as ?cursor= on
+	the next request. The first request, without a cursor, gets the current state. With
+	Server-Sent Events the changes keep coming on one response, one event per change
+	"""
+	cursor = request.args.get('cursor') or request.headers.get('Last-Event-ID')
+	try:
+		timeout = min(max(float(request.args.get('timeout', config.CHANGES_TIMEOUT)), 0), config.CHANGES_TIMEOUT)
+	except ValueError:
+		raise errors.InvalidInput(INVALID_TIMEOUT)
+	change_feed.start()
+	stream = wants_event_stream()
+	#an event stream starts with whatever is pending, so that errors still get a status code
+	cursor, changes = change_feed.wait(ids, cursor, 0 if (stream) else timeout)
+	if (not stream):
+		return json_response({"cursor": cursor, "changes": [change.to_json() for change in changes]})
+
+	def events(cursor, changes):
+		while (True):
+			if (not changes):
+				#a comment line keeps proxies from closing an idle stream
+				yield ": keep-alive\n\n"
+			for change in changes:
+				yield "id: %s\nevent: %s\ndata: %s\n\n" % (cursor, change.kind,
+					response_encoder.encode(change.to_json()).decode('utf-8'))
+			cursor, changes = change_feed.wait(ids, cursor, config.CHANGES_TIMEOUT)
+
+	response = Response(events(cursor, changes), mimetype='text/event-stream')
+	response.headers['Cache-Control'] = 'no-cache'
+	return response
+
+def ndjson_response(results):
+	"""
+	Stream an iterable of results back as one line of JSON per result, writing each
+	line as soon as it is produced
+	"""
+	return Response((response_encoder.encode(ret) + b"\n" for ret in results), mimetype=NDJSON)
+
+@app.before_request
+def start_timer():
+	g.start = metrics.now()
+
+@app.after_request
+def record_request(response):
+	"""
+	Count every response and time it by route, using the URL rule (e.g. /vehicles/<int:id>)
+	rather than the path so that the number of label values stays bounded
+	"""
+	route = request.url_rule.rule if (request.url_rule is not None) else "unmatched"
+	metrics.http_seconds.observe((request.method, route), metrics.now() - g.start)
+	metrics.http_responses.inc((request.method, route, response.status_code))
+	return response
+
+@app.errorhandler(errors.APIError)
+def api_error(err):
+	"""
+	Answer bad input, unknown vehicles and malformed GM API responses with the status code
+	and (preallocated) body their error carries
+	"""
+	return Response(err.body, status=err.status, mimetype='text/plain')
+
+@app.errorhandler(circuit.CircuitOpenError)
+def service_unavailable(err):
+	"""
+	Fail fast with a 503 while the GM API service a request needs is known to be down
+	(and there is no cached result to answer with), telling the client when to retry
+	"""
+	response = Response("The GM API is unavailable, please try again later", status=503, mimetype='text/plain')
+	response.headers['Retry-After'] = str(max(1, int(math.ceil(err.retry_after))))
+	return response
+
+@app.errorhandler(ratelimit.ThrottledError)
+def service_busy(err):
+	"""
+	Shed load with a 503 when a GM API call could not be admitted in time (and there is
+	no cached result to answer with), rather than queueing requests without bound
+	"""
+	response = Response("The GM API is busy, please try again later", status=503, mimetype='text/plain')
+	response.headers['Retry-After'] = str(max(1, int(math.ceil(err.retry_after))))
+	return response
+
+@app.errorhandler(requests.exceptions.RequestException)
+def upstream_failed(err):
+	"""
+	Answer a GM API call that failed (no answer, a timeout or an error status) and had no
+	cached result to fall back on with the same JSON error as a failed lookup in a batch:
+	a 504 for a timeout and a 502 otherwise
+	"""
+	error = batch.error_status(err)
+	response = json_response(error)
+	response.status_code = error["status"]
+	return response
+
+#Route for getting vehicle info based on ID, or only the fields listed in ?fields= (e.g.
+#?fields=vin,doors,battery) from whichever GM API services provide them
 @app.route('/vehicles/<int:id>', methods=['GET'])
 def get_vehicle_info(id):
 	if (request.method == 'GET'):
-		try:
-			ret = smartcar.get_vehicle_info(id)
-		except ValueError as err:
-			if (err.message == "404"):
-				abort(404, "Vehicle not found")
-			else:
-				return (400, err.message)
-		return json.dumps(ret, indent=4)
+		if (request.args.get('fields') is not None):
+			ret, age = query.fetch_fields(id, query.parse_fields(request.args.get('fields')))
+			return json_response(ret, age=age, conditional=True)
+		ret = smartcar.get_vehicle_info(id)
+		return json_response(ret, age=smartcar.result_age(), conditional=True)
 
 #Route for getting status of each door for a vehicle given an ID
 @app.route('/vehicles/<int:id>/doors', methods=['GET'])
 def get_door_status(id):
 	if (request.method == 'GET'):
-		try:
-			ret = smartcar.get_door_status(id)
-		except ValueError as err:
-			if (err.message == "404"):
-				abort(404, "Vehicle not found")
-			else:
-				return (400, err.message)
-		return json.dumps(ret, indent=4)
+		ret = smartcar.get_door_status(id)
+		return json_response(ret, age=smartcar.result_age(), conditional=True)
 
 #Route for getting the fuel range for a fuel-powered vehicle
 @app.route('/vehicles/<int:id>/fuel', methods=['GET'])
 def get_fuel_range(id):
 	if (request.method == 'GET'):
-		try:
-			ret = smartcar.get_fuel_range(id)
-		except ValueError as err:
-			if (err.message == "404"):
-				abort(404, "Vehicle not found")
-			else:
-				return (400, err.message)
-		return json.dumps(ret, indent=4)
+		ret = smartcar.get_fuel_range(id)
+		return json_response(ret, age=smartcar.result_age(), conditional=True)
 
 #Route for getting the battery range for an electric vehicle
 @app.route('/vehicles/<int:id>/battery', methods=['GET'])
 def get_battery_range(id):
 	if (request.method == 'GET'):
-		try:
-			ret = smartcar.get_battery_range(id)
-		except ValueError as err:
-			if (err.message == "404"):
-				abort(404, "Vehicle not found")
-			else:
-				return abort(400, err.message)
-		return json.dumps(ret, indent=4)
+		ret = smartcar.get_battery_range(id)
+		return json_response(ret, age=smartcar.result_age(), conditional=True)
+
+#Route for getting both the fuel and battery range of a vehicle with a single GM API call
+@app.route('/vehicles/<int:id>/energy', methods=['GET'])
+def get_energy(id):
+	if (request.method == 'GET'):
+		ret = smartcar.get_energy(id)
+		return json_response(ret, age=smartcar.result_age(), conditional=True)
 
 #Route for start/stopping an engine of a vehicle given an ID and action (START|STOP)
 @app.route('/vehicles/<int:id>/engine', methods=['POST'])
 def control_engine(id):
 	if (request.method == 'POST'):
-		request_json = request.get_json()
+		request_json = request.get_json(silent=True)
+		if (type(request_json) != dict):
+			raise errors.InvalidInput(utility.MISSING_ACTION)
 		#get the desired action (START|STOP) from the request
-		action = request_json.get('action')
-		try:
-			ret = smartcar.control_engine(id, action)
-		except ValueError as err:
-			if (err.message == "404"):
-				abort(404, "Vehicle not found")
-			else:
-				return abort(400, err.message)
-		return json.dumps(ret, indent=4)
+		ret = smartcar.control_engine(id, request_json.get('action'))
+		return json_response(ret)
+
+#Route for looking up several fields (info|doors|fuel|battery) for many vehicles at once. With
+#?format=ndjson (or Accept: application/x-ndjson) each vehicle is streamed back as soon as it is done
+@app.route('/vehicles/batch', methods=['POST'])
+def get_vehicle_batch():
+	if (request.method == 'POST'):
+		request_json = request.get_json(silent=True)
+		if (type(request_json) != dict):
+			request_json = {}
+		if (wants_ndjson()):
+			return ndjson_response(batch.iter_batch(request_json.get('ids'), request_json.get('fields')))
+		ret = batch.fetch_batch(request_json.get('ids'), request_json.get('fields'))
+		return json_response(ret)
+
+#Route for starting/stopping many vehicles at once. Every command is validated before any is
+#sent, and the result of each command is streamed back as a line of JSON as soon as it completes
+@app.route('/vehicles/engine', methods=['POST'])
+def control_engine_batch():
+	if (request.method == 'POST'):
+		request_json = request.get_json(silent=True)
+		if (type(request_json) != dict):
+			request_json = {}
+		return ndjson_response(batch.iter_engine_batch(request_json.get('commands')))
+
+#Route for subscribing to the door status and energy changes of a set of vehicles, given as
+#?ids=1234,1235 (long-poll, or Server-Sent Events with ?format=sse)
+@app.route('/vehicles/changes', methods=['GET'])
+def get_changes():
+	if (request.method == 'GET'):
+		return changes_response(parse_ids(request.args.get('ids')))
+
+#Route for subscribing to the door status and energy changes of one vehicle
+@app.route('/vehicles/<int:id>/changes', methods=['GET'])
+def get_vehicle_changes(id):
+	if (request.method == 'GET'):
+		return changes_response([id])
+
+#Route for inspecting the hit/miss/eviction counters of the response cache
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+	if (request.method == 'GET'):
+		return json_response(smartcar.cache_stats())
+
+#Route for forgetting that the GM API did not know a vehicle, e.g. once it has been provisioned,
+#so that its next lookup asks the GM API again instead of getting a cached 404
+@app.route('/cache/unknown/<int:id>', methods=['DELETE'])
+def forget_unknown_vehicle(id):
+	if (request.method == 'DELETE'):
+		return json_response({"forgotten": smartcar.forget_unknown([id])})
+
+#Route for forgetting every vehicle the GM API did not know
+@app.route('/cache/unknown', methods=['DELETE'])
+def forget_unknown_vehicles():
+	if (request.method == 'DELETE'):
+		return json_response({"forgotten": smartcar.forget_unknown()})
+
+#Route exposing request timings and counters in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+	if (request.method == 'GET'):
+		return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
 
 if __name__ == '__main__':
+	#debug mode runs this file twice (the reloader and the server); only the server prefetches
+	if (os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+		smartcar.start_prefetching()
 	app.run(debug=True)
\ No newline at end of file
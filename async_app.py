@@ -0,0 +1,106 @@
+import math
+import requests
+from aiohttp import web
+import async_smartcar
+import batch
+import encoder
+import errors
+import circuit
+import ratelimit
+
+"""
+This is the asyncio counterpart of app.py. It serves the same routes with the same
+responses and status codes (though without stale results when the GM API fails), but
+from an aiohttp server that waits on GM API calls without holding a thread per
+request. Run it with `python async_app.py`; it listens on localhost:5000 like app.py
+does. Requires Python 3 and aiohttp.
+"""
+
+routes = web.RouteTableDef()
+
+#Compact JSON by default; clients can ask for pretty-printed JSON with ?pretty=1
+response_encoder = encoder.ResponseEncoder()
+
+async def respond(request, call):
+	"""
+	Await a call into async_smartcar and turn its result or error into a response
+	:param request: The request being answered
+	:param call: Awaitable returned by an async_smartcar function
+	:rtype: response: JSON response, or the error response app.py answers the error with
+	"""
+	try:
+		ret = await call
+	except errors.APIError as err:
+		return web.Response(body=err.body, status=err.status, content_type='text/plain')
+	except (circuit.CircuitOpenError, ratelimit.ThrottledError) as err:
+		response = web.Response(text=batch.error_status(err)["message"], status=503, content_type='text/plain')
+		response.headers['Retry-After'] = str(max(1, int(math.ceil(err.retry_after))))
+		return response
+	except requests.exceptions.RequestException as err:
+		ret = batch.error_status(err)
+		return encode(request, ret, status=ret["status"])
+	return encode(request, ret)
+
+def encode(request, ret, status=200):
+	"""
+	Serialize a result into an application/json response, pretty-printed if the client
+	asked for it with ?pretty=1 and compressed if its Accept-Encoding allows
+	"""
+	pretty = request.query.get('pretty') in ('1', 'true')
+	body = response_encoder.encode(ret, pretty=pretty)
+	body, coding = response_encoder.compress(body, request.headers.get('Accept-Encoding'))
+	response = web.Response(body=body, status=status, content_type='application/json', headers={'Vary': 'Accept-Encoding'})
+	if (coding is not None):
+		response.headers['Content-Encoding'] = coding
+	return response
+
+#Route for getting vehicle info based on ID
+@routes.get(r'/vehicles/{id:\d+}')
+async def get_vehicle_info(request):
+	return await respond(request, async_smartcar.get_vehicle_info(int(request.match_info['id'])))
+
+#Route for getting status of each door for a vehicle given an ID
+@routes.get(r'/vehicles/{id:\d+}/doors')
+async def get_door_status(request):
+	return await respond(request, async_smartcar.get_door_status(int(request.match_info['id'])))
+
+#Route for getting the fuel range for a fuel-powered vehicle
+@routes.get(r'/vehicles/{id:\d+}/fuel')
+async def get_fuel_range(request):
+	return await respond(request, async_smartcar.get_fuel_range(int(request.match_info['id'])))
+
+#Route for getting the battery range for an electric vehicle
+@routes.get(r'/vehicles/{id:\d+}/battery')
+async def get_battery_range(request):
+	return await respond(request, async_smartcar.get_battery_range(int(request.match_info['id'])))
+
+#Route for getting both the fuel and battery range of a vehicle with a single GM API call
+@routes.get(r'/vehicles/{id:\d+}/energy')
+async def get_energy(request):
+	return await respond(request, async_smartcar.get_energy(int(request.match_info['id'])))
+
+#Route for start/stopping an engine of a vehicle given an ID and action (START|STOP)
+@routes.post(r'/vehicles/{id:\d+}/engine')
+async def control_engine(request):
+	try:
+		request_json = await request.json()
+	except ValueError:
+		request_json = None
+	#get the desired action (START|STOP) from the request
+	action = request_json.get('action') if (type(request_json) == dict) else None
+	return await respond(request, async_smartcar.control_engine(int(request.match_info['id']), action))
+
+async def close_client(app):
+	await async_smartcar.client.close()
+
+def create_app():
+	"""
+	:rtype: app: The aiohttp application serving the Smartcar API routes
+	"""
+	app = web.Application()
+	app.add_routes(routes)
+	app.on_cleanup.append(close_client)
+	return app
+
+if __name__ == '__main__':
+	web.run_app(create_app(), host='127.0.0.1', port=5000)
@@ -0,0 +1,355 @@
+import asyncio
+import time
+import aiohttp
+import requests
+import config
+import smartcar
+import utility
+import errors
+import circuit
+import ratelimit
+import metrics
+
+"""
+This contains asyncio versions of the functions in smartcar.py. They talk to the GM
+API over a non-blocking aiohttp client so that a single thread can wait on many GM
+calls at once. Parsing, the response cache, the negative cache, the circuit breakers,
+the governors, the upstream metrics and the error semantics (errors.VehicleNotFound
+for unknown vehicles, errors.InvalidInput for bad input, the requests exceptions of
+smartcar.UPSTREAM_ERRORS when the GM API fails) are shared with smartcar.py.
+Requires Python 3 and aiohttp.
+"""
+
+class AsyncGMClient(object):
+	"""
+	A non-blocking, pooled, keep-alive client for the GM API services
+	"""
+
+	def __init__(self, base_url=config.GM_API_URL, limit=100, limit_per_host=0,
+			keepalive_timeout=15, connect_timeout=config.GM_CONNECT_TIMEOUT,
+			read_timeout=config.GM_READ_TIMEOUT):
+		"""
+		:param base_url: Root URL of the GM API (no trailing slash)
+		:param limit: Maximum number of open connections in total
+		:param limit_per_host: Maximum number of open connections per host (0 for no limit)
+		:param keepalive_timeout: Seconds an idle connection is kept open for reuse
+		:param connect_timeout: Seconds to wait for a connection to be established
+		:param read_timeout: Seconds to wait for the GM API to send a response
+		"""
+		self.base_url = base_url.rstrip('/')
+		self.limit = limit
+		self.limit_per_host = limit_per_host
+		self.keepalive_timeout = keepalive_timeout
+		self.connect_timeout = connect_timeout
+		self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+		self.session = None
+
+	def _session(self):
+		#the session has to be created inside a running event loop
+		if (self.session is None or self.session.closed):
+			connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+				keepalive_timeout=self.keepalive_timeout)
+			self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+				headers={'Content-Type': 'application/json'})
+		return self.session
+
+	async def post(self, service, params, read_timeout=None):
+		"""
+		POST a JSON request to a GM API service and decode its JSON response
+		:param service: Name of the GM service, e.g. getVehicleInfoService
+		:param params: Validated request parameters
+		:param read_timeout: Seconds to wait for this response, instead of the client's read_timeout
+		:rtype: r: Decoded JSON response
+		"""
+		timeout = None
+		if (read_timeout is not None):
+			timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=read_timeout)
+		async with self._session().post(self.base_url + '/' + service, json=params, timeout=timeout) as r:
+			#Raise an exception for any 4XX or 5XX status code being returned from GM API
+			if (r.status != 200):
+				r.raise_for_status()
+			return await r.json(content_type=None)
+
+	async def close(self):
+		if (self.session is not None):
+			await self.session.close()
+
+class AsyncGroup(object):
+	"""
+	Coalesces concurrent coroutine calls that share a key into a single call, the
+	asyncio counterpart of singleflight.Group
+	"""
+
+	def __init__(self):
+		self.calls = {}
+
+	async def do(self, key, func):
+		"""
+		Await func() unless a call for the same key is already in flight, in which case
+		await that call instead
+		:param key: Hashable identifier of the call, e.g. (service, id)
+		:param func: Function taking no arguments that returns a coroutine
+		:rtype: result: The value returned by the coroutine
+		"""
+		task = self.calls.get(key)
+		if (task is None):
+			task = asyncio.ensure_future(func())
+			self.calls[key] = task
+			task.add_done_callback(lambda _: self.calls.pop(key, None))
+		#a cancelled caller must not cancel the call the other callers are waiting on
+		return await asyncio.shield(task)
+
+class AsyncGovernor(object):
+	"""
+	The asyncio counterpart of ratelimit.Governor, with the same in-flight limit, rate limit
+	and queue timeout. Queued calls wait as coroutines rather than on a thread each, and
+	a call cancelled while it waits gives its slot back
+	"""
+
+	def __init__(self, service, rate=100, burst=100, max_in_flight=32, queue_timeout=2.0,
+			clock=time.time):
+		"""
+		:param service: Name of the GM service
+		:param rate: Calls started per second, or 0 for no rate limit
+		:param burst: Calls that may start at once after a quiet period
+		:param max_in_flight: Calls in progress at once, or 0 for no limit
+		:param queue_timeout: Maximum seconds a call waits to be admitted
+		:param clock: Function returning the current time in seconds
+		"""
+		self.service = service
+		self.queue_timeout = queue_timeout
+		self.clock = clock
+		self.slots = asyncio.Semaphore(max_in_flight) if (max_in_flight > 0) else None
+		self.bucket = ratelimit.TokenBucket(rate, burst, clock) if (rate > 0) else None
+
+	async def acquire(self):
+		"""
+		Wait until a call may start; every successful acquire must be followed by a release
+		once the call is over
+		:rtype: waited: Seconds the call waited to be admitted
+		"""
+		start = self.clock()
+		deadline = start + self.queue_timeout
+		if (self.slots is not None):
+			try:
+				await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+			except asyncio.TimeoutError:
+				self._reject("concurrency", start)
+		try:
+			while (self.bucket is not None and not self.bucket.try_acquire()):
+				wait = 1.0 / self.bucket.rate
+				if (self.clock() + wait > deadline):
+					self._reject("rate", start)
+				await asyncio.sleep(wait)
+		except BaseException:
+			#rejected or cancelled while holding a slot
+			self.release()
+			raise
+		waited = self.clock() - start
+		metrics.queue_seconds.observe((self.service,), waited)
+		return waited
+
+	def _reject(self, reason, start):
+		metrics.upstream_rejections.inc((self.service, reason))
+		metrics.queue_seconds.observe((self.service,), self.clock() - start)
+		retry_after = 1.0 / self.bucket.rate if (reason == "rate") else self.queue_timeout
+		raise ratelimit.ThrottledError(self.service, retry_after)
+
+	def release(self):
+		if (self.slots is not None):
+			self.slots.release()
+
+client = AsyncGMClient()
+flights = AsyncGroup()
+
+#AsyncGovernor of each service, with the smartcar.governors it took its settings from
+_governors = {}
+
+def governor(service):
+	"""
+	The AsyncGovernor of a service, with the settings of smartcar.governors. It is rebuilt
+	when smartcar.governors is replaced, e.g. by serve.py or the benchmarks
+	"""
+	live = smartcar.governors
+	entry = _governors.get(service)
+	if (entry is None or entry[0] is not live):
+		entry = _governors[service] = (live, AsyncGovernor(service, **live.settings))
+	return entry[1]
+
+async def _post(service, params):
+	"""
+	The asyncio counterpart of smartcar._post: the call goes through the service's circuit
+	breaker, waits to be admitted by its governor, uses its adaptive read timeout and is
+	counted in the same metrics. GM API failures are raised as the requests exceptions
+	smartcar.py raises for them
+	:param service: Name of the GM service, e.g. getVehicleInfoService
+	:param params: Validated request parameters
+	:rtype: r: Decoded JSON response
+	"""
+	breaker = smartcar.breakers.get(service)
+	try:
+		breaker.allow()
+	except circuit.CircuitOpenError:
+		metrics.upstream_responses.inc((service, "circuit_open"))
+		raise
+
+	admission = governor(service)
+	try:
+		await admission.acquire()
+	except ratelimit.ThrottledError:
+		breaker.cancel()
+		metrics.upstream_responses.inc((service, "throttled"))
+		raise
+	except asyncio.CancelledError:
+		breaker.cancel()
+		raise
+
+	start = metrics.now()
+	try:
+		r = await client.post(service, params, read_timeout=breaker.timeout)
+	except asyncio.CancelledError:
+		#the call was given up on by its caller, so it says nothing about the service
+		breaker.cancel()
+		raise
+	except ValueError:
+		#the GM API answered, but not with JSON
+		metrics.upstream_seconds.observe((service,), metrics.now() - start)
+		metrics.upstream_responses.inc((service, "200"))
+		breaker.success(metrics.now() - start)
+		raise errors.BadUpstreamResponse(smartcar.NOT_JSON)
+	except aiohttp.ClientResponseError as err:
+		metrics.upstream_seconds.observe((service,), metrics.now() - start)
+		metrics.upstream_responses.inc((service, str(err.status)))
+		#only server side errors count against the service, as in smartcar._post
+		if (err.status >= 500):
+			breaker.failure()
+		else:
+			breaker.success(metrics.now() - start)
+		raise requests.exceptions.HTTPError(str(err))
+	except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+		metrics.upstream_seconds.observe((service,), metrics.now() - start)
+		metrics.upstream_responses.inc((service, "error"))
+		breaker.failure()
+		if (isinstance(err, asyncio.TimeoutError)):
+			raise requests.exceptions.Timeout("The GM API service %s did not answer in time" % service)
+		raise requests.exceptions.ConnectionError(str(err))
+	finally:
+		admission.release()
+	elapsed = metrics.now() - start
+	metrics.upstream_seconds.observe((service,), elapsed)
+	metrics.upstream_responses.inc((service, "200"))
+	breaker.success(elapsed)
+	return r
+
+async def gather_limited(calls, limit):
+	"""
+	Run coroutine calls concurrently with at most `limit` of them in flight at a time
+	:param calls: List of functions taking no arguments that return a coroutine
+	:param limit: Maximum number of calls awaited at the same time
+	:rtype: results: List of results in the same order as calls
+	"""
+	semaphore = asyncio.Semaphore(limit)
+
+	async def run(call):
+		async with semaphore:
+			return await call()
+
+	return await asyncio.gather(*[run(call) for call in calls])
+
+async def _read(endpoint, service, parse, id):
+	"""
+	Serve a read-only lookup from the shared cache, or from a coalesced GM API call
+	"""
+	params = {
+		"id": id,
+		"responseType": "JSON"
+	}
+
+	#check for valid input
+	params = utility.check_valid_input(params)
+
+	ret_data = smartcar.response_cache.get(endpoint, id)
+	if (ret_data is not None):
+		return ret_data
+	if (smartcar.unknown_vehicles.contains(id)):
+		raise errors.VehicleNotFound()
+
+	async def fetch():
+		try:
+			ret_data = parse(await _post(service, params))
+		except errors.VehicleNotFound:
+			smartcar.unknown_vehicles.add(id)
+			raise
+		smartcar.response_cache.set(endpoint, id, ret_data)
+		return ret_data
+
+	return await flights.do((service, id), fetch)
+
+async def get_vehicle_info(id):
+	"""
+	Get vehicle information based on ID
+	:param id: A unqiue idenitifer to locate a car
+	:rtype: ret_data: JSON object containing relevant vehicle details if found
+	"""
+	return await _read("vehicle_info", 'getVehicleInfoService', smartcar.parse_vehicle_info, id)
+
+async def get_door_status(id):
+	"""
+	Get status of each door for a given ID corresponding to a vehicle (LOCKED/UNLOCKED)
+	:param id: A unqiue idenitifer to locate a car
+	:rtype: ret_data: JSON object containing relevant vehicle details if found
+	"""
+	return await _read("door_status", 'getSecurityStatusService', smartcar.parse_door_status, id)
+
+async def get_energy(id):
+	"""
+	Gets both the fuel and battery range of a vehicle given its ID
+	:param id: A unqiue idenitifer to locate a car
+	:rtype: ret_data: JSON object with a "fuel" and a "battery" range, each null if not applicable
+	"""
+	return await _read("energy", 'getEnergyService', smartcar.parse_energy, id)
+
+async def get_fuel_range(id):
+	"""
+	Gets fuel range of a vehicle given its ID if applicable (if vehicle is fuel powered)
+	:param id: A unqiue idenitifer to locate a car
+	:rtype: ret_data: JSON object containing relevant vehicle details if found
+	"""
+	return smartcar.fuel_range(await get_energy(id))
+
+async def get_battery_range(id):
+	"""
+	Gets battery range of a vehicle given its ID if applicable (if vehicle is electric)
+	:param id: A unqiue idenitifer to locate a car
+	:rtype: ret_data: JSON object containing relevant vehicle details if found
+	"""
+	return smartcar.battery_range(await get_energy(id))
+
+async def control_engine(id, action):
+	"""
+	Allows clients to start/stop a vehicle given a unique ID and corresponding action
+	:param id: A unqiue idenitifer to locate a car
+	:param action: Corresponding action to take (START|STOP)
+	:rtype: ret_data: JSON object with the status (success|error) of the command
+	"""
+	params = {
+		"id": id,
+		"command" : action,
+		"responseType": "JSON"
+	}
+
+	#check for a valid input
+	params = utility.check_valid_input(params)
+	if (smartcar.unknown_vehicles.contains(id)):
+		raise errors.VehicleNotFound()
+
+	r = await _post('actionEngineService', params)
+
+	#starting or stopping the engine changes the vehicle's state, so drop what we have cached
+	smartcar.response_cache.invalidate(id)
+
+	try:
+		return smartcar.parse_engine_action(r)
+	except errors.VehicleNotFound:
+		smartcar.unknown_vehicles.add(id)
+		raise
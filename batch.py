@@ -0,0 +1,222 @@
+import json
+import threading
+import requests
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import smartcar
+import utility
+import ratelimit
+import circuit
+import errors
+
+"""
+This contains the batch operations used by the fleet routes. Lookups for many
+vehicles are fanned out to the functions in smartcar.py in parallel, so a batch
+takes about as long as its slowest lookup rather than the sum of all of them.
+Bulk engine commands are sent concurrently too, but rate limited.
+"""
+
+#Fields a client can ask for and the smartcar.py function that provides each one
+FIELDS = {
+	"info": smartcar.get_vehicle_info,
+	"doors": smartcar.get_door_status,
+	"fuel": smartcar.get_fuel_range,
+	"battery": smartcar.get_battery_range
+}
+
+#Largest number of vehicle IDs accepted in one batch
+MAX_BATCH_SIZE = 1000
+
+#Number of lookups in flight at the same time, shared by every batch
+MAX_CONCURRENCY = 16
+
+#Largest number of engine commands accepted in one bulk request
+MAX_ENGINE_BATCH_SIZE = 1000
+
+#Number of engine commands in flight at the same time, shared by every bulk request
+ENGINE_CONCURRENCY = 8
+
+#Engine commands sent to the GM API per second (and how many may go out in a burst)
+ENGINE_RATE = 20
+ENGINE_BURST = 20
+
+#Fixed error messages, encoded once
+EMPTY_BATCH = errors.preallocate("Please provide a non-empty list of vehicle IDs.")
+BATCH_TOO_LARGE = errors.preallocate("Please provide at most %d vehicle IDs per batch." % MAX_BATCH_SIZE)
+EMPTY_FIELDS = errors.preallocate("Please provide a non-empty list of fields (%s)." % "|".join(sorted(FIELDS)))
+EMPTY_ENGINE_BATCH = errors.preallocate("Please provide a non-empty list of engine commands.")
+ENGINE_BATCH_TOO_LARGE = errors.preallocate("Please provide at most %d engine commands per request." % MAX_ENGINE_BATCH_SIZE)
+INVALID_COMMAND = errors.preallocate("Please provide an object with an id and an action.")
+
+engine_limiter = ratelimit.TokenBucket(ENGINE_RATE, ENGINE_BURST)
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+def pool(name="lookup"):
+	"""
+	The thread pool running batch lookups (or engine commands), created on first use
+	:param name: "lookup" or "engine"
+	"""
+	with _pool_lock:
+		if (name not in _pools):
+			_pools[name] = ThreadPool(ENGINE_CONCURRENCY if (name == "engine") else MAX_CONCURRENCY)
+		return _pools[name]
+
+def check_id(id):
+	"""
+	Make sure a vehicle ID in a batch is an integer
+	"""
+	if (type(id) is not int):
+		raise errors.InvalidInput("Please provide a valid option for the vehicle ID. " + json.dumps(id) + " is not a valid option")
+
+def error_status(err):
+	"""
+	Map an exception raised by smartcar.py to an HTTP status code and message, the
+	same way the single vehicle routes in app.py do
+	:param err: The exception raised by a lookup
+	:rtype: error: JSON object with the "status" code and a "message"
+	"""
+	if (isinstance(err, errors.APIError)):
+		return {"status": err.status, "message": err.description}
+	if (isinstance(err, circuit.CircuitOpenError)):
+		return {"status": 503, "message": "The GM API is unavailable, please try again later"}
+	if (isinstance(err, ratelimit.ThrottledError)):
+		return {"status": 503, "message": "The GM API is busy, please try again later"}
+	if (isinstance(err, requests.exceptions.Timeout)):
+		return {"status": 504, "message": "The GM API did not answer in time"}
+	return {"status": 502, "message": "The GM API could not be reached"}
+
+def check_batch(ids, fields):
+	"""
+	Validate the ids and fields of a batch request
+	:param ids: List of vehicle IDs
+	:param fields: List of field names from FIELDS, or None for all of them
+	:rtype: (ids, fields): The IDs without duplicates and the fields to fetch
+	"""
+	if (type(ids) != list or len(ids) == 0):
+		raise errors.InvalidInput(EMPTY_BATCH)
+	if (len(ids) > MAX_BATCH_SIZE):
+		raise errors.InvalidInput(BATCH_TOO_LARGE)
+	for id in ids:
+		check_id(id)
+	if (fields is None):
+		fields = sorted(FIELDS)
+	if (type(fields) != list or len(fields) == 0):
+		raise errors.InvalidInput(EMPTY_FIELDS)
+	for field in fields:
+		if (type(field) not in utility.STRING_TYPES or field not in FIELDS):
+			raise errors.InvalidInput("Please provide valid fields (%s). %s is not a valid field" % ("|".join(sorted(FIELDS)), json.dumps(field)))
+
+	#drop duplicates while keeping the order the client asked for
+	return list(OrderedDict.fromkeys(ids)), list(OrderedDict.fromkeys(fields))
+
+def _lookup(task):
+	"""
+	Run a single (id, field) lookup, capturing its error instead of raising it
+	"""
+	id, field = task
+	try:
+		return id, field, FIELDS[field](id), None
+	except Exception as err:
+		return id, field, None, error_status(err)
+
+def fetch_batch(ids, fields=None):
+	"""
+	Look up several fields for many vehicles in parallel
+	:param ids: List of vehicle IDs
+	:param fields: List of field names from FIELDS, or None for all of them
+	:rtype: ret_data: List with one JSON object per vehicle holding its "id", each
+	requested field that was found and an "errors" object for the fields that were not
+	"""
+	ids, fields = check_batch(ids, fields)
+
+	results = dict((ret_data["id"], ret_data) for ret_data in _iter_batch(ids, fields))
+	return [results[id] for id in ids]
+
+def iter_batch(ids, fields=None):
+	"""
+	Look up several fields for many vehicles in parallel, yielding each vehicle's result
+	as soon as all of its lookups have finished. The request is validated straight away;
+	only the lookups are deferred until the iterator is consumed
+	:param ids: List of vehicle IDs
+	:param fields: List of field names from FIELDS, or None for all of them
+	:rtype: results: Iterator over the same JSON objects fetch_batch returns, in the
+	order they complete
+	"""
+	ids, fields = check_batch(ids, fields)
+	return _iter_batch(ids, fields)
+
+def _iter_batch(ids, fields):
+	#only vehicles that still have lookups in flight are held in memory, along with
+	#the number of lookups they are still waiting on
+	pending = {}
+	tasks = ((id, field) for id in ids for field in fields)
+	for id, field, value, error in pool().imap_unordered(_lookup, tasks):
+		if (id not in pending):
+			pending[id] = [{"id": id, "errors": {}}, len(fields)]
+		ret_data = pending[id][0]
+		if (error is None):
+			ret_data[field] = value
+		else:
+			ret_data["errors"][field] = error
+		pending[id][1] -= 1
+		if (pending[id][1] == 0):
+			del pending[id]
+			yield ret_data
+
+def check_engine_batch(commands):
+	"""
+	Validate every command of a bulk engine request before any of them is sent
+	:param commands: List of JSON objects with an "id" and an "action" (START|STOP)
+	:rtype: commands: List of (id, action) pairs
+	"""
+	if (type(commands) != list or len(commands) == 0):
+		raise errors.InvalidInput(EMPTY_ENGINE_BATCH)
+	if (len(commands) > MAX_ENGINE_BATCH_SIZE):
+		raise errors.InvalidInput(ENGINE_BATCH_TOO_LARGE)
+
+	pairs = []
+	problems = []
+	seen = set()
+	for index, command in enumerate(commands):
+		try:
+			if (type(command) != dict):
+				raise errors.InvalidInput(INVALID_COMMAND)
+			check_id(command.get('id'))
+			utility.check_valid_input({"id": command['id'], "command": command.get('action')})
+			if (command['id'] in seen):
+				raise errors.InvalidInput("Vehicle %d appears more than once." % command['id'])
+		except errors.InvalidInput as err:
+			problems.append("Command %d: %s" % (index, err.description))
+			continue
+		seen.add(command['id'])
+		pairs.append((command['id'], command['action']))
+
+	if (problems):
+		raise errors.InvalidInput("\n".join(problems))
+	return pairs
+
+def _engine(pair):
+	"""
+	Send a single rate limited engine command, capturing its error instead of raising it
+	"""
+	id, action = pair
+	engine_limiter.acquire()
+	ret_data = {"id": id, "action": action}
+	try:
+		ret_data.update(smartcar.control_engine(id, action))
+	except Exception as err:
+		ret_data["error"] = error_status(err)
+	return ret_data
+
+def iter_engine_batch(commands):
+	"""
+	Start or stop many vehicles. Every command is validated first; the commands are
+	then sent concurrently, within the engine rate limit
+	:param commands: List of JSON objects with an "id" and an "action" (START|STOP)
+	:rtype: results: Iterator over one JSON object per vehicle, in the order the commands
+	finish, with the "status" (success|error) of the command or an "error" object
+	"""
+	pairs = check_engine_batch(commands)
+	return pool("engine").imap_unordered(_engine, pairs)
@@ -0,0 +1,813 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import requests
+from multiprocessing.pool import ThreadPool
+try:
+	import resource
+except ImportError:
+	#not available on Windows; peak memory is then not reported
+	resource = None
+from werkzeug.serving import make_server
+import gmclient
+import smartcar
+import batch
+import utility
+import ratelimit
+import encoder
+import decoder
+import metrics
+import vehiclestate
+import simulator
+from simulator import GMSimulator
+
+"""
+Benchmarks for the Smartcar API. Every suite runs against a local GM API
+simulator so that the numbers are repeatable and do not depend on the network.
+Run a suite with `python benchmark.py <suite>`, or every suite with no argument.
+
+The `routes` suite drives every app.py route over HTTP and the `service` suite calls
+every smartcar.py function directly. Both report p50/p95/p99 latency, throughput
+and peak memory at each concurrency level given with -c. Results can be saved as
+JSON with --save and compared against an earlier run with --compare, which exits
+with status 1 when a metric got worse by more than --threshold:
+
+`python benchmark.py routes service --save before.json`
+`python benchmark.py routes service --compare before.json`
+"""
+
+def timer():
+	return timeit.default_timer()
+
+def percentile(values, p):
+	"""
+	Nearest-rank percentile of an already sorted list
+	"""
+	if (not values):
+		return 0.0
+	index = int(round(p / 100.0 * len(values) + 0.5)) - 1
+	return values[max(0, min(index, len(values) - 1))]
+
+def peak_memory():
+	"""
+	:rtype: kb: Peak resident memory of this process so far in KB, or None if unknown
+	"""
+	if (resource is None):
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	#Linux reports KB, macOS reports bytes
+	return peak // 1024 if (sys.platform == 'darwin') else peak
+
+def run_concurrently(func, total, concurrency):
+	"""
+	Call func(i) for i in range(total), spread across `concurrency` threads
+	:rtype: (elapsed, latencies, errors): Wall clock seconds taken for all calls, the
+	seconds taken by each call and the number of calls that raised
+	"""
+	latencies = [[] for _ in range(concurrency)]
+	errors = [0] * concurrency
+
+	def worker(thread):
+		record = latencies[thread].append
+		for i in range(thread, total, concurrency):
+			start = timer()
+			try:
+				func(i)
+			except Exception:
+				errors[thread] += 1
+			record(timer() - start)
+
+	threads = [threading.Thread(target=worker, args=(thread,)) for thread in range(concurrency)]
+	start = timer()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = timer() - start
+	return elapsed, sorted(sum(latencies, [])), sum(errors)
+
+def measure(name, func, total, concurrency):
+	"""
+	Run func(i) `total` times at a given concurrency and summarize the run
+	:rtype: row: Dictionary with the latency percentiles (ms), throughput (calls/s),
+	error count and peak memory (KB) of the run
+	"""
+	elapsed, latencies, errors = run_concurrently(func, total, concurrency)
+	return {
+		"name": name,
+		"concurrency": concurrency,
+		"requests": total,
+		"errors": errors,
+		"throughput": total / elapsed,
+		"p50_ms": percentile(latencies, 50) * 1000,
+		"p95_ms": percentile(latencies, 95) * 1000,
+		"p99_ms": percentile(latencies, 99) * 1000,
+		"max_rss_kb": peak_memory()
+	}
+
+def print_header():
+	print("%-30s %5s %10s %9s %9s %9s %7s %10s" % ("name", "conc", "req/s", "p50 ms", "p95 ms",
+		"p99 ms", "errors", "rss KB"))
+
+def print_row(row):
+	print("%-30s %5d %10.1f %9.2f %9.2f %9.2f %7d %10s" % (row["name"], row["concurrency"],
+		row["throughput"], row["p50_ms"], row["p95_ms"], row["p99_ms"], row["errors"], row["max_rss_kb"]))
+
+def bench_pool(args):
+	"""
+	Compare a fresh connection per request (module level requests.post) against
+	the pooled, keep-alive GMClient
+	"""
+	upstream = GMSimulator().start()
+	params = {"id": 1234, "responseType": "JSON"}
+	headers = {'Content-Type': 'application/json'}
+	url = upstream.url + '/getVehicleInfoService'
+	client = gmclient.GMClient(base_url=upstream.url, pool_maxsize=max(args.concurrency))
+
+	def unpooled(i):
+		requests.post(url, headers=headers, json=params)
+
+	def pooled(i):
+		client.post('getVehicleInfoService', params)
+
+	rows = []
+	try:
+		print_header()
+		for concurrency in args.concurrency:
+			for name, func in (("unpooled", unpooled), ("pooled", pooled)):
+				#warm up so that the pooled client has its connections open
+				func(0)
+				rows.append(measure(name, func, args.requests, concurrency))
+				print_row(rows[-1])
+	finally:
+		client.close()
+		upstream.stop()
+	return rows
+
+class Upstream(object):
+	"""
+	Points smartcar.py at a GM API simulator serving a generated fleet for the
+	duration of a suite, and knows which of its vehicles each call can be made for
+	"""
+
+	def __init__(self, args):
+		self.simulator = GMSimulator(latency=args.latency or 0, fleet_size=args.fleet_size).start()
+		self.live_client = smartcar.client
+		self.live_limiter = batch.engine_limiter
+		smartcar.client = gmclient.GMClient(base_url=self.simulator.url, pool_maxsize=max(args.concurrency))
+		#lift the bulk engine rate limit and the GM API governors so that the suites measure
+		#the API rather than the limits
+		batch.engine_limiter = ratelimit.TokenBucket(1e9, 1e9)
+		self.live_governors = smartcar.governors
+		smartcar.governors = ratelimit.Governors(rate=0, max_in_flight=0)
+
+		self.ids = list(range(simulator.FLEET_FIRST_ID, simulator.FLEET_FIRST_ID + args.fleet_size))
+		vehicles = [simulator.generate_vehicle(id) for id in self.ids]
+		self.fuel_ids = [id for id, vehicle in zip(self.ids, vehicles) if (vehicle["tankLevel"])]
+		self.battery_ids = [id for id, vehicle in zip(self.ids, vehicles) if (vehicle["batteryLevel"])]
+
+	def group(self, i, size=10):
+		"""
+		:rtype: ids: The i-th group of `size` consecutive vehicle IDs, wrapping around the fleet
+		"""
+		return [self.ids[(i * size + j) % len(self.ids)] for j in range(size)]
+
+	def close(self):
+		smartcar.client.close()
+		smartcar.client = self.live_client
+		batch.engine_limiter = self.live_limiter
+		smartcar.governors = self.live_governors
+		self.simulator.stop()
+
+def run_targets(args, targets):
+	"""
+	Measure each (name, func) target at every concurrency level. The response cache is
+	cleared before each measurement and the IDs cycle through the fleet, so the first
+	pass over the fleet goes to the GM API and later passes are served from the cache
+	"""
+	rows = []
+	print_header()
+	for name, func in targets:
+		for concurrency in args.concurrency:
+			smartcar.response_cache.clear()
+			rows.append(measure(name, func, args.requests, concurrency))
+			print_row(rows[-1])
+	return rows
+
+def bench_routes(args):
+	"""
+	Latency and throughput of every app.py route, served by a threaded werkzeug server
+	"""
+	import app
+
+	upstream = Upstream(args)
+	#one log line per request would drown the results
+	logging.getLogger('werkzeug').setLevel(logging.ERROR)
+	server = make_server('127.0.0.1', 0, app.app, threaded=True)
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+	base_url = 'http://127.0.0.1:%d' % server.server_port
+	sessions = threading.local()
+
+	def call(method, path, body=None):
+		if (not hasattr(sessions, 'session')):
+			sessions.session = requests.Session()
+		r = sessions.session.request(method, base_url + path, json=body)
+		r.raise_for_status()
+
+	def each(ids, path, method='GET', body=None):
+		return lambda i: call(method, path % ids[i % len(ids)], body)
+
+	targets = [
+		("GET /vehicles/<id>", each(upstream.ids, '/vehicles/%d')),
+		("GET /vehicles/<id>/doors", each(upstream.ids, '/vehicles/%d/doors')),
+		("GET /vehicles/<id>/fuel", each(upstream.fuel_ids, '/vehicles/%d/fuel')),
+		("GET /vehicles/<id>/battery", each(upstream.battery_ids, '/vehicles/%d/battery')),
+		("GET /vehicles/<id>/energy", each(upstream.ids, '/vehicles/%d/energy')),
+		("POST /vehicles/<id>/engine", each(upstream.ids, '/vehicles/%d/engine', 'POST', {"action": "START"})),
+		("POST /vehicles/batch", lambda i: call('POST', '/vehicles/batch', {"ids": upstream.group(i)})),
+		("POST /vehicles/engine", lambda i: call('POST', '/vehicles/engine',
+			{"commands": [{"id": id, "action": "START"} for id in upstream.group(i)]})),
+		("GET /cache/stats", lambda i: call('GET', '/cache/stats'))
+	]
+	try:
+		return run_targets(args, targets)
+	finally:
+		server.shutdown()
+		upstream.close()
+
+def bench_service(args):
+	"""
+	Latency and throughput of every smartcar.py function (and the batch functions built
+	on them), called directly without going through HTTP
+	"""
+	upstream = Upstream(args)
+
+	def each(ids, func, *extra):
+		return lambda i: func(ids[i % len(ids)], *extra)
+
+	targets = [
+		("get_vehicle_info", each(upstream.ids, smartcar.get_vehicle_info)),
+		("get_door_status", each(upstream.ids, smartcar.get_door_status)),
+		("get_fuel_range", each(upstream.fuel_ids, smartcar.get_fuel_range)),
+		("get_battery_range", each(upstream.battery_ids, smartcar.get_battery_range)),
+		("get_energy", each(upstream.ids, smartcar.get_energy)),
+		("control_engine", each(upstream.ids, smartcar.control_engine, "START")),
+		("batch.fetch_batch", lambda i: batch.fetch_batch(upstream.group(i), None)),
+		("batch.iter_engine_batch", lambda i: list(batch.iter_engine_batch(
+			[{"id": id, "action": "START"} for id in upstream.group(i)])))
+	]
+	try:
+		return run_targets(args, targets)
+	finally:
+		upstream.close()
+
+def bench_async(args):
+	"""
+	Compare how blocking smartcar.py (capped at a fixed number of worker threads) and
+	async_smartcar.py (a single thread) scale with the number of concurrent requests
+	against a slow GM API. Engine commands are used because they are never cached or
+	coalesced, so every call goes upstream
+	"""
+	import asyncio
+	import async_smartcar
+
+	latency = 0.05 if (args.latency is None) else args.latency
+	upstream = GMSimulator(latency=latency).start()
+	live_client = smartcar.client
+	smartcar.client = gmclient.GMClient(base_url=upstream.url, pool_maxsize=args.workers)
+	async_smartcar.client = async_smartcar.AsyncGMClient(base_url=upstream.url)
+	#both go through the GM API governors, which would cap them at the same rate
+	live_governors = smartcar.governors
+	smartcar.governors = ratelimit.Governors(rate=0, max_in_flight=0)
+
+	def blocking(total, concurrency):
+		pool = ThreadPool(min(concurrency, args.workers))
+		try:
+			pool.map(lambda _: smartcar.control_engine(1234, "START"), range(total))
+		finally:
+			pool.close()
+
+	def nonblocking(total, concurrency):
+		calls = [lambda: async_smartcar.control_engine(1234, "START")] * total
+		return async_smartcar.gather_limited(calls, concurrency)
+
+	rows = []
+	loop = asyncio.new_event_loop()
+	try:
+		print("upstream latency %dms, %d blocking workers" % (latency * 1000, args.workers))
+		print("%12s %14s %14s" % ("concurrency", "blocking r/s", "asyncio r/s"))
+		for concurrency in (1, 8, 32, 128, 512):
+			total = max(concurrency * 4, 32)
+			start = timer()
+			blocking(total, concurrency)
+			blocking_rate = total / (timer() - start)
+			start = timer()
+			loop.run_until_complete(nonblocking(total, concurrency))
+			async_rate = total / (timer() - start)
+			print("%12d %14.1f %14.1f" % (concurrency, blocking_rate, async_rate))
+			rows.append({"name": "blocking", "concurrency": concurrency, "throughput": blocking_rate})
+			rows.append({"name": "asyncio", "concurrency": concurrency, "throughput": async_rate})
+	finally:
+		loop.run_until_complete(async_smartcar.client.close())
+		loop.close()
+		smartcar.client = live_client
+		smartcar.governors = live_governors
+		upstream.stop()
+	return rows
+
+#Representative results of each endpoint, used by the serialization benchmarks
+SAMPLE_RESULTS = {
+	"info": {"vin": "123123412412", "color": "Metallic Silver", "doorCount": 4, "driveTrain": "v8"},
+	"doors": [
+		{"location": "frontLeft", "locked": True},
+		{"location": "frontRight", "locked": False},
+		{"location": "backLeft", "locked": True},
+		{"location": "backRight", "locked": False}
+	],
+	"fuel": {"percent": 30.2},
+	"energy": {"fuel": {"percent": 30.2}, "battery": None},
+	"engine": {"status": "success"}
+}
+SAMPLE_RESULTS["batch"] = [dict({"id": 1000 + i, "errors": {}, "info": SAMPLE_RESULTS["info"],
+	"doors": SAMPLE_RESULTS["doors"], "fuel": SAMPLE_RESULTS["fuel"]}) for i in range(100)]
+
+def bench_encode(args):
+	"""
+	Per endpoint cost of serializing a result the old way (json.dumps with indent=4) and
+	with the compact encoder, and of compressing the compact body
+	"""
+	compact = encoder.ResponseEncoder()
+	rows = []
+	print("json backend: " + encoder.BACKEND)
+	print("%-8s %10s %10s %10s %10s %8s %12s" % ("endpoint", "indent us", "compact us", "indent B",
+		"compact B", "coding", "compress us"))
+	for name in sorted(SAMPLE_RESULTS):
+		ret = SAMPLE_RESULTS[name]
+		number = max(args.requests // 10, 10) if (name == "batch") else args.requests * 10
+		indent_us = timeit.timeit(lambda: json.dumps(ret, indent=4), number=number) / number * 1e6
+		compact_us = timeit.timeit(lambda: compact.encode(ret), number=number) / number * 1e6
+		indent_size = len(json.dumps(ret, indent=4))
+		body = compact.encode(ret)
+		row = {"name": name, "indent_us": indent_us, "compact_us": compact_us,
+			"indent_bytes": indent_size, "compact_bytes": len(body)}
+		for coding, func, level in encoder.CODINGS:
+			compress_us = timeit.timeit(lambda: func(body, level), number=number) / number * 1e6
+			row[coding + "_us"] = compress_us
+			row[coding + "_bytes"] = len(func(body, level))
+			print("%-8s %10.2f %10.2f %10d %10d %8s %12.2f" % (name, indent_us, compact_us, indent_size,
+				len(body), "%s:%d" % (coding, row[coding + "_bytes"]), compress_us))
+		rows.append(row)
+	return rows
+
+def bench_decode(args):
+	"""
+	Decode throughput of each GM service response, including security responses with
+	very large doors.values arrays
+	"""
+	vehicle = dict(simulator.VEHICLES[1234])
+	payloads = [
+		("info", decoder.VEHICLE_INFO, simulator.SERVICES["getVehicleInfoService"](vehicle)),
+		("energy", decoder.ENERGY, simulator.SERVICES["getEnergyService"](vehicle)),
+		("engine", decoder.ENGINE_ACTION, simulator.SERVICES["actionEngineService"](vehicle))
+	]
+	for doors in (4, 100, 10000):
+		vehicle["doors"] = ["door%d" % i for i in range(doors)]
+		payloads.append(("doors x%d" % doors, decoder.DOOR_STATUS,
+			simulator.SERVICES["getSecurityStatusService"](vehicle)))
+
+	rows = []
+	print("%-12s %14s %16s" % ("payload", "decodes/s", "records/s"))
+	for name, decode, payload in payloads:
+		records = len(payload["data"]["doors"]["values"]) if (decode is decoder.DOOR_STATUS) else 1
+		number = max(args.requests * 50 // records, 5)
+		elapsed = timeit.timeit(lambda: decode(payload), number=number)
+		print("%-12s %14.0f %16.0f" % (name, number / elapsed, number * records / elapsed))
+		rows.append({"name": name, "decodes_per_second": number / elapsed,
+			"records_per_second": number * records / elapsed})
+	return rows
+
+def bench_metrics(args):
+	"""
+	Cost of recording a timing or a count, i.e. the overhead the instrumentation adds to
+	each phase of a request
+	"""
+	histogram = metrics.Histogram("bench_seconds", "Benchmark.", ("phase",))
+	counter = metrics.Counter("bench_total", "Benchmark.", ("service", "status"))
+
+	def timed():
+		start = metrics.now()
+		histogram.observe(("validate",), metrics.now() - start)
+
+	number = args.requests * 100
+	rows = []
+	print("%-12s %10s" % ("operation", "ns"))
+	for name, func in (("observe", lambda: histogram.observe(("validate",), 0.0001)),
+			("inc", lambda: counter.inc(("getEnergyService", 200))), ("timed phase", timed)):
+		ns = timeit.timeit(func, number=number) / number * 1e9
+		print("%-12s %10.0f" % (name, ns))
+		rows.append({"name": name, "cost_us": ns / 1000})
+	return rows
+
+def _client(job):
+	"""
+	One client process of the scaling suite: GET every path with `concurrency` threads
+	"""
+	base_url, paths, concurrency = job
+	sessions = threading.local()
+
+	def call(i):
+		if (not hasattr(sessions, 'session')):
+			sessions.session = requests.Session()
+		sessions.session.get(base_url + paths[i]).raise_for_status()
+
+	return run_concurrently(call, len(paths), concurrency)
+
+def bench_scaling(args):
+	"""
+	Throughput of serve.py as its number of worker processes grows. The load comes from
+	as many client processes as there are cores, so that the clients' own interpreter
+	lock is not what limits the measurement, and cycles through vehicle info, door and
+	energy lookups of the fleet with the response cache shared between the workers
+	"""
+	import serve
+
+	upstream = Upstream(args)
+	logging.getLogger('werkzeug').setLevel(logging.ERROR)
+	paths = []
+	for id in upstream.ids:
+		paths.extend(['/vehicles/%d' % id, '/vehicles/%d/doors' % id, '/vehicles/%d/energy' % id])
+	clients = multiprocessing.cpu_count()
+	concurrency = max(args.concurrency)
+	per_client = max(args.requests // clients, 1)
+	rows = []
+	print("%d cores, %d client processes x %d threads" % (multiprocessing.cpu_count(), clients, concurrency))
+	print("%8s %10s %9s %9s %7s %8s" % ("workers", "req/s", "p50 ms", "p99 ms", "errors", "speedup"))
+	try:
+		for workers in args.processes:
+			server = serve.Server('127.0.0.1', 0, workers=workers).start()
+			pool = multiprocessing.Pool(clients)
+			try:
+				jobs = [(server.url, [paths[(client * per_client + i) % len(paths)] for i in range(per_client)],
+					concurrency) for client in range(clients)]
+				#one pass to warm up the workers and the shared cache
+				pool.map(_client, jobs)
+				results = pool.map(_client, jobs)
+			finally:
+				pool.close()
+				pool.join()
+				server.stop()
+			latencies = sorted(sum([result[1] for result in results], []))
+			row = {
+				"name": "workers=%d" % workers,
+				"workers": workers,
+				"requests": per_client * clients,
+				"errors": sum([result[2] for result in results]),
+				"throughput": per_client * clients / max([result[0] for result in results]),
+				"p50_ms": percentile(latencies, 50) * 1000,
+				"p99_ms": percentile(latencies, 99) * 1000
+			}
+			row["speedup"] = row["throughput"] / rows[0]["throughput"] if (rows) else 1.0
+			print("%8d %10.1f %9.2f %9.2f %7d %7.2fx" % (workers, row["throughput"], row["p50_ms"],
+				row["p99_ms"], row["errors"], row["speedup"]))
+			rows.append(row)
+	finally:
+		upstream.close()
+	return rows
+
+def bench_governor(args):
+	"""
+	Upstream request rate under bursty traffic, with and without the per service
+	governors of ratelimit.py. Every second a burst of door status lookups of uncached
+	vehicles arrives at once; the GM API calls they cause are counted per 100ms window
+	"""
+	upstream = Upstream(args)
+	burst = max(args.requests // args.bursts, 1)
+	concurrency = max(args.concurrency)
+	settings = [
+		("ungoverned", ratelimit.Governors(rate=0, max_in_flight=0)),
+		("governed", ratelimit.Governors(rate=args.rate, burst=max(args.rate / 10, 1),
+			max_in_flight=concurrency // 2 or 1, queue_timeout=2.0))
+	]
+	rows = []
+	print("%d bursts of %d lookups, %d client threads, governed rate %g/s" % (args.bursts, burst, concurrency, args.rate))
+	print("%-12s %10s %10s %10s %9s %9s %9s" % ("mode", "peak qps", "mean qps", "stdev qps", "rejected",
+		"p50 ms", "p99 ms"))
+	try:
+		for name, governors in settings:
+			smartcar.governors = governors
+			upstream.simulator.reset()
+			windows = []
+			stopped = threading.Event()
+
+			def sample():
+				last = upstream.simulator.hit_count()
+				while (not stopped.wait(0.1)):
+					hits = upstream.simulator.hit_count()
+					windows.append((hits - last) * 10)
+					last = hits
+
+			sampler = threading.Thread(target=sample)
+			sampler.start()
+			latencies = []
+			rejected = [0]
+
+			def lookup(i):
+				try:
+					smartcar.get_door_status(upstream.ids[i % len(upstream.ids)])
+				except ratelimit.ThrottledError:
+					rejected[0] += 1
+
+			for _ in range(args.bursts):
+				started = timer()
+				smartcar.response_cache.clear()
+				latencies.extend(run_concurrently(lookup, burst, concurrency)[1])
+				time.sleep(max(1 - (timer() - started), 0))
+			stopped.set()
+			sampler.join()
+
+			busy = [qps for qps in windows if (qps > 0)] or [0]
+			mean = sum(busy) / float(len(busy))
+			row = {
+				"name": name,
+				"peak_upstream_qps": max(busy),
+				"mean_upstream_qps": mean,
+				"stdev_upstream_qps": (sum([(qps - mean) ** 2 for qps in busy]) / len(busy)) ** 0.5,
+				"rejected": rejected[0],
+				"p50_ms": percentile(sorted(latencies), 50) * 1000,
+				"p99_ms": percentile(sorted(latencies), 99) * 1000
+			}
+			print("%-12s %10.1f %10.1f %10.1f %9d %9.2f %9.2f" % (name, row["peak_upstream_qps"],
+				row["mean_upstream_qps"], row["stdev_upstream_qps"], row["rejected"], row["p50_ms"], row["p99_ms"]))
+			rows.append(row)
+	finally:
+		upstream.close()
+	return rows
+
+def bench_abuse(args):
+	"""
+	Throughput of requests that fail validation, as sent by a misbehaving or abusive
+	client: bad engine actions, unknown fields, malformed and oversized batches. Each
+	request must be answered with a 4xx without a single GM API call, which is checked
+	against the simulator's hit count. Lookups of 100 nonexistent vehicles show the
+	negative cache, which lets only the first lookup of each go to the GM API. The
+	cost of validating bad input in smartcar.py itself is measured without HTTP as well
+	"""
+	import app
+
+	upstream = Upstream(args)
+	logging.getLogger('werkzeug').setLevel(logging.ERROR)
+	server = make_server('127.0.0.1', 0, app.app, threaded=True)
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+	base_url = 'http://127.0.0.1:%d' % server.server_port
+	sessions = threading.local()
+
+	def call(method, path, status=400, **kwargs):
+		if (not hasattr(sessions, 'session')):
+			sessions.session = requests.Session()
+		r = sessions.session.request(method, base_url + path, **kwargs)
+		if (r.status_code != status):
+			raise AssertionError("expected a %d, got %d" % (status, r.status_code))
+
+	too_many = {"ids": list(range(batch.MAX_BATCH_SIZE + 1))}
+	targets = [
+		("bad engine action", lambda i: call('POST', '/vehicles/%d/engine' % upstream.ids[i % len(upstream.ids)],
+			json={"action": "LAUNCH"})),
+		("engine body not JSON", lambda i: call('POST', '/vehicles/1234/engine', data="START")),
+		("unknown field", lambda i: call('GET', '/vehicles/1234?fields=vin,speed')),
+		("batch bad id", lambda i: call('POST', '/vehicles/batch', json={"ids": [1234, "1235"]})),
+		("batch too large", lambda i: call('POST', '/vehicles/batch', json=too_many)),
+		("bulk engine bad action", lambda i: call('POST', '/vehicles/engine',
+			json={"commands": [{"id": id, "action": "stop"} for id in upstream.group(i)]})),
+		("changes bad ids", lambda i: call('GET', '/vehicles/changes?ids=1234,abc')),
+		#ids below the fleet that the GM API does not know; only the first lookup of each goes upstream
+		("unknown vehicle", lambda i: call('GET', '/vehicles/%d' % (1 + i % 100), status=404))
+	]
+	rows = []
+	try:
+		print("%-30s %5s %10s %9s %9s %9s %7s %10s" % ("request", "conc", "req/s", "p50 ms", "p95 ms",
+			"p99 ms", "errors", "upstream"))
+		for name, func in targets:
+			for concurrency in args.concurrency:
+				upstream.simulator.reset()
+				smartcar.forget_unknown()
+				row = measure(name, func, args.requests, concurrency)
+				row["upstream_calls"] = upstream.simulator.hit_count()
+				print("%-30s %5d %10.1f %9.2f %9.2f %9.2f %7d %10d" % (row["name"], row["concurrency"],
+					row["throughput"], row["p50_ms"], row["p95_ms"], row["p99_ms"], row["errors"], row["upstream_calls"]))
+				rows.append(row)
+	finally:
+		server.shutdown()
+		upstream.close()
+
+	invalid = [
+		("invalid id", {"id": "1234", "responseType": "JSON"}),
+		("invalid action", {"id": 1234, "command": "LAUNCH", "responseType": "JSON"}),
+		("missing action", {"id": 1234, "command": None, "responseType": "JSON"})
+	]
+	print("%-30s %10s" % ("validation", "checks/s"))
+	for name, params in invalid:
+		def check():
+			try:
+				utility.check_valid_input(dict(params))
+			except ValueError:
+				pass
+		number = args.requests * 50
+		elapsed = timeit.timeit(check, number=number)
+		print("%-30s %10.0f" % (name, number / elapsed))
+		rows.append({"name": name, "checks_per_second": number / elapsed})
+	return rows
+
+def deep_size(obj, seen):
+	"""
+	Bytes held by an object and everything it references that is not in `seen` yet, so
+	objects shared between results (e.g. interned strings) are only counted once
+	"""
+	if (id(obj) in seen):
+		return 0
+	seen.add(id(obj))
+	size = sys.getsizeof(obj)
+	if (type(obj) == dict):
+		for key, value in obj.items():
+			size += deep_size(key, seen) + deep_size(value, seen)
+	elif (type(obj) in (list, tuple)):
+		for item in obj:
+			size += deep_size(item, seen)
+	else:
+		for slot in getattr(type(obj), '__slots__', ()):
+			if (hasattr(obj, slot)):
+				size += deep_size(getattr(obj, slot), seen)
+	return size
+
+def bench_memory(args):
+	"""
+	Memory held per vehicle by cached results kept as plain dicts (as smartcar.py builds
+	them) and as the compact records of vehiclestate.py, for a fleet of --vehicles
+	vehicles, along with the cost of turning a record back into its JSON shape
+	"""
+	builders = (
+		("vehicle_info", "getVehicleInfoService", decoder.VEHICLE_INFO),
+		("door_status", "getSecurityStatusService", decoder.DOOR_STATUS),
+		("energy", "getEnergyService", decoder.ENERGY)
+	)
+	rows = []
+	print("%d vehicles" % args.vehicles)
+	print("%-14s %14s %14s %8s %10s" % ("endpoint", "dict B/vehicle", "compact B/veh", "ratio", "unpack us"))
+	for endpoint, service, decode in builders:
+		#decode every response on its own, as they arrive from the GM API
+		values = []
+		for id in range(simulator.FLEET_FIRST_ID, simulator.FLEET_FIRST_ID + args.vehicles):
+			payload = simulator.SERVICES[service](simulator.generate_vehicle(id))
+			values.append(decode(json.loads(json.dumps(payload))))
+		records = [vehiclestate.pack(endpoint, value) for value in values]
+		dict_bytes = deep_size(values, set()) / float(args.vehicles)
+		compact_bytes = deep_size(records, set()) / float(args.vehicles)
+		number = min(args.vehicles, 100000)
+		unpack_us = timeit.timeit(lambda: records[0].unpack(), number=number) / number * 1e6
+		print("%-14s %14.1f %14.1f %7.1fx %10.2f" % (endpoint, dict_bytes, compact_bytes,
+			dict_bytes / compact_bytes, unpack_us))
+		rows.append({"name": endpoint, "dict_bytes": dict_bytes, "compact_bytes": compact_bytes,
+			"unpack_us": unpack_us})
+	return rows
+
+SUITES = {
+	"routes": bench_routes,
+	"service": bench_service,
+	"pool": bench_pool,
+	"async": bench_async,
+	"encode": bench_encode,
+	"decode": bench_decode,
+	"metrics": bench_metrics,
+	"memory": bench_memory,
+	"scaling": bench_scaling,
+	"governor": bench_governor,
+	"abuse": bench_abuse
+}
+
+#Metrics where a larger value is better; for every other metric ending in one of
+#LOWER_IS_BETTER a larger value is a regression. Anything else is not compared
+HIGHER_IS_BETTER = ("throughput", "_per_second")
+LOWER_IS_BETTER = ("_ms", "_us", "_kb", "_bytes")
+
+def git_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('utf-8').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(baseline, current, threshold):
+	"""
+	Compare the suites of two benchmark runs measurement by measurement
+	:param baseline: Results loaded from an earlier --save
+	:param current: Results of this run
+	:param threshold: Relative change (e.g. 0.1 for 10%) a metric may get worse by
+	:rtype: regressions: List of (suite, measurement, metric, before, after) that got worse
+	"""
+	regressions = []
+	for suite, rows in sorted(current["suites"].items()):
+		before = {}
+		for row in baseline["suites"].get(suite, []):
+			before[(row["name"], row.get("concurrency"))] = row
+		for row in rows:
+			key = (row["name"], row.get("concurrency"))
+			if (key not in before):
+				continue
+			label = row["name"] if (key[1] is None) else "%s c=%d" % key
+			for metric, value in sorted(row.items()):
+				old = before[key].get(metric)
+				if (type(value) not in (int, float) or type(old) not in (int, float)):
+					continue
+				if (metric == "errors"):
+					worse = value > old
+				elif (metric.endswith(HIGHER_IS_BETTER)):
+					worse = old > 0 and value < old * (1 - threshold)
+				elif (metric.endswith(LOWER_IS_BETTER)):
+					worse = old > 0 and value > old * (1 + threshold)
+				else:
+					continue
+				if (worse):
+					regressions.append((suite, label, metric, old, value))
+	return regressions
+
+def parse_levels(value):
+	try:
+		levels = [int(level) for level in value.split(',')]
+	except ValueError:
+		levels = []
+	if (not levels or min(levels) < 1):
+		raise argparse.ArgumentTypeError("expected a comma separated list of positive integers: " + value)
+	return levels
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Smartcar API benchmarks")
+	parser.add_argument('suites', nargs='*', metavar='suite',
+		help="suites to run, one of: %s (default: all)" % ", ".join(sorted(SUITES)))
+	parser.add_argument('-n', '--requests', type=int, default=2000,
+		help="requests per measurement")
+	parser.add_argument('-c', '--concurrency', type=parse_levels, default=[1, 8, 32],
+		help="comma separated client thread counts to measure at (default: 1,8,32)")
+	parser.add_argument('--fleet-size', type=int, default=500,
+		help="number of simulated vehicles the routes and service suites cycle through")
+	parser.add_argument('--processes', type=parse_levels,
+		default=sorted(set([1, 2, 4, 8, 16, 32, 64]) & set(range(1, multiprocessing.cpu_count() + 1)) |
+			set([multiprocessing.cpu_count()])),
+		help="comma separated worker process counts the scaling suite measures (default: powers of two up to the core count)")
+	parser.add_argument('--rate', type=float, default=50,
+		help="GM API calls per second per service the governor suite allows")
+	parser.add_argument('--bursts', type=int, default=5,
+		help="bursts of lookups the governor suite sends, one per second")
+	parser.add_argument('--vehicles', type=int, default=100000,
+		help="number of cached vehicles the memory suite compares")
+	parser.add_argument('--latency', type=float, default=None,
+		help="simulated GM API latency in seconds (default: 0.05 for the async suite, 0 otherwise)")
+	parser.add_argument('--workers', type=int, default=8,
+		help="worker threads for the blocking side of the async suite")
+	parser.add_argument('--save', metavar='PATH', help="write the results to a JSON file")
+	parser.add_argument('--compare', metavar='PATH',
+		help="compare the results against a JSON file written by --save")
+	parser.add_argument('--threshold', type=float, default=0.1,
+		help="relative change a metric may get worse by before --compare fails (default: 0.1)")
+	args = parser.parse_args()
+	for name in args.suites:
+		if (name not in SUITES):
+			parser.error("unknown suite: " + name)
+
+	results = {
+		"commit": git_commit(),
+		"time": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"json_backend": encoder.BACKEND,
+		"args": dict((key, value) for key, value in vars(args).items()
+			if (key not in ('suites', 'save', 'compare', 'threshold'))),
+		"suites": {}
+	}
+	for name in args.suites or sorted(SUITES):
+		print("== " + name)
+		results["suites"][name] = SUITES[name](args)
+	results["max_rss_kb"] = peak_memory()
+
+	if (args.save):
+		with open(args.save, 'w') as f:
+			json.dump(results, f, indent=4, sort_keys=True)
+		print("results saved to " + args.save)
+	if (args.compare):
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		regressions = compare(baseline, results, args.threshold)
+		print("== compared with %s (%s)" % (args.compare, baseline.get("commit")))
+		for suite, label, metric, old, value in regressions:
+			print("REGRESSION %s %s %s: %.2f -> %.2f" % (suite, label, metric, old, value))
+		if (regressions):
+			sys.exit(1)
+		print("no regressions beyond %d%%" % (args.threshold * 100))
@@ -0,0 +1,316 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+"""
+This contains the in-memory response cache used by smartcar.py for the read-only
+GM API lookups. Entries expire after a per-endpoint TTL and the least recently
+used entries are evicted once the cache grows past its entry or memory bound.
+
+It also contains the negative cache of vehicle IDs the GM API does not know, so that
+repeated lookups of nonexistent vehicles are answered with a 404 without a GM API call.
+"""
+
+class Entry(object):
+	"""
+	A single cached result along with its bookkeeping
+	"""
+	__slots__ = ('value', 'size', 'stored_at', 'expires_at')
+
+	def __init__(self, value, size, stored_at, expires_at):
+		self.value = value
+		self.size = size
+		self.stored_at = stored_at
+		self.expires_at = expires_at
+
+def estimate_size(value):
+	"""
+	Approximate the memory held by a cached value using its serialized length
+	"""
+	return len(json.dumps(value, separators=(',', ':')))
+
+class ResponseCache(object):
+	"""
+	A thread safe LRU cache keyed on (endpoint, vehicle id) with a TTL per endpoint
+	"""
+
+	def __init__(self, ttls, max_entries=100000, max_bytes=64 * 1024 * 1024, clock=time.time, stale_ttls=None,
+			revalidate_ttls=None, codec=None):
+		"""
+		:param ttls: Dictionary of endpoint name -> time to live in seconds. Endpoints
+		that are not listed (or have a TTL of 0) are never cached
+		:param max_entries: Maximum number of entries kept before evicting
+		:param max_bytes: Approximate upper bound on the memory held by cached values
+		:param clock: Function returning the current time in seconds
+		:param stale_ttls: Dictionary of endpoint name -> seconds an expired result is kept
+		around for get_stale, e.g. to answer while the GM API is down
+		:param revalidate_ttls: Dictionary of endpoint name -> seconds past its expiry that
+		lookup still returns a result, flagged as stale so that the caller refreshes it
+		:param codec: Module or object with pack(endpoint, value) and unpack(stored) functions
+		that convert values to and from a more compact form for storage (see vehiclestate.py)
+		"""
+		self.ttls = dict(ttls)
+		self.stale_ttls = dict(stale_ttls or {})
+		self.revalidate_ttls = dict(revalidate_ttls or {})
+		self.codec = codec
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.clock = clock
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+		self.stale_hits = 0
+		self.revalidations = 0
+
+	def get(self, endpoint, id):
+		"""
+		Look up a cached result
+		:param endpoint: Name of the endpoint the result belongs to
+		:param id: Vehicle ID
+		:rtype: value: The cached value, or None if it is missing or has expired
+		"""
+		ret = self._lookup(endpoint, id, 0)
+		return None if (ret is None) else ret[0]
+
+	def lookup(self, endpoint, id):
+		"""
+		Look up a cached result and how old it is. Results that expired less than the
+		endpoint's revalidate_ttls window ago are still returned, flagged as stale
+		:param endpoint: Name of the endpoint the result belongs to
+		:param id: Vehicle ID
+		:rtype: (value, age, stale): The cached value, its age in seconds and whether it
+		has expired, or None if there is no result recent enough
+		"""
+		return self._lookup(endpoint, id, self.revalidate_ttls.get(endpoint, 0))
+
+	def _lookup(self, endpoint, id, revalidate_ttl):
+		key = (endpoint, id)
+		with self.lock:
+			entry = self.entries.get(key)
+			if (entry is None):
+				self.misses += 1
+				return None
+			now = self.clock()
+			stale = entry.expires_at <= now
+			if (stale and entry.expires_at + revalidate_ttl <= now):
+				#keep it around for as long as get_stale or a later lookup may still use it
+				if (entry.expires_at + self._retention(endpoint) <= now):
+					self._remove(key)
+					self.expirations += 1
+				self.misses += 1
+				return None
+			#mark as most recently used
+			del self.entries[key]
+			self.entries[key] = entry
+			if (stale):
+				self.revalidations += 1
+			else:
+				self.hits += 1
+		return self._unpack(entry.value), now - entry.stored_at, stale
+
+	def get_stale(self, endpoint, id):
+		"""
+		Look up a cached result even if it has expired, as long as it is within the
+		endpoint's stale_ttls window
+		:rtype: (value, age): The cached value and its age in seconds, or None if there is
+		none recent enough
+		"""
+		key = (endpoint, id)
+		with self.lock:
+			entry = self.entries.get(key)
+			now = self.clock()
+			if (entry is None or entry.expires_at + self.stale_ttls.get(endpoint, 0) <= now):
+				return None
+			self.stale_hits += 1
+		return self._unpack(entry.value), now - entry.stored_at
+
+	def _unpack(self, stored):
+		if (self.codec is None):
+			return stored
+		return self.codec.unpack(stored)
+
+	def expires_in(self, endpoint, id):
+		"""
+		How long until a cached result expires, without counting as a lookup
+		:rtype: seconds: Seconds left (negative once expired), or None if nothing is cached
+		"""
+		with self.lock:
+			entry = self.entries.get((endpoint, id))
+			if (entry is None):
+				return None
+			return entry.expires_at - self.clock()
+
+	def _retention(self, endpoint):
+		"""
+		Seconds past its expiry that an entry of an endpoint may still be served
+		"""
+		return max(self.stale_ttls.get(endpoint, 0), self.revalidate_ttls.get(endpoint, 0))
+
+	def set(self, endpoint, id, value):
+		"""
+		Store a result for an endpoint and vehicle ID, evicting old entries if needed
+		"""
+		ttl = self.ttls.get(endpoint, 0)
+		if (ttl <= 0 or value is None):
+			return
+		size = estimate_size(value)
+		if (size > self.max_bytes):
+			return
+		if (self.codec is not None):
+			value = self.codec.pack(endpoint, value)
+		key = (endpoint, id)
+		now = self.clock()
+		with self.lock:
+			if (key in self.entries):
+				self._remove(key)
+			self.entries[key] = Entry(value, size, now, now + ttl)
+			self.bytes += size
+			while (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+				oldest = next(iter(self.entries))
+				self._remove(oldest)
+				self.evictions += 1
+
+	def invalidate(self, id):
+		"""
+		Drop every cached result for a vehicle
+		:param id: Vehicle ID
+		"""
+		with self.lock:
+			for endpoint in self.ttls:
+				if ((endpoint, id) in self.entries):
+					self._remove((endpoint, id))
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.bytes = 0
+
+	def stats(self):
+		"""
+		:rtype: stats: Dictionary of cache counters
+		"""
+		with self.lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+				"expirations": self.expirations,
+				"stale_hits": self.stale_hits,
+				"revalidations": self.revalidations,
+				"entries": len(self.entries),
+				"bytes": self.bytes
+			}
+
+	def _remove(self, key):
+		entry = self.entries.pop(key)
+		self.bytes -= entry.size
+
+class NegativeCache(object):
+	"""
+	A thread safe, bounded set of vehicle IDs the GM API does not know. Each ID is
+	forgotten after a TTL, or straight away with discard once the vehicle is provisioned
+	"""
+
+	def __init__(self, ttl=300, max_entries=100000, clock=time.time):
+		"""
+		:param ttl: Seconds an unknown ID is remembered for; 0 to remember none
+		:param max_entries: Maximum number of IDs kept before the oldest are dropped
+		:param clock: Function returning the current time in seconds
+		"""
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.clock = clock
+		self.lock = threading.Lock()
+		#id -> expiry time; every ID has the same TTL, so the oldest also expires first
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.additions = 0
+		self.evictions = 0
+		self.expirations = 0
+		self.invalidations = 0
+
+	def add(self, id):
+		"""
+		Remember that the GM API does not know a vehicle
+		"""
+		if (self.ttl <= 0):
+			return
+		with self.lock:
+			self.entries.pop(id, None)
+			self.entries[id] = self.clock() + self.ttl
+			self.additions += 1
+			while (len(self.entries) > self.max_entries):
+				self.entries.popitem(last=False)
+				self.evictions += 1
+
+	def contains(self, id):
+		"""
+		:rtype: unknown: Whether the GM API did not know the vehicle less than a TTL ago
+		"""
+		with self.lock:
+			expires_at = self.entries.get(id)
+			if (expires_at is None):
+				self.misses += 1
+				return False
+			now = self.clock()
+			if (expires_at <= now):
+				self._expire(now)
+				self.misses += 1
+				return False
+			self.hits += 1
+			return True
+
+	def _expire(self, now):
+		#the entries are in expiry order, so the expired ones are all at the front
+		while (self.entries):
+			id, expires_at = next(iter(self.entries.items()))
+			if (expires_at > now):
+				break
+			del self.entries[id]
+			self.expirations += 1
+
+	def discard(self, ids):
+		"""
+		Forget vehicles, e.g. because they were just provisioned
+		:param ids: List of vehicle IDs
+		:rtype: count: Number of them that were remembered as unknown
+		"""
+		with self.lock:
+			count = 0
+			for id in ids:
+				if (self.entries.pop(id, None) is not None):
+					count += 1
+			self.invalidations += count
+			return count
+
+	def clear(self):
+		"""
+		Forget every vehicle
+		:rtype: count: Number of vehicles that were remembered as unknown
+		"""
+		with self.lock:
+			count = len(self.entries)
+			self.entries.clear()
+			self.invalidations += count
+			return count
+
+	def stats(self):
+		"""
+		:rtype: stats: Dictionary of negative cache counters
+		"""
+		with self.lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"additions": self.additions,
+				"evictions": self.evictions,
+				"expirations": self.expirations,
+				"invalidations": self.invalidations,
+				"entries": len(self.entries)
+			}
@@ -0,0 +1,223 @@
+import binascii
+import os
+import threading
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import errors
+
+"""
+This contains the change feed behind the /vehicles/changes routes. Rather than every
+client polling the door and energy routes in a tight loop, clients subscribe to a
+set of vehicles, and a single background poller fetches the door status and energy
+of every subscribed vehicle once per interval, compares them with what it fetched the
+time before and appends only what changed to a shared log. Subscribers wait on the log
+(long-polling, or over a Server-Sent Events stream) and are woken up as soon as one of
+their vehicles changes.
+
+Each change has a sequence number. Clients resume from the cursor of the last change
+they saw; a cursor that is too old (its changes have left the log) or that comes from
+another feed (e.g. one from before a restart) gets the current state of every vehicle
+instead. The worker processes of serve.py share a single feed, which runs in the
+manager process of sharedcache.py.
+"""
+
+class Change(object):
+	"""
+	A new door status or energy result of one vehicle
+	"""
+	__slots__ = ('seq', 'id', 'kind', 'value')
+
+	def __init__(self, seq, id, kind, value):
+		self.seq = seq
+		self.id = id
+		self.kind = kind
+		self.value = value
+
+	def to_json(self):
+		return {"id": self.id, self.kind: self.value}
+
+	def __reduce__(self):
+		#changes are handed to the worker processes of serve.py when the feed is shared
+		return (Change, (self.seq, self.id, self.kind, self.value))
+
+class ChangeFeed(object):
+	"""
+	The shared poller and the log of changes it found
+	"""
+
+	def __init__(self, sources, interval=2.0, linger=60.0, log_size=10000, threads=4, clock=time.time):
+		"""
+		:param sources: List of (kind, fetch, get): fetch(id) fetches a fresh result from the
+		GM API, get(id) returns one that may come from the cache
+		:param interval: Seconds between two polls of the subscribed vehicles
+		:param linger: Seconds a vehicle stays subscribed after the last request for it
+		:param log_size: Number of changes kept for subscribers to catch up on
+		:param threads: Vehicles are polled in parallel on this many threads
+		:param clock: Function returning the current time in seconds
+		"""
+		self.sources = sources
+		self.interval = interval
+		self.linger = linger
+		self.threads = threads
+		self.clock = clock
+		#a different epoch per feed, so that cursors of another feed are recognized
+		self.epoch = binascii.hexlify(os.urandom(4)).decode('ascii')
+		self.condition = threading.Condition(threading.Lock())
+		self.log = deque(maxlen=log_size)
+		self.seq = 0
+		#(id, kind) -> last result polled
+		self.state = {}
+		#id -> time of the last request for it
+		self.watched = {}
+		self.polls = 0
+		self.thread = None
+		self.pool = None
+
+	def cursor(self, seq=None):
+		return "%s-%d" % (self.epoch, self.seq if (seq is None) else seq)
+
+	def _parse(self, cursor):
+		"""
+		:rtype: seq: The sequence number of a cursor of this feed, or None
+		"""
+		if (not cursor):
+			return None
+		epoch, _, seq = cursor.rpartition('-')
+		if (epoch != self.epoch or not seq.isdigit() or int(seq) > self.seq):
+			return None
+		seq = int(seq)
+		#changes after seq that have left the log would be missed
+		if (seq < self.seq and (not self.log or self.log[0].seq > seq + 1)):
+			return None
+		return seq
+
+	def watch(self, ids):
+		"""
+		Subscribe to vehicles (again). They are polled once the poller is started
+		"""
+		now = self.clock()
+		with self.condition:
+			for id in ids:
+				self.watched[id] = now
+
+	def snapshot(self, ids):
+		"""
+		The current door status and energy of vehicles, as changes. Lookups may raise the
+		errors of smartcar.py, e.g. errors.VehicleNotFound for an unknown vehicle
+		:rtype: (cursor, changes): Cursor to resume from and list of changes
+		"""
+		with self.condition:
+			cursor = self.cursor()
+		changes = []
+		for id in ids:
+			for kind, fetch, get in self.sources:
+				with self.condition:
+					value = self.state.get((id, kind))
+				if (value is None):
+					value = get(id)
+					#the next poll reports changes relative to what the subscriber was sent
+					with self.condition:
+						self.state.setdefault((id, kind), value)
+				changes.append(Change(None, id, kind, value))
+		return cursor, changes
+
+	def wait(self, ids, cursor, timeout):
+		"""
+		Wait for changes of some vehicles after a cursor
+		:param ids: Vehicle IDs subscribed to
+		:param cursor: Cursor returned with the previous changes, or None
+		:param timeout: Maximum seconds to wait for a change
+		:rtype: (cursor, changes): Cursor to resume from and list of changes (empty if the
+		timeout ran out). Without a valid cursor this is the snapshot of the vehicles
+		"""
+		self.watch(ids)
+		with self.condition:
+			seq = self._parse(cursor)
+		if (seq is None):
+			return self.snapshot(ids)
+		wanted = set(ids)
+		deadline = self.clock() + timeout
+		with self.condition:
+			while (True):
+				changes = [change for change in self.log if (change.seq > seq and change.id in wanted)]
+				remaining = deadline - self.clock()
+				if (changes or remaining <= 0):
+					return self.cursor(), changes
+				#nothing for these vehicles yet, skip what was looked at already
+				seq = self.seq
+				self.condition.wait(remaining)
+
+	def _poll(self, key):
+		id, (kind, fetch, get) = key
+		try:
+			value = fetch(id)
+		except errors.VehicleNotFound:
+			#the GM API does not know this vehicle (any more)
+			with self.condition:
+				self.watched.pop(id, None)
+			return
+		except Exception:
+			#try again at the next poll
+			return
+		with self.condition:
+			if (self.state.get((id, kind)) != value):
+				if ((id, kind) in self.state):
+					self.seq += 1
+					self.log.append(Change(self.seq, id, kind, value))
+					self.condition.notify_all()
+				self.state[(id, kind)] = value
+
+	def poll_once(self):
+		"""
+		Poll every subscribed vehicle once and log what changed since the previous poll
+		:rtype: polled: Number of vehicles polled
+		"""
+		now = self.clock()
+		with self.condition:
+			for id, seen in list(self.watched.items()):
+				if (seen + self.linger <= now):
+					del self.watched[id]
+			ids = list(self.watched)
+			#forget the state of vehicles nobody is subscribed to any more
+			for key in list(self.state):
+				if (key[0] not in self.watched):
+					del self.state[key]
+		if (ids):
+			if (self.pool is None):
+				self.pool = ThreadPool(self.threads)
+			self.pool.map(self._poll, [(id, source) for id in ids for source in self.sources])
+		self.polls += 1
+		return len(ids)
+
+	def _run(self):
+		while (True):
+			started = self.clock()
+			try:
+				self.poll_once()
+			except Exception:
+				#a failed poll must not stop the poller; the next one tries again
+				pass
+			time.sleep(max(self.interval - (self.clock() - started), 0))
+
+	def start(self):
+		"""
+		Start the poller on a background thread, unless it is running already
+		"""
+		if (self.thread is None):
+			with self.condition:
+				if (self.thread is None):
+					self.thread = threading.Thread(target=self._run)
+					self.thread.daemon = True
+					self.thread.start()
+
+	def stats(self):
+		"""
+		:rtype: stats: Dictionary with the subscribed vehicles, the changes found and the polls made
+		"""
+		with self.condition:
+			return {
+				"vehicles": len(self.watched),
+				"changes": self.seq,
+				"polls": self.polls
+			}
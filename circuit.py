@@ -0,0 +1,185 @@
+import threading
+import time
+
+"""
+This contains the circuit breakers that sit in front of each GM API service. A
+breaker counts consecutive failures (errors, timeouts and 5XX responses) and once
+there are too many it opens: calls then fail straight away with CircuitOpenError
+instead of tying up a worker on a service that is down. After a cool-down a single
+trial call is let through (half-open) and its outcome closes or re-opens the breaker.
+
+Each breaker also derives the read timeout of its service from the latencies it has
+observed, so that a hung request is given up on after a few multiples of the
+service's normal p99 rather than after the fixed worst-case timeout.
+"""
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitOpenError(Exception):
+	"""
+	Raised instead of calling a GM API service whose breaker is open
+	"""
+
+	def __init__(self, service, retry_after):
+		"""
+		:param service: Name of the GM service
+		:param retry_after: Seconds until the breaker lets a trial call through
+		"""
+		Exception.__init__(self, "The GM API service %s is unavailable" % service)
+		self.service = service
+		self.retry_after = retry_after
+
+	def __reduce__(self):
+		#rebuilt from its arguments when raised in the manager process of sharedcache.py
+		return (self.__class__, (self.service, self.retry_after))
+
+class CircuitBreaker(object):
+	"""
+	A thread safe closed/open/half-open breaker with an adaptive timeout for one service
+	"""
+
+	def __init__(self, service, failure_threshold=5, reset_timeout=30.0, min_timeout=1.0,
+			max_timeout=10.0, timeout_multiplier=3.0, window=200, min_samples=20, clock=time.time):
+		"""
+		:param service: Name of the GM service
+		:param failure_threshold: Consecutive failures that open the breaker
+		:param reset_timeout: Seconds the breaker stays open before a trial call
+		:param min_timeout: Lower bound of the adaptive read timeout in seconds
+		:param max_timeout: Upper bound of the adaptive read timeout, and the timeout used
+		until enough latencies have been observed
+		:param timeout_multiplier: The adaptive timeout is this multiple of the observed p99
+		:param window: Number of recent successful call latencies the p99 is taken over
+		:param min_samples: Latencies needed before the timeout adapts
+		:param clock: Function returning the current time in seconds
+		"""
+		self.service = service
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.min_timeout = min_timeout
+		self.max_timeout = max_timeout
+		self.timeout_multiplier = timeout_multiplier
+		self.window = window
+		self.min_samples = min_samples
+		self.clock = clock
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.state = CLOSED
+			self.failures = 0
+			self.opened_at = 0
+			self.trial = False
+			self.latencies = []
+			self.next_latency = 0
+			self.timeout = self.max_timeout
+			self.rejected = 0
+
+	def allow(self):
+		"""
+		Check that a call may go ahead, moving an open breaker to half-open once its
+		cool-down has passed. Only one trial call is let through while half-open
+		"""
+		with self.lock:
+			if (self.state == CLOSED):
+				return
+			remaining = self.opened_at + self.reset_timeout - self.clock()
+			if (self.state == OPEN and remaining <= 0):
+				self.state = HALF_OPEN
+			if (self.state == HALF_OPEN and not self.trial):
+				self.trial = True
+				return
+			self.rejected += 1
+			raise CircuitOpenError(self.service, max(remaining, 0))
+
+	def cancel(self):
+		"""
+		Give back the trial call of a half-open breaker that was let through by allow but
+		never made, e.g. because it was throttled, so that the next call can be the trial
+		"""
+		with self.lock:
+			if (self.state == HALF_OPEN):
+				self.trial = False
+
+	def success(self, latency):
+		"""
+		Record a call that got a response, closing a half-open breaker
+		:param latency: Seconds the call took
+		"""
+		with self.lock:
+			self.state = CLOSED
+			self.failures = 0
+			self.trial = False
+			if (len(self.latencies) < self.window):
+				self.latencies.append(latency)
+			else:
+				self.latencies[self.next_latency] = latency
+			self.next_latency = (self.next_latency + 1) % self.window
+			#recomputing the p99 sorts the window, so only do it every few calls
+			if (len(self.latencies) >= self.min_samples and self.next_latency % 10 == 0):
+				latencies = sorted(self.latencies)
+				p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+				self.timeout = min(self.max_timeout, max(self.min_timeout, p99 * self.timeout_multiplier))
+
+	def failure(self):
+		"""
+		Record a failed call, opening the breaker after too many in a row (or straight
+		away when the trial call of a half-open breaker fails). Each failure also doubles
+		the timeout (up to max_timeout), in case the service has merely become slower
+		"""
+		with self.lock:
+			self.failures += 1
+			self.timeout = min(self.max_timeout, self.timeout * 2)
+			if (self.state == HALF_OPEN or self.failures >= self.failure_threshold):
+				self.state = OPEN
+				self.opened_at = self.clock()
+				self.trial = False
+
+	def stats(self):
+		"""
+		:rtype: stats: Dictionary with the state, consecutive failures, rejected calls and current timeout
+		"""
+		with self.lock:
+			return {
+				"state": self.state,
+				"failures": self.failures,
+				"rejected": self.rejected,
+				"timeout": self.timeout
+			}
+
+class Breakers(object):
+	"""
+	One CircuitBreaker per GM service, created on first use with shared settings
+	"""
+
+	def __init__(self, **settings):
+		"""
+		:param settings: Keyword arguments passed to every CircuitBreaker
+		"""
+		self.settings = settings
+		self.lock = threading.Lock()
+		self.breakers = {}
+
+	def get(self, service):
+		breaker = self.breakers.get(service)
+		if (breaker is None):
+			with self.lock:
+				breaker = self.breakers.get(service)
+				if (breaker is None):
+					breaker = self.breakers[service] = CircuitBreaker(service, **self.settings)
+		return breaker
+
+	def reset(self):
+		with self.lock:
+			for breaker in self.breakers.values():
+				breaker.reset()
+
+	def stats(self):
+		"""
+		:rtype: stats: Dictionary of service name -> CircuitBreaker.stats()
+		"""
+		with self.lock:
+			breakers = list(self.breakers.values())
+		return dict((breaker.service, breaker.stats()) for breaker in breakers)
@@ -0,0 +1,91 @@
+import os
+
+"""
+This contains the settings of the Smartcar API. Each one can be overridden with an
+environment variable of the same name, e.g. to point the API at a local GM API
+simulator instead of the real one:
+
+`GM_API_URL=http://127.0.0.1:8000 python app.py`
+"""
+
+def env_int(name, default):
+	return int(os.environ.get(name, default))
+
+def env_float(name, default):
+	return float(os.environ.get(name, default))
+
+def env_bool(name, default):
+	value = os.environ.get(name)
+	if (value is None):
+		return default
+	return value.lower() in ('1', 'true', 'yes', 'on')
+
+#Root URL of the GM API
+GM_API_URL = os.environ.get('GM_API_URL', 'http://gmapi.azurewebsites.net')
+
+#Connection pool of the GM API client (see gmclient.GMClient)
+GM_POOL_CONNECTIONS = env_int('GM_POOL_CONNECTIONS', 4)
+GM_POOL_MAXSIZE = env_int('GM_POOL_MAXSIZE', 32)
+GM_POOL_BLOCK = env_bool('GM_POOL_BLOCK', False)
+GM_KEEP_ALIVE = env_bool('GM_KEEP_ALIVE', True)
+
+#Seconds to wait for a connection to the GM API, and for it to answer
+GM_CONNECT_TIMEOUT = env_float('GM_CONNECT_TIMEOUT', 3.05)
+GM_READ_TIMEOUT = env_float('GM_READ_TIMEOUT', 10)
+
+#Admission control of each GM API service (see ratelimit.Governor): calls started per second
+#(0 for no limit) and the burst allowed, calls in flight at once, and seconds a call may queue
+#before it is rejected
+GM_RATE_LIMIT = env_float('GM_RATE_LIMIT', 100)
+GM_RATE_BURST = env_float('GM_RATE_BURST', 100)
+GM_MAX_IN_FLIGHT = env_int('GM_MAX_IN_FLIGHT', 32)
+GM_QUEUE_TIMEOUT = env_float('GM_QUEUE_TIMEOUT', 2.0)
+
+#Circuit breaker of each GM API service (see circuit.CircuitBreaker): consecutive failures
+#that open it, and seconds it stays open before a trial call
+CIRCUIT_FAILURE_THRESHOLD = env_int('CIRCUIT_FAILURE_THRESHOLD', 5)
+CIRCUIT_RESET_TIMEOUT = env_float('CIRCUIT_RESET_TIMEOUT', 30)
+
+#Adaptive read timeout: a multiple of each service's observed p99 latency, never below
+#GM_MIN_READ_TIMEOUT nor above GM_READ_TIMEOUT
+GM_TIMEOUT_MULTIPLIER = env_float('GM_TIMEOUT_MULTIPLIER', 3)
+GM_MIN_READ_TIMEOUT = env_float('GM_MIN_READ_TIMEOUT', 1.0)
+
+#Seconds past their TTL that cached results are still served while being refreshed in the
+#background (stale-while-revalidate), per endpoint, and the threads doing the refreshing
+SWR_VEHICLE_INFO = env_float('SWR_VEHICLE_INFO', 0)
+SWR_DOOR_STATUS = env_float('SWR_DOOR_STATUS', 10)
+SWR_ENERGY = env_float('SWR_ENERGY', 20)
+REFRESH_THREADS = env_int('REFRESH_THREADS', 4)
+
+#Background prefetching of the most requested vehicles (see prefetch.Prefetcher): GM API
+#calls per second it may make, seconds between rounds, and how many hot lookups it keeps fresh
+PREFETCH_ENABLED = env_bool('PREFETCH_ENABLED', True)
+PREFETCH_BUDGET = env_float('PREFETCH_BUDGET', 10)
+PREFETCH_INTERVAL = env_float('PREFETCH_INTERVAL', 1)
+PREFETCH_TOP = env_int('PREFETCH_TOP', 100)
+
+#Keep cached results as compact records (see vehiclestate.py) rather than plain dicts
+COMPACT_CACHE = env_bool('COMPACT_CACHE', True)
+
+#Database file of the persistent vehicle info store (see vehiclestore.py), shared by every
+#worker process and kept across restarts; empty to keep vehicle info in memory only. Stored
+#info is used for VEHICLE_STORE_TTL seconds before it is fetched from the GM API again
+VEHICLE_STORE = os.environ.get('VEHICLE_STORE', '')
+VEHICLE_STORE_TTL = env_float('VEHICLE_STORE_TTL', 7 * 86400)
+
+#Negative cache of vehicle IDs the GM API does not know (see cache.NegativeCache): seconds an
+#unknown ID is answered with a 404 without asking the GM API again (0 to always ask), and most IDs kept
+NEGATIVE_CACHE_TTL = env_float('NEGATIVE_CACHE_TTL', 300)
+NEGATIVE_CACHE_SIZE = env_int('NEGATIVE_CACHE_SIZE', 100000)
+
+#Worker processes of serve.py; 0 for one per core
+WORKERS = env_int('WORKERS', 0)
+
+#Change feed of the /vehicles/changes routes (see changefeed.py): seconds between two polls of
+#the subscribed vehicles, longest a long-poll waits for a change, seconds a vehicle stays
+#subscribed after the last request for it, and most vehicles per subscription
+CHANGES_INTERVAL = env_float('CHANGES_INTERVAL', 2)
+CHANGES_TIMEOUT = env_float('CHANGES_TIMEOUT', 25)
+CHANGES_LINGER = env_float('CHANGES_LINGER', 60)
+CHANGES_MAX_VEHICLES = env_int('CHANGES_MAX_VEHICLES', 100)
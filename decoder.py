@@ -0,0 +1,269 @@
+import errors
+
+"""
+This contains the table driven decoder for GM API responses. Each GM service is
+described once as a schema (which fields to read, how to convert them and what to
+say when a required one is missing), and each schema is compiled once into an
+extractor function that smartcar.py calls for every response.
+
+Compiling turns a schema into the source of a single expression that reads every
+field directly (e.g. {"vin": data["vin"]["value"], ...}), which is then exec'd into
+a function. Only when that raises, because something is missing or malformed, does the extractor
+fall back to checking field by field, so well formed responses (nearly all of them)
+never pay for the checks.
+"""
+
+class Field(object):
+	"""
+	One field of a decoded result
+	"""
+	__slots__ = ('name', 'paths', 'convert', 'missing')
+
+	def __init__(self, name, paths, convert=None, missing=None):
+		"""
+		:param name: Key of the field in the decoded result
+		:param paths: Tuple of keys leading to the raw value, or a list of such tuples when
+		the field is built from several raw values
+		:param convert: Function turning the raw value(s) into the decoded value
+		:param missing: Error message raised when the raw value is absent. Fields without
+		one are optional and decode to None when absent
+		"""
+		self.name = name
+		self.paths = paths if (type(paths) == list) else [paths]
+		self.convert = convert
+		self.missing = missing
+
+def _identity(value):
+	return value
+
+_BOOLEANS = {"True": True, "False": False}
+
+def boolean(value):
+	"""
+	Convert a GM boolean ("True"|"False")
+	"""
+	ret = _BOOLEANS.get(value)
+	if (ret is None):
+		raise errors.BadUpstreamResponse("Unexpected boolean value from the GM API: " + str(value))
+	return ret
+
+def percent(value):
+	"""
+	Convert a GM number that may be "null" into a {"percent": value} object (or None)
+	"""
+	if (value == 'null'):
+		return None
+	try:
+		return {"percent": float(value)}
+	except (TypeError, ValueError):
+		raise errors.BadUpstreamResponse("Unexpected number from the GM API: " + str(value))
+
+def door_count(four_door_sedan, two_door_coupe):
+	"""
+	Work out the number of doors from the GM body style flags
+	"""
+	if (two_door_coupe == 'True'):
+		return 2
+	if (four_door_sedan == 'True'):
+		return 4
+	return 0
+
+_ACTION_STATUSES = {"EXECUTED": "success", "FAILED": "error"}
+
+def action_status(value):
+	"""
+	Convert a GM engine action result (EXECUTED|FAILED) into success|error
+	"""
+	return _ACTION_STATUSES.get(value, "error")
+
+class array(object):
+	"""
+	Converter for an array of records, e.g. the doors.values list of the security service
+	"""
+
+	def __init__(self, path, fields):
+		"""
+		:param path: Tuple of keys leading from the field to the list of records
+		:param fields: List of Fields read from every record
+		"""
+		self.path = path
+		self.fields = list(fields)
+		self.element = compile_record(self.fields)
+
+	def __call__(self, value):
+		for key in self.path:
+			value = value.get(key)
+			if (value is None):
+				return []
+		return [self.element(item) for item in value]
+
+#Converters that are cheap enough to write straight into the generated expression,
+#with {0} standing for the expression reading the raw value
+_INLINE = {
+	_identity: "{0}",
+	boolean: "_BOOLEANS[{0}]",
+	percent: "(None if ({0} == 'null') else {{'percent': float({0})}})"
+}
+
+def _access(var, path):
+	return var + "".join(["[%r]" % str(key) for key in path])
+
+def _field_source(field, var, namespace):
+	"""
+	Source of the expression reading and converting one field out of the record in `var`
+	"""
+	convert = field.convert or _identity
+	values = [_access(var, path) for path in field.paths]
+	if (isinstance(convert, array)):
+		item = var + "_item"
+		return "[%s for %s in %s]" % (_record_source(convert.fields, item, namespace), item,
+			_access(values[0], convert.path))
+	if (convert in _INLINE and len(values) == 1):
+		return _INLINE[convert].format(values[0])
+	name = "convert%d" % len(namespace)
+	namespace[name] = convert
+	return "%s(%s)" % (name, ", ".join(values))
+
+def _record_source(fields, var, namespace):
+	return "{" + ", ".join(["%r: %s" % (str(field.name), _field_source(field, var, namespace))
+		for field in fields]) + "}"
+
+def _has_path(data, path):
+	for key in path:
+		if (type(data) != dict or key not in data):
+			return False
+		data = data[key]
+	return True
+
+def _compile_path(path):
+	def get(data):
+		for key in path:
+			data = data[key]
+		return data
+	return get
+
+def _checked(fields):
+	"""
+	Build the slow path of an extractor, which looks at each field to report the one
+	that is missing or fill in optional ones
+	"""
+	fields = list(fields)
+	getters = [[_compile_path(path) for path in field.paths] for field in fields]
+
+	def checked(data):
+		ret = {}
+		for field, getter in zip(fields, getters):
+			present = True
+			for path in field.paths:
+				if (not _has_path(data, path)):
+					present = False
+			if (present):
+				ret[field.name] = (field.convert or _identity)(*[get(data) for get in getter])
+			elif (field.missing is not None):
+				raise errors.BadUpstreamResponse(field.missing)
+			else:
+				ret[field.name] = None
+		return ret
+
+	return checked
+
+#The GM API answers some failed requests with HTTP 200 and the failure in the body
+UNEXPECTED_STATUS = "The GM API answered with status %s instead of data"
+
+def missing_data(payload):
+	"""
+	:param payload: Decoded GM API response without the key holding the data
+	:rtype: err: errors.VehicleNotFound when the GM API reported the vehicle unknown,
+	errors.BadUpstreamResponse for any other failure (e.g. "status": "400" or "500")
+	"""
+	status = payload.get("status") if (isinstance(payload, dict)) else None
+	if (str(status) == "404"):
+		return errors.VehicleNotFound()
+	return errors.BadUpstreamResponse(UNEXPECTED_STATUS % (status,))
+
+def _namespace(extra):
+	namespace = {"_BOOLEANS": _BOOLEANS, "_missing_data": missing_data}
+	namespace.update(extra)
+	return namespace
+
+def _compile(source, name, namespace):
+	code = compile(source, "<decoder %s>" % name, "exec")
+	exec(code, namespace)
+	return namespace[name]
+
+def compile_record(fields):
+	"""
+	Compile a list of Fields into a function that decodes one record (a dict)
+	:rtype: extract: Function taking the raw record and returning the decoded dict
+	"""
+	fields = list(fields)
+	extra = {}
+	expression = _record_source(fields, "data", extra)
+	namespace = _namespace(extra)
+	namespace["checked"] = _checked(fields)
+	source = (
+		"def extract(data):\n"
+		"\ttry:\n"
+		"\t\treturn %s\n"
+		"\texcept (KeyError, TypeError, AttributeError, ValueError):\n"
+		"\t\treturn checked(data)\n" % expression)
+	return _compile(source, "extract", namespace)
+
+def compile_schema(root, fields, result=None):
+	"""
+	Compile the schema of a GM service response into a decoder
+	:param root: Key of the response holding the data; responses without it raise the
+	error chosen by missing_data
+	:param fields: List of Fields read from the data
+	:param result: Name of a single field to return on its own instead of the whole record
+	:rtype: decode: Function taking the decoded JSON response and returning the result
+	"""
+	fields = list(fields)
+	extra = {}
+	if (result is None):
+		expression = _record_source(fields, "data", extra)
+		fallback = "checked(data)"
+	else:
+		field = [field for field in fields if (field.name == result)][0]
+		expression = _field_source(field, "data", extra)
+		fallback = "checked(data)[%r]" % str(result)
+	namespace = _namespace(extra)
+	namespace["checked"] = _checked(fields)
+	source = (
+		"def decode(payload):\n"
+		"\ttry:\n"
+		"\t\tdata = payload[%r]\n"
+		"\texcept (KeyError, TypeError):\n"
+		"\t\t#a 404 for unknown vehicles, a 502 for any other failure\n"
+		"\t\traise _missing_data(payload)\n"
+		"\ttry:\n"
+		"\t\treturn %s\n"
+		"\texcept (KeyError, TypeError, AttributeError, ValueError):\n"
+		"\t\treturn %s\n" % (str(root), expression, fallback))
+	return _compile(source, "decode", namespace)
+
+VEHICLE_INFO = compile_schema("data", [
+	Field("vin", ("vin", "value"), missing="No VIN present for this vehicle"),
+	Field("color", ("color", "value"), missing="No Color specified for this vehicle"),
+	Field("doorCount", [("fourDoorSedan", "value"), ("twoDoorCoupe", "value")], door_count,
+		missing="No door count specified for this vehicle"),
+	Field("driveTrain", ("driveTrain", "value"), missing="No drive train specified for this vehicle")
+])
+
+DOOR = [
+	Field("location", ("location", "value"), missing="No location specified for a door"),
+	Field("locked", ("locked", "value"), boolean, missing="No lock status specified for a door")
+]
+
+DOOR_STATUS = compile_schema("data", [
+	Field("doors", ("doors",), array(("values",), DOOR), missing="There are no doors for this vehicle")
+], result="doors")
+
+ENERGY = compile_schema("data", [
+	Field("fuel", ("tankLevel", "value"), percent, missing="No fuel level specified for this vehicle"),
+	Field("battery", ("batteryLevel", "value"), percent, missing="No battery level specified for this vehicle")
+])
+
+ENGINE_ACTION = compile_schema("actionResult", [
+	Field("status", ("status",), action_status, missing="No result specified for this action")
+])
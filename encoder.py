@@ -0,0 +1,196 @@
+import gzip
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+try:
+	import orjson
+except ImportError:
+	orjson = None
+try:
+	import ujson
+except ImportError:
+	ujson = None
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+"""
+This contains the encoder that turns route results into response bodies. By default
+it writes compact JSON with the fastest JSON library that is installed (orjson, then
+ujson, then the standard library). Pretty-printed JSON is only written when a client
+asks for it. Bodies can also be compressed with gzip or brotli (if installed),
+depending on what the client's Accept-Encoding header allows.
+
+For conditional requests, EncodedBodies remembers the last body encoded for each
+route along with its ETag, so that a result which has not changed since is neither
+serialized nor hashed again.
+"""
+
+def _stdlib_compact(obj):
+	return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+if (orjson is not None):
+	BACKEND = "orjson"
+	_compact = orjson.dumps
+elif (ujson is not None):
+	BACKEND = "ujson"
+	def _compact(obj):
+		return ujson.dumps(obj, escape_forward_slashes=False).encode('utf-8')
+else:
+	BACKEND = "json"
+	_compact = _stdlib_compact
+
+def _pretty(obj):
+	#pretty output is for people reading it, so it matches the original json.dumps(ret, indent=4)
+	return json.dumps(obj, indent=4).encode('utf-8')
+
+def _gzip(body, level):
+	out = io.BytesIO()
+	with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level, mtime=0) as stream:
+		stream.write(body)
+	return out.getvalue()
+
+def _brotli(body, level):
+	return brotli.compress(body, quality=level)
+
+#Supported content codings, in order of preference, with the function and level used for each
+CODINGS = [("gzip", _gzip, 6)]
+if (brotli is not None):
+	CODINGS.insert(0, ("br", _brotli, 4))
+
+def parse_accept_encoding(header):
+	"""
+	Parse an Accept-Encoding header
+	:param header: The header value, e.g. "gzip;q=0.8, br"
+	:rtype: weights: Dictionary of coding -> quality (0 means not acceptable)
+	"""
+	weights = {}
+	for part in (header or '').split(','):
+		pieces = part.strip().split(';')
+		coding = pieces[0].strip().lower()
+		if (not coding):
+			continue
+		quality = 1.0
+		for piece in pieces[1:]:
+			piece = piece.strip()
+			if (piece.startswith('q=')):
+				try:
+					quality = float(piece[2:])
+				except ValueError:
+					quality = 0.0
+		weights[coding] = quality
+	return weights
+
+class ResponseEncoder(object):
+	"""
+	Serializes results to JSON and optionally compresses them
+	"""
+
+	def __init__(self, pretty=False, compress=True, min_compress_size=1024):
+		"""
+		:param pretty: Pretty-print by default (meant for development only)
+		:param compress: Allow compressing bodies when the client accepts it
+		:param min_compress_size: Bodies smaller than this many bytes are sent as they are,
+		since compressing them costs more than it saves
+		"""
+		self.pretty = pretty
+		self.compress_enabled = compress
+		self.min_compress_size = min_compress_size
+
+	def encode(self, obj, pretty=None):
+		"""
+		Serialize a result to JSON
+		:param obj: JSON serializable result
+		:param pretty: Override the default and pretty-print (True) or not (False)
+		:rtype: body: UTF-8 encoded JSON
+		"""
+		if (pretty if (pretty is not None) else self.pretty):
+			return _pretty(obj)
+		return _compact(obj)
+
+	def compress(self, body, accept_encoding):
+		"""
+		Compress a body with the best coding the client accepts
+		:param body: Encoded response body
+		:param accept_encoding: The client's Accept-Encoding header
+		:rtype: (body, coding): The possibly compressed body, and the coding used (None if
+		the body was left as it is)
+		"""
+		if (not self.compress_enabled or len(body) < self.min_compress_size or not accept_encoding):
+			return body, None
+		weights = parse_accept_encoding(accept_encoding)
+		best = None
+		for coding, func, level in CODINGS:
+			quality = weights.get(coding, weights.get('*', 0.0))
+			if (quality > 0 and (best is None or quality > best[0])):
+				best = (quality, coding, func, level)
+		if (best is None):
+			return body, None
+		return best[2](body, best[3]), best[1]
+
+def result_tag(obj):
+	"""
+	A stable hash of a result, the same in every process and across restarts since it is
+	taken over JSON with sorted keys rather than over whatever order a dict is in
+	:rtype: tag: Hex digest to use as an ETag
+	"""
+	return hashlib.sha1(json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()[:20]
+
+class Encoded(object):
+	"""
+	A result along with its encoded body, ETag and Last-Modified time
+	"""
+	__slots__ = ('result', 'body', 'tag', 'modified')
+
+	def __init__(self, result, body, tag, modified):
+		self.result = result
+		self.body = body
+		self.tag = tag
+		self.modified = modified
+
+class EncodedBodies(object):
+	"""
+	The most recently encoded body of each key (e.g. a request path), in a thread safe
+	LRU table. Checking that a result has not changed is a comparison with the one
+	remembered, which is much cheaper than encoding and hashing it
+	"""
+
+	def __init__(self, max_entries=10000):
+		self.max_entries = max_entries
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()
+
+	def get(self, key, result):
+		"""
+		:param key: Hashable key, e.g. (path, pretty)
+		:param result: The result about to be sent for the key
+		:rtype: encoded: The Encoded remembered for the key if its result equals `result`, else None
+		"""
+		with self.lock:
+			encoded = self.entries.get(key)
+			if (encoded is None or encoded.result != result):
+				return None
+			del self.entries[key]
+			self.entries[key] = encoded
+			return encoded
+
+	def put(self, key, result, body, tag, modified):
+		"""
+		Remember the encoded body of a result, replacing the one remembered for the key
+		:param modified: Time (in seconds since the epoch) the result was fetched from the GM API
+		:rtype: encoded: The new Encoded
+		"""
+		encoded = Encoded(result, body, tag, modified)
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = encoded
+			while (len(self.entries) > self.max_entries):
+				self.entries.popitem(last=False)
+		return encoded
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
@@ -0,0 +1,69 @@
+"""
+This contains the errors raised for requests the Smartcar API cannot answer. Each
+error carries the HTTP status code it is answered with and the text of the response
+body, so the routes in app.py no longer look at error messages to pick a status code;
+a single error handler answers them all.
+
+The errors derive from ValueError, which is what smartcar.py raised for bad input and
+unknown vehicles before these existed. The bodies of errors whose message never
+changes (e.g. "Vehicle not found") are encoded once, when this module is loaded.
+"""
+
+#Encoded bodies of the fixed error messages, registered with preallocate
+_bodies = {}
+
+def preallocate(description):
+	"""
+	Encode the body of a fixed error message once, ahead of any request that fails with it
+	:param description: The message
+	:rtype: description: The same message, to be kept as a module level constant
+	"""
+	_bodies[description] = description.encode('utf-8')
+	return description
+
+class APIError(ValueError):
+	"""
+	A request the Smartcar API cannot answer, with the status code to answer it with
+	"""
+	status = 400
+	description = None
+
+	def __init__(self, description=None):
+		description = description or self.description
+		ValueError.__init__(self, description)
+		self.description = description
+
+	@property
+	def body(self):
+		"""
+		:rtype: body: The encoded response body, preallocated for fixed messages
+		"""
+		body = _bodies.get(self.description)
+		if (body is None):
+			body = self.description.encode('utf-8')
+		return body
+
+class InvalidInput(APIError):
+	"""
+	A request with a parameter of the wrong type or value. It is rejected before any
+	GM API call is made
+	"""
+	status = 400
+
+class VehicleNotFound(APIError):
+	"""
+	A vehicle the GM API does not know, or a range (fuel or battery) it does not have
+	"""
+	status = 404
+	description = preallocate("Vehicle not found")
+
+	def __init__(self, description=None):
+		#str(err) stays "404", which callers checked for before this class existed
+		ValueError.__init__(self, "404")
+		self.description = description or self.description
+
+class BadUpstreamResponse(APIError):
+	"""
+	A GM API response that is missing a field every response should have
+	"""
+	status = 502
@@ -0,0 +1,72 @@
+import requests
+from requests.adapters import HTTPAdapter
+import config
+
+"""
+This contains the shared HTTP client used to talk to the GM API. It keeps a pool
+of persistent (keep-alive) connections so that repeated calls to the same GM
+service do not pay for a new TCP handshake every time.
+"""
+
+class GMClient(object):
+	"""
+	A pooled, keep-alive client for the GM API services
+	"""
+
+	def __init__(self, base_url=config.GM_API_URL, pool_connections=config.GM_POOL_CONNECTIONS,
+			pool_maxsize=config.GM_POOL_MAXSIZE, pool_block=config.GM_POOL_BLOCK,
+			keep_alive=config.GM_KEEP_ALIVE, connect_timeout=config.GM_CONNECT_TIMEOUT,
+			read_timeout=config.GM_READ_TIMEOUT):
+		"""
+		:param base_url: Root URL of the GM API (no trailing slash)
+		:param pool_connections: Number of per-host connection pools to keep around
+		:param pool_maxsize: Maximum number of connections kept open per host
+		:param pool_block: If True, never open more than pool_maxsize connections to one host
+		and make callers wait for a free connection instead
+		:param keep_alive: Reuse connections between requests (sends Connection: close if False)
+		:param connect_timeout: Seconds to wait for a connection to be established
+		:param read_timeout: Seconds to wait for the GM API to send a response
+		"""
+		self.base_url = base_url.rstrip('/')
+		self.pool_connections = pool_connections
+		self.pool_maxsize = pool_maxsize
+		self.pool_block = pool_block
+		self.keep_alive = keep_alive
+		self.connect_timeout = connect_timeout
+		self.read_timeout = read_timeout
+
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+			pool_block=pool_block)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		self.session.headers.update({
+			'Content-Type': 'application/json'
+		})
+		if (not keep_alive):
+			self.session.headers['Connection'] = 'close'
+
+	def url(self, service):
+		"""
+		Build the full URL for a GM API service
+		:param service: Name of the GM service, e.g. getVehicleInfoService
+		:rtype: url: Absolute URL of the service
+		"""
+		return self.base_url + '/' + service
+
+	def post(self, service, params, read_timeout=None):
+		"""
+		POST a JSON request to a GM API service over a pooled connection
+		:param service: Name of the GM service, e.g. getVehicleInfoService
+		:param params: JSON serializable request body
+		:param read_timeout: Seconds to wait for the response, instead of the client's read_timeout
+		:rtype: r: The requests.Response returned by the GM API
+		"""
+		return self.session.post(self.url(service), json=params,
+			timeout=(self.connect_timeout, read_timeout or self.read_timeout))
+
+	def close(self):
+		"""
+		Close every pooled connection held by this client
+		"""
+		self.session.close()
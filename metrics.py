@@ -0,0 +1,195 @@
+import bisect
+import threading
+import timeit
+
+"""
+This contains the counters and histograms that record where the time of each
+request goes, and renders them in the Prometheus text format for the /metrics
+route. Recording a value takes a dictionary lookup, a bisect and an uncontended
+lock, so the instrumentation stays on in production.
+"""
+
+#Monotonic (where available) clock used for every timing
+now = timeit.default_timer
+
+#Upper bounds (in seconds) of the histogram buckets, from 10us up to 10s so that the same
+#buckets fit both in-process phases and GM API calls
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+	0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=None):
+	pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+	if (extra is not None):
+		pairs.append('%s="%s"' % extra)
+	return "{" + ",".join(pairs) + "}" if (pairs) else ""
+
+def _number(value):
+	if (value == float('inf')):
+		return "+Inf"
+	return repr(float(value)) if (type(value) == float) else str(value)
+
+class Counter(object):
+	"""
+	A set of monotonically increasing counts, one per combination of label values
+	"""
+
+	def __init__(self, name, help, labels=()):
+		"""
+		:param name: Metric name, e.g. smartcar_upstream_responses_total
+		:param help: One line description shown on /metrics
+		:param labels: Tuple of label names
+		"""
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self.lock = threading.Lock()
+		self.values = {}
+
+	def inc(self, labels=(), amount=1):
+		"""
+		:param labels: Tuple of label values, in the order of the label names
+		"""
+		with self.lock:
+			self.values[labels] = self.values.get(labels, 0) + amount
+
+	def value(self, labels=()):
+		with self.lock:
+			return self.values.get(labels, 0)
+
+	def render(self):
+		with self.lock:
+			values = sorted(self.values.items())
+		lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+		for labels, value in values:
+			lines.append("%s%s %s" % (self.name, _labels(self.labels, labels), _number(value)))
+		return lines
+
+class Histogram(object):
+	"""
+	A set of distributions of observed durations, one per combination of label values
+	"""
+
+	def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+		"""
+		:param name: Metric name, e.g. smartcar_phase_seconds
+		:param help: One line description shown on /metrics
+		:param labels: Tuple of label names
+		:param buckets: Sorted upper bounds of the buckets
+		"""
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self.buckets = tuple(buckets)
+		self.lock = threading.Lock()
+		#label values -> [count per bucket (the last one is +Inf), sum, count]
+		self.values = {}
+
+	def observe(self, labels, value):
+		"""
+		:param labels: Tuple of label values, in the order of the label names
+		:param value: Observed duration in seconds
+		"""
+		index = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			data = self.values.get(labels)
+			if (data is None):
+				data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+			data[0][index] += 1
+			data[1] += value
+			data[2] += 1
+
+	def count(self, labels=()):
+		with self.lock:
+			data = self.values.get(labels)
+			return 0 if (data is None) else data[2]
+
+	def render(self):
+		with self.lock:
+			values = sorted((labels, [list(data[0]), data[1], data[2]]) for labels, data in self.values.items())
+		lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+		for labels, (buckets, total, count) in values:
+			cumulative = 0
+			for bound, bucket in zip(self.buckets + (float('inf'),), buckets):
+				cumulative += bucket
+				lines.append("%s_bucket%s %d" % (self.name,
+					_labels(self.labels, labels, ("le", _number(bound))), cumulative))
+			lines.append("%s_sum%s %s" % (self.name, _labels(self.labels, labels), _number(total)))
+			lines.append("%s_count%s %d" % (self.name, _labels(self.labels, labels), count))
+		return lines
+
+class Registry(object):
+	"""
+	The metrics shown on /metrics, plus callbacks reporting values that are kept
+	elsewhere (e.g. the response cache counters)
+	"""
+
+	def __init__(self):
+		self.metrics = []
+		self.collectors = []
+
+	def register(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def collect(self, collector):
+		"""
+		:param collector: Function returning a list of (name, type, help, value) tuples,
+		called every time the metrics are rendered. The value can also be a list of
+		(labels, value) pairs, where labels is a dictionary of label name -> value
+		"""
+		self.collectors.append(collector)
+
+	def render(self):
+		"""
+		:rtype: text: Every metric in the Prometheus text exposition format
+		"""
+		lines = []
+		for metric in self.metrics:
+			lines.extend(metric.render())
+		for collector in self.collectors:
+			for name, type_name, help, value in collector():
+				lines.extend(["# HELP %s %s" % (name, help), "# TYPE %s %s" % (name, type_name)])
+				if (type(value) != list):
+					value = [({}, value)]
+				for labels, sample in value:
+					names = sorted(labels)
+					lines.append("%s%s %s" % (name, _labels(names, [labels[key] for key in names]), _number(sample)))
+		return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+#Time spent in each phase of a request: validate (utility.check_valid_input), json_decode
+#(parsing a GM API response body), shape (building our result from it), encode (serializing
+#our response) and compress
+phase_seconds = registry.register(Histogram("smartcar_phase_seconds",
+	"Time spent in each phase of handling a request.", ("phase",)))
+
+#GM API calls, per service. Status is the HTTP status code as text, "error" when no response came back
+#or "circuit_open" when the call was not made because the service's circuit breaker is open
+upstream_seconds = registry.register(Histogram("smartcar_upstream_request_seconds",
+	"Duration of GM API calls.", ("service",)))
+upstream_responses = registry.register(Counter("smartcar_upstream_responses_total",
+	"GM API calls by service and HTTP status code.", ("service", "status")))
+
+#Requests served by app.py, per route (the URL rule, e.g. /vehicles/<int:id>)
+http_seconds = registry.register(Histogram("smartcar_http_request_seconds",
+	"Duration of requests served, by route.", ("method", "route")))
+http_responses = registry.register(Counter("smartcar_http_responses_total",
+	"Requests served by route and HTTP status code.", ("method", "route", "status")))
+
+#Refreshes made by the background prefetcher, per endpoint. Result is ok, error or not_found
+prefetches = registry.register(Counter("smartcar_prefetch_refreshes_total",
+	"Background refreshes of hot cached results.", ("endpoint", "result")))
+
+#Admission of GM API calls by the governors of ratelimit.py: time waited for a slot and a rate
+#limit token, and calls rejected because they could not be admitted before their deadline.
+#Reason is "concurrency" (too many calls in flight) or "rate" (rate limit)
+queue_seconds = registry.register(Histogram("smartcar_upstream_queue_seconds",
+	"Time GM API calls waited to be admitted, by service.", ("service",)))
+upstream_rejections = registry.register(Counter("smartcar_upstream_rejections_total",
+	"GM API calls rejected by admission control, by service and reason.", ("service", "reason")))
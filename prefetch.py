@@ -0,0 +1,208 @@
+import random
+import threading
+from multiprocessing.pool import ThreadPool
+import ratelimit
+import metrics
+import errors
+
+"""
+This contains the background prefetcher that keeps the cached results of the most
+requested vehicles fresh. Every lookup is counted in a count-min sketch, a fixed
+size table of counters that estimates how often each (endpoint, vehicle id) key is
+requested without keeping a counter per key. The keys with the highest estimates
+are kept as candidates, and on a schedule the prefetcher refreshes those whose
+cached result is missing or about to expire, hottest first and within an upstream
+request budget, so that reads of hot vehicles are answered from the cache.
+
+Counts are halved periodically so that vehicles that stop being requested cool down.
+"""
+
+#Mersenne prime (2^61 - 1) the row hashes of CountMinSketch are computed modulo
+_PRIME = (1 << 61) - 1
+
+class CountMinSketch(object):
+	"""
+	Approximate frequency counts in `depth` rows of `width` counters. A key is counted
+	in one counter per row, and its estimate is the smallest of those counters, which
+	can only overestimate (when other keys share all of its counters)
+	"""
+
+	def __init__(self, width=2048, depth=4, seed=None):
+		"""
+		:param width: Counters per row
+		:param depth: Rows
+		:param seed: Seed of the random row hashes, for repeatable counts
+		"""
+		self.width = width
+		self.depth = depth
+		self.rows = [[0] * width for _ in range(depth)]
+		#each row hashes keys with its own random multiply-shift function, so that keys
+		#sharing a counter in one row are unlikely to share one in the others
+		rng = random.Random(seed)
+		self.seeds = [(rng.randrange(1, _PRIME), rng.randrange(_PRIME)) for _ in range(depth)]
+
+	def _indexes(self, key):
+		value = hash(key) % _PRIME
+		return [((a * value + b) % _PRIME) % self.width for a, b in self.seeds]
+
+	def add(self, key):
+		"""
+		Count one occurrence of a key
+		:rtype: estimate: The key's estimated count, including this occurrence
+		"""
+		estimate = None
+		for row, index in zip(self.rows, self._indexes(key)):
+			row[index] += 1
+			if (estimate is None or row[index] < estimate):
+				estimate = row[index]
+		return estimate
+
+	def estimate(self, key):
+		return min([row[index] for row, index in zip(self.rows, self._indexes(key))])
+
+	def decay(self):
+		"""
+		Halve every counter, so that old traffic counts for less than recent traffic
+		"""
+		self.rows = [[count >> 1 for count in row] for row in self.rows]
+
+class Prefetcher(object):
+	"""
+	Tracks how often each (endpoint, vehicle id) is looked up and refreshes the cached
+	results of the hottest ones in the background
+	"""
+
+	def __init__(self, refresh, expires_in, budget=10, interval=1.0, top=100, threads=4,
+			decay_every=60, width=2048, depth=4):
+		"""
+		:param refresh: Function (endpoint, id) fetching a fresh result into the cache
+		:param expires_in: Function (endpoint, id) returning the seconds left before the
+		cached result expires, or None when nothing is cached
+		:param budget: GM API calls per second the prefetcher may make
+		:param interval: Seconds between two rounds of refreshes
+		:param top: Number of hottest keys kept fresh
+		:param threads: Refreshes run in parallel on this many threads
+		:param decay_every: Rounds between two halvings of the counts
+		:param width: Counters per row of the count-min sketch
+		:param depth: Rows of the count-min sketch
+		"""
+		self.refresh = refresh
+		self.expires_in = expires_in
+		self.interval = interval
+		self.top = top
+		self.threads = threads
+		self.decay_every = decay_every
+		self.limiter = ratelimit.TokenBucket(budget, max(1, budget * interval))
+		self.sketch = CountMinSketch(width, depth)
+		self.lock = threading.Lock()
+		#key -> estimated count, for the keys that may be among the `top` hottest
+		self.candidates = {}
+		self.rounds = 0
+		self.stopped = threading.Event()
+		self.thread = None
+		self.pool = None
+
+	def record(self, endpoint, id):
+		"""
+		Count a lookup. This is on the path of every read, so it only touches the sketch
+		and the candidates
+		"""
+		key = (endpoint, id)
+		with self.lock:
+			estimate = self.sketch.add(key)
+			self.candidates[key] = estimate
+			if (len(self.candidates) > 2 * self.top):
+				self._prune()
+
+	def _prune(self):
+		hottest = sorted(self.candidates.items(), key=lambda item: -item[1])[:self.top]
+		self.candidates = dict(hottest)
+
+	def hottest(self):
+		"""
+		:rtype: keys: The `top` hottest (endpoint, id) keys, hottest first
+		"""
+		with self.lock:
+			ranked = sorted(self.candidates, key=lambda key: -self.candidates[key])
+		return ranked[:self.top]
+
+	def forget(self, key):
+		"""
+		Stop tracking a key, e.g. a vehicle the GM API does not know
+		"""
+		with self.lock:
+			self.candidates.pop(key, None)
+
+	def due(self):
+		"""
+		:rtype: keys: The hot keys whose cached result is missing or expires before the
+		round after next, hottest first
+		"""
+		lead = 2 * self.interval
+		ret = []
+		for key in self.hottest():
+			remaining = self.expires_in(*key)
+			if (remaining is None or remaining < lead):
+				ret.append(key)
+		return ret
+
+	def _refresh(self, key):
+		endpoint, id = key
+		try:
+			self.refresh(endpoint, id)
+		except errors.VehicleNotFound:
+			#the GM API does not know this vehicle; do not spend the budget on it again
+			self.forget(key)
+			metrics.prefetches.inc((endpoint, "not_found"))
+		except Exception:
+			metrics.prefetches.inc((endpoint, "error"))
+		else:
+			metrics.prefetches.inc((endpoint, "ok"))
+
+	def run_once(self):
+		"""
+		Run one round: refresh the hot keys that are due, as far as the budget allows
+		:rtype: refreshed: Number of keys refreshed (or attempted)
+		"""
+		keys = []
+		for key in self.due():
+			if (not self.limiter.try_acquire()):
+				break
+			keys.append(key)
+		if (keys):
+			if (self.pool is None):
+				self.pool = ThreadPool(self.threads)
+			self.pool.map(self._refresh, keys)
+
+		self.rounds += 1
+		if (self.rounds % self.decay_every == 0):
+			with self.lock:
+				self.sketch.decay()
+				for key in self.candidates:
+					self.candidates[key] >>= 1
+		return len(keys)
+
+	def _run(self):
+		while (not self.stopped.wait(self.interval)):
+			try:
+				self.run_once()
+			except Exception:
+				#a failed round must not stop the prefetcher; the next one tries again
+				pass
+
+	def start(self):
+		"""
+		Start refreshing on a background thread
+		"""
+		if (self.thread is None):
+			self.stopped.clear()
+			self.thread = threading.Thread(target=self._run)
+			self.thread.daemon = True
+			self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopped.set()
+		if (self.thread is not None):
+			self.thread.join()
+			self.thread = None
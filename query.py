@@ -0,0 +1,106 @@
+import threading
+from multiprocessing.pool import ThreadPool
+import smartcar
+import errors
+
+"""
+This contains the field selection of the /vehicles/<id>?fields= route. A client lists
+the fields it needs, e.g. `?fields=vin,doors,battery`, and the query is planned down to
+the GM API services that provide them: vehicle info, security (doors) and energy.
+Only those services are called, concurrently, and their results are merged into one
+object holding just the requested fields.
+"""
+
+#Each field a client can select, with the smartcar.py endpoint providing it and the
+#function picking the field out of that endpoint's result
+FIELDS = {
+	"vin": ("vehicle_info", lambda info: info["vin"]),
+	"color": ("vehicle_info", lambda info: info["color"]),
+	"doorCount": ("vehicle_info", lambda info: info["doorCount"]),
+	"driveTrain": ("vehicle_info", lambda info: info["driveTrain"]),
+	"doors": ("door_status", lambda doors: doors),
+	"fuel": ("energy", lambda energy: energy["fuel"]),
+	"battery": ("energy", lambda energy: energy["battery"])
+}
+
+#Number of service calls of field selections running on the pool at the same time. Each
+#request makes one of its calls on its own thread, so this only takes the second and third
+CONCURRENCY = 8
+
+#The pool is separate from the one of batch.py, so that a field selection never waits
+#behind the lookups of a large batch
+_pool = None
+_pool_lock = threading.Lock()
+
+#The smartcar.py function behind each endpoint
+ENDPOINTS = {
+	"vehicle_info": smartcar.get_vehicle_info,
+	"door_status": smartcar.get_door_status,
+	"energy": smartcar.get_energy
+}
+
+def parse_fields(value):
+	"""
+	Parse a comma separated list of fields
+	:param value: e.g. "vin,doors,battery"
+	:rtype: fields: List of field names, without duplicates and in the order asked for
+	"""
+	fields = []
+	for field in value.split(','):
+		field = field.strip()
+		if (field not in FIELDS):
+			raise errors.InvalidInput("Please provide valid fields (%s). %s is not a valid field" % (",".join(sorted(FIELDS)), field))
+		if (field not in fields):
+			fields.append(field)
+	return fields
+
+def plan(fields):
+	"""
+	:param fields: List of field names
+	:rtype: endpoints: The endpoints that must be called to get the fields, each only once
+	"""
+	endpoints = []
+	for field in fields:
+		endpoint = FIELDS[field][0]
+		if (endpoint not in endpoints):
+			endpoints.append(endpoint)
+	return endpoints
+
+def pool():
+	"""
+	The thread pool running the service calls of field selections, created on first use
+	"""
+	global _pool
+	with _pool_lock:
+		if (_pool is None):
+			_pool = ThreadPool(CONCURRENCY)
+		return _pool
+
+def _call(task):
+	endpoint, id = task
+	ret_data = ENDPOINTS[endpoint](id)
+	return ret_data, smartcar.result_age()
+
+def fetch_fields(id, fields):
+	"""
+	Get selected fields of a vehicle, calling only the GM API services they come from
+	:param id: Vehicle ID
+	:param fields: List of field names, as returned by parse_fields
+	:rtype: (ret_data, age): JSON object with the requested fields, and the age in seconds
+	of the oldest result it was built from. Errors of smartcar.py are raised as they are
+	"""
+	endpoints = plan(fields)
+	tasks = [(endpoint, id) for endpoint in endpoints]
+	if (len(tasks) == 1):
+		results = [_call(tasks[0])]
+	else:
+		#the first call runs on this thread while the others run on the pool
+		pending = [pool().apply_async(_call, (task,)) for task in tasks[1:]]
+		results = [_call(tasks[0])] + [call.get() for call in pending]
+
+	values = dict(zip(endpoints, [result[0] for result in results]))
+	ret_data = {}
+	for field in fields:
+		endpoint, pick = FIELDS[field]
+		ret_data[field] = pick(values[endpoint])
+	return ret_data, max([result[1] for result in results])
@@ -0,0 +1,203 @@
+import threading
+import time
+import metrics
+
+"""
+This contains the rate limiting helpers used to keep our traffic to the GM API
+within a steady number of requests per second, and within a bounded number of
+requests in flight at once.
+"""
+
+class TokenBucket(object):
+	"""
+	A thread safe token bucket. Tokens are added at a steady rate up to a maximum
+	burst size, and every request takes one token
+	"""
+
+	def __init__(self, rate, burst, clock=time.time, sleep=time.sleep):
+		"""
+		:param rate: Tokens added per second
+		:param burst: Maximum number of tokens the bucket holds
+		:param clock: Function returning the current time in seconds
+		:param sleep: Function used to wait for new tokens
+		"""
+		self.rate = float(rate)
+		self.burst = float(burst)
+		self.clock = clock
+		self.sleep = sleep
+		self.lock = threading.Lock()
+		self.tokens = self.burst
+		self.updated_at = clock()
+
+	def _refill(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+		self.updated_at = now
+
+	def try_acquire(self, tokens=1):
+		"""
+		Take tokens if they are available right now
+		:rtype: acquired: True if the tokens were taken
+		"""
+		with self.lock:
+			self._refill(self.clock())
+			if (self.tokens >= tokens):
+				self.tokens -= tokens
+				return True
+			return False
+
+	def acquire(self, tokens=1, timeout=None):
+		"""
+		Take tokens, waiting for them to be added if needed
+		:param tokens: Number of tokens to take
+		:param timeout: Maximum seconds to wait, or None to wait as long as it takes
+		:rtype: acquired: True if the tokens were taken, False if the timeout ran out first
+		"""
+		deadline = None if (timeout is None) else self.clock() + timeout
+		while (True):
+			with self.lock:
+				now = self.clock()
+				self._refill(now)
+				if (self.tokens >= tokens):
+					self.tokens -= tokens
+					return True
+				wait = (tokens - self.tokens) / self.rate
+			if (deadline is not None):
+				if (now + wait > deadline):
+					return False
+			self.sleep(wait)
+
+class ThrottledError(Exception):
+	"""
+	Raised instead of calling a GM API service when a request could not be admitted
+	by the service's Governor before its deadline
+	"""
+
+	def __init__(self, service, retry_after):
+		"""
+		:param service: Name of the GM service
+		:param retry_after: Seconds after which a retry is likely to be admitted
+		"""
+		Exception.__init__(self, "The GM API service %s is busy" % service)
+		self.service = service
+		self.retry_after = retry_after
+
+	def __reduce__(self):
+		#rebuilt from its arguments when raised in the manager process of sharedcache.py
+		return (self.__class__, (self.service, self.retry_after))
+
+class Governor(object):
+	"""
+	Admission control in front of one GM API service: at most `max_in_flight` calls at
+	once, started at no more than `rate` per second (with bursts of up to `burst`).
+	Calls that cannot start straight away queue until a slot and a token are free, and
+	give up with ThrottledError once they have waited `queue_timeout` seconds, so that a
+	spike of traffic to our API turns into a steady stream of calls to the GM API rather
+	than tripping its own throttling
+	"""
+
+	def __init__(self, service, rate=100, burst=100, max_in_flight=32, queue_timeout=2.0,
+			clock=time.time, sleep=time.sleep):
+		"""
+		:param service: Name of the GM service
+		:param rate: Calls started per second, or 0 for no rate limit
+		:param burst: Calls that may start at once after a quiet period
+		:param max_in_flight: Calls in progress at once, or 0 for no limit
+		:param queue_timeout: Maximum seconds a call waits to be admitted
+		:param clock: Function returning the current time in seconds
+		:param sleep: Function used to wait for new tokens
+		"""
+		self.service = service
+		self.max_in_flight = max_in_flight
+		self.queue_timeout = queue_timeout
+		self.clock = clock
+		self.bucket = TokenBucket(rate, burst, clock, sleep) if (rate > 0) else None
+		self.condition = threading.Condition(threading.Lock())
+		self.in_flight = 0
+		self.queued = 0
+		self.admitted = 0
+		self.rejected = 0
+
+	def acquire(self):
+		"""
+		Wait until a call may start, then count it as in flight; every successful acquire
+		must be followed by a release once the call is over
+		"""
+		start = self.clock()
+		deadline = start + self.queue_timeout
+		with self.condition:
+			self.queued += 1
+			try:
+				while (self.max_in_flight > 0 and self.in_flight >= self.max_in_flight):
+					remaining = deadline - self.clock()
+					if (remaining <= 0):
+						self._reject("concurrency", start)
+					self.condition.wait(remaining)
+				self.in_flight += 1
+			finally:
+				self.queued -= 1
+
+		if (self.bucket is not None and not self.bucket.acquire(timeout=max(deadline - self.clock(), 0))):
+			self.release()
+			with self.condition:
+				self._reject("rate", start)
+
+		waited = self.clock() - start
+		metrics.queue_seconds.observe((self.service,), waited)
+		with self.condition:
+			self.admitted += 1
+		return waited
+
+	def _reject(self, reason, start):
+		#called with the condition held
+		self.rejected += 1
+		metrics.upstream_rejections.inc((self.service, reason))
+		metrics.queue_seconds.observe((self.service,), self.clock() - start)
+		retry_after = 1.0 / self.bucket.rate if (reason == "rate") else self.queue_timeout
+		raise ThrottledError(self.service, retry_after)
+
+	def release(self):
+		with self.condition:
+			self.in_flight -= 1
+			self.condition.notify()
+
+	def stats(self):
+		"""
+		:rtype: stats: Dictionary with the calls in flight, queued, admitted and rejected
+		"""
+		with self.condition:
+			return {
+				"in_flight": self.in_flight,
+				"queued": self.queued,
+				"admitted": self.admitted,
+				"rejected": self.rejected
+			}
+
+class Governors(object):
+	"""
+	One Governor per GM service, created on first use with shared settings
+	"""
+
+	def __init__(self, **settings):
+		"""
+		:param settings: Keyword arguments passed to every Governor
+		"""
+		self.settings = settings
+		self.lock = threading.Lock()
+		self.governors = {}
+
+	def get(self, service):
+		governor = self.governors.get(service)
+		if (governor is None):
+			with self.lock:
+				governor = self.governors.get(service)
+				if (governor is None):
+					governor = self.governors[service] = Governor(service, **self.settings)
+		return governor
+
+	def stats(self):
+		"""
+		:rtype: stats: Dictionary of service name -> Governor.stats()
+		"""
+		with self.lock:
+			governors = list(self.governors.values())
+		return dict((governor.service, governor.stats()) for governor in governors)
@@ -0,0 +1,132 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+from werkzeug.serving import make_server
+import config
+import smartcar
+import sharedcache
+import app
+
+"""
+This is the production entry point of the Smartcar API. `python app.py` runs Flask's
+single-process debug server; this runs a pre-forked pool of worker processes instead:
+
+`python serve.py --port 5000 --workers 4`
+
+The listening socket is opened once and inherited by every worker, each of which
+accepts connections on it and serves them on its own threads, so requests spread
+across all cores rather than queueing behind one interpreter lock. The workers share
+the response cache, the single-flight table, the negative cache and the change feed
+through sharedcache.py, and only the first worker prefetches hot vehicles. A worker
+that dies is replaced.
+"""
+
+def _interrupt(signum, frame):
+	raise KeyboardInterrupt
+
+def _worker(server, index, shares, address, authkey, shared):
+	#workers are stopped by the parent with SIGTERM, not by the Ctrl-C meant for the parent
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	#the governors are per process, so each worker keeps to its share of the GM API limits
+	smartcar.split_upstream_limits(shares)
+	if (shared):
+		cache, group, unknown, changes = sharedcache.connect(address, authkey)
+		smartcar.use_shared_state(cache, group, unknown)
+		app.change_feed = changes
+	#SQLite connections must not be carried over a fork
+	if (smartcar.vehicle_store is not None):
+		smartcar.vehicle_store = smartcar.vehiclestore.VehicleStore(smartcar.vehicle_store.path)
+	if (index == 0):
+		smartcar.start_prefetching()
+	server.serve_forever()
+
+class Server(object):
+	"""
+	A pool of worker processes serving app.py on one port
+	"""
+
+	def __init__(self, host='127.0.0.1', port=5000, workers=None, shared=True):
+		"""
+		:param host: Interface to listen on
+		:param port: Port to listen on, or 0 for any free port
+		:param workers: Number of worker processes, one per core by default
+		:param shared: Whether the workers share their response cache and single-flight
+		state; each worker keeps its own otherwise
+		"""
+		self.workers = workers or multiprocessing.cpu_count()
+		self.shared = shared
+		self.server = make_server(host, port, app.app, threaded=True)
+		self.port = self.server.server_port
+		self.url = "http://%s:%d" % (host, self.port)
+		self.address = sharedcache.socket_path()
+		self.authkey = os.urandom(16)
+		#the manager process polls the GM API for the change feed, so it takes a share of
+		#the GM API limits along with the workers
+		self.shares = self.workers + 1 if (shared) else self.workers
+		self.manager = None
+		self.processes = []
+
+	def _spawn(self, index):
+		process = sharedcache.fork.Process(target=_worker,
+			args=(self.server, index, self.shares, self.address, self.authkey, self.shared))
+		process.daemon = True
+		process.start()
+		return process
+
+	def start(self):
+		if (self.shared):
+			self.manager = sharedcache.serve(smartcar.response_cache, smartcar.unknown_vehicles,
+				app.change_feed, self.address, self.authkey, smartcar.split_upstream_limits, (self.shares,))
+		self.processes = [self._spawn(index) for index in range(self.workers)]
+		return self
+
+	def supervise(self, interval=1.0):
+		"""
+		Replace workers that died, until interrupted
+		"""
+		try:
+			while (True):
+				time.sleep(interval)
+				for index, process in enumerate(self.processes):
+					if (not process.is_alive()):
+						self.processes[index] = self._spawn(index)
+		except KeyboardInterrupt:
+			pass
+
+	def stop(self):
+		for process in self.processes:
+			process.terminate()
+		for process in self.processes:
+			process.join()
+		self.processes = []
+		self.server.server_close()
+		if (self.manager is not None):
+			self.manager.shutdown()
+			self.manager = None
+		if (os.path.exists(self.address)):
+			os.remove(self.address)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Serve the Smartcar API on a pool of worker processes")
+	parser.add_argument('--host', default='127.0.0.1', help="interface to listen on")
+	parser.add_argument('--port', type=int, default=5000, help="port to listen on")
+	parser.add_argument('--workers', type=int, default=config.WORKERS or None,
+		help="number of worker processes (default: one per core)")
+	parser.add_argument('--no-shared-cache', dest='shared', action='store_false',
+		help="give each worker its own response cache")
+	args = parser.parse_args(argv)
+
+	server = Server(args.host, args.port, args.workers, args.shared).start()
+	#end the workers on SIGTERM as well as on Ctrl-C
+	signal.signal(signal.SIGTERM, _interrupt)
+	print("Serving on %s with %d workers" % (server.url, server.workers))
+	try:
+		server.supervise()
+	finally:
+		server.stop()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,209 @@
+import binascii
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from multiprocessing.managers import BaseManager
+import singleflight
+
+"""
+This contains the state that the worker processes of serve.py share: the response
+cache, the single-flight table of GM API calls in progress and the negative cache of
+vehicles the GM API does not know. All of them live in one manager process and the
+workers reach them over a local (Unix domain) socket, so a result fetched by one
+worker is a cache hit for every other worker, concurrent identical lookups in
+different workers still make a single GM API call, and a vehicle one worker found to
+be unknown is answered with a 404 by all of them. The change feed of the
+/vehicles/changes routes runs there too, so a single poller serves the subscribers of
+every worker and a cursor from one worker is valid in all of them.
+
+Each call to the shared cache is a round trip over the socket, which costs tens of
+microseconds instead of the sub-microsecond dictionary lookup of an in-process
+cache, in exchange for fetching every result once per host rather than once per worker.
+"""
+
+#The manager process and the workers of serve.py inherit live objects (the caches, the
+#change feed, the listening server) instead of having them pickled, so they are always
+#forked, whatever the default start method (spawn on macOS, forkserver on Linux from
+#Python 3.14)
+try:
+	fork = multiprocessing.get_context('fork')
+except AttributeError:
+	#Python 2 always forks
+	fork = multiprocessing
+
+#States returned by FlightTable.join
+LEADER = "leader"
+DONE = "done"
+FAILED = "failed"
+
+class _Flight(object):
+	"""
+	A GM API call in progress in one of the workers
+	"""
+	__slots__ = ('event', 'result', 'ok', 'started')
+
+	def __init__(self, started):
+		self.event = threading.Event()
+		self.result = None
+		self.ok = False
+		self.started = started
+
+class FlightTable(object):
+	"""
+	The calls in progress across all workers. Lives in the manager process; each
+	worker thread waiting on a call blocks a manager thread of its own
+	"""
+
+	def __init__(self, timeout=30.0, clock=time.time):
+		"""
+		:param timeout: Seconds after which a call is given up on, e.g. because the
+		worker making it died; its waiters then make the call themselves
+		:param clock: Function returning the current time in seconds
+		"""
+		self.timeout = timeout
+		self.clock = clock
+		self.lock = threading.Lock()
+		self.flights = {}
+		self.leaders = 0
+		self.shared = 0
+
+	def join(self, key):
+		"""
+		Become the leader of a call, or wait for the call already in progress
+		:param key: Hashable identifier of the call, e.g. (service, id)
+		:rtype: (state, result): (LEADER, None) if the caller must make the call and then
+		report it with end; (DONE, result) with the leader's result; (FAILED, None) if the
+		leader failed or timed out, in which case the caller makes the call on its own
+		"""
+		with self.lock:
+			flight = self.flights.get(key)
+			now = self.clock()
+			if (flight is None or flight.started + self.timeout <= now):
+				self.flights[key] = _Flight(now)
+				self.leaders += 1
+				return LEADER, None
+			self.shared += 1
+		if (not flight.event.wait(max(flight.started + self.timeout - now, 0))):
+			return FAILED, None
+		return (DONE, flight.result) if (flight.ok) else (FAILED, None)
+
+	def end(self, key, result, ok):
+		"""
+		Report the outcome of a call joined as its leader, waking its waiters
+		:param result: The result of the call, handed to the waiters if ok
+		:param ok: Whether the call succeeded
+		"""
+		with self.lock:
+			flight = self.flights.get(key)
+			if (flight is None):
+				return
+			del self.flights[key]
+		flight.result = result
+		flight.ok = ok
+		flight.event.set()
+
+	def stats(self):
+		with self.lock:
+			return {
+				"calls": self.leaders,
+				"shared": self.shared,
+				"in_flight": len(self.flights)
+			}
+
+class SharedGroup(object):
+	"""
+	A drop-in replacement of singleflight.Group for a worker process. Calls are first
+	coalesced within the process, and the one call left is then coalesced with the
+	other workers through the shared FlightTable
+	"""
+
+	def __init__(self, table):
+		"""
+		:param table: Proxy of the shared FlightTable
+		"""
+		self.table = table
+		self.local = singleflight.Group()
+
+	def do(self, key, func):
+		"""
+		As singleflight.Group.do. The result must be picklable, since it is handed to the
+		other workers
+		"""
+		return self.local.do(key, lambda: self._do(key, func))
+
+	def _do(self, key, func):
+		state, result = self.table.join(key)
+		if (state == DONE):
+			return result
+		if (state == FAILED):
+			#errors are not shared between workers; make the call and raise our own
+			return func()
+		try:
+			result = func()
+		except Exception:
+			self.table.end(key, None, False)
+			raise
+		self.table.end(key, result, True)
+		return result
+
+	def stats(self):
+		"""
+		:rtype: stats: As singleflight.Group.stats, across every worker
+		"""
+		stats = self.table.stats()
+		stats['shared'] += self.local.stats()['shared']
+		return stats
+
+class SharedStateManager(BaseManager):
+	pass
+
+#Methods of changefeed.ChangeFeed the workers call
+CHANGE_FEED_METHODS = ('watch', 'snapshot', 'wait', 'start', 'stats')
+
+def serve(cache, unknown, changes, address, authkey, initializer=None, initargs=()):
+	"""
+	Start the manager process holding the shared state
+	:param cache: The cache.ResponseCache to share; the manager process gets its own copy
+	:param unknown: The cache.NegativeCache to share, likewise
+	:param changes: The changefeed.ChangeFeed to share, likewise. Its poller runs in the
+	manager process, where it fetches through the shared cache
+	:param address: Path of the Unix domain socket the workers connect to
+	:param authkey: Secret the workers must present
+	:param initializer: Function called with initargs in the manager process once it has started
+	:rtype: manager: The started SharedStateManager, to be shut down with shutdown()
+	"""
+	table = FlightTable()
+	SharedStateManager.register('cache', callable=lambda: cache)
+	SharedStateManager.register('flights', callable=lambda: table)
+	SharedStateManager.register('unknown', callable=lambda: unknown)
+	SharedStateManager.register('changes', callable=lambda: changes, exposed=CHANGE_FEED_METHODS)
+	if (fork is multiprocessing):
+		manager = SharedStateManager(address=address, authkey=authkey)
+	else:
+		manager = SharedStateManager(address=address, authkey=authkey, ctx=fork)
+	manager.start(initializer, initargs)
+	return manager
+
+def connect(address, authkey):
+	"""
+	Connect a worker process to the manager started by serve
+	:rtype: (cache, flights, unknown, changes): Proxy of the shared response cache, a
+	SharedGroup to use in place of the process's own, and proxies of the shared negative
+	cache and change feed
+	"""
+	SharedStateManager.register('cache')
+	SharedStateManager.register('flights')
+	SharedStateManager.register('unknown')
+	SharedStateManager.register('changes', exposed=CHANGE_FEED_METHODS)
+	manager = SharedStateManager(address=address, authkey=authkey)
+	manager.connect()
+	return manager.cache(), SharedGroup(manager.flights()), manager.unknown(), manager.changes()
+
+def socket_path(directory=None):
+	"""
+	:rtype: path: A fresh path for the Unix domain socket of the manager
+	"""
+	directory = directory or tempfile.gettempdir()
+	return os.path.join(directory, "smartcar-%d-%s.sock" % (os.getpid(), binascii.hexlify(os.urandom(4))))
@@ -0,0 +1,361 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+try:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+except ImportError:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+
+"""
+This is a local stand-in for the GM API. It answers getVehicleInfoService,
+getSecurityStatusService, getEnergyService and actionEngineService with the same
+payload shapes as gmapi.azurewebsites.net, so that tests and benchmarks can run
+offline and give repeatable numbers.
+
+Besides the two well known vehicles (1234 and 1235) it can serve a generated fleet
+of any size, and it can add latency, failures (HTTP 500) and hung requests to its
+answers. Run it on its own with e.g.
+
+`python simulator.py --port 8000 --fleet-size 100000 --latency exponential:0.05 --error-rate 0.01`
+
+and point the API at it with `GM_API_URL=http://127.0.0.1:8000 python app.py`.
+"""
+
+VEHICLES = {
+	1234: {
+		"vin": "123123412412",
+		"color": "Metallic Silver",
+		"fourDoorSedan": "True",
+		"twoDoorCoupe": "False",
+		"driveTrain": "v8",
+		"doors": ["frontLeft", "frontRight", "backLeft", "backRight"],
+		"tankLevel": True,
+		"batteryLevel": False
+	},
+	1235: {
+		"vin": "1235AZ91XP",
+		"color": "Forest Green",
+		"fourDoorSedan": "False",
+		"twoDoorCoupe": "True",
+		"driveTrain": "electric",
+		"doors": ["frontLeft", "frontRight"],
+		"tankLevel": False,
+		"batteryLevel": True
+	}
+}
+
+#First id of the generated fleet, which is numbered FLEET_FIRST_ID, FLEET_FIRST_ID + 1, ...
+FLEET_FIRST_ID = 10000
+
+COLORS = ["Metallic Silver", "Forest Green", "Midnight Blue", "Pearl White", "Jet Black", "Candy Red"]
+DRIVE_TRAINS = ["v4", "v6", "v8", "electric"]
+FOUR_DOORS = ["frontLeft", "frontRight", "backLeft", "backRight"]
+TWO_DOORS = ["frontLeft", "frontRight"]
+
+def generate_vehicle(id, seed=0):
+	"""
+	Build the static details of a generated fleet vehicle; the same id and seed always
+	give the same vehicle
+	:param id: Vehicle ID
+	:param seed: Fleet seed, so that different fleets can be generated
+	:rtype: vehicle: Dictionary shaped like the entries of VEHICLES
+	"""
+	rng = random.Random(seed * 1000003 + id)
+	four_doors = rng.random() < 0.7
+	drive_train = rng.choice(DRIVE_TRAINS)
+	electric = drive_train == "electric"
+	return {
+		"vin": "%d%08X" % (id, rng.getrandbits(32)),
+		"color": rng.choice(COLORS),
+		"fourDoorSedan": str(four_doors),
+		"twoDoorCoupe": str(not four_doors),
+		"driveTrain": drive_train,
+		"doors": FOUR_DOORS if (four_doors) else TWO_DOORS,
+		"tankLevel": not electric,
+		"batteryLevel": electric
+	}
+
+def _field(type_name, value):
+	return {"type": type_name, "value": value}
+
+def _vehicle_info(vehicle):
+	return {
+		"service": "getVehicleInfo",
+		"status": "200",
+		"data": {
+			"vin": _field("String", vehicle["vin"]),
+			"color": _field("String", vehicle["color"]),
+			"fourDoorSedan": _field("Boolean", vehicle["fourDoorSedan"]),
+			"twoDoorCoupe": _field("Boolean", vehicle["twoDoorCoupe"]),
+			"driveTrain": _field("String", vehicle["driveTrain"])
+		}
+	}
+
+def _security_status(vehicle):
+	values = []
+	for location in vehicle["doors"]:
+		values.append({
+			"location": _field("String", location),
+			"locked": _field("Boolean", random.choice(["True", "False"]))
+		})
+	return {
+		"service": "getSecurityStatus",
+		"status": "200",
+		"data": {
+			"doors": {"type": "Array", "values": values}
+		}
+	}
+
+def _energy_level(present):
+	if (present):
+		return _field("Number", "%.2f" % random.uniform(0, 100))
+	return _field("Null", "null")
+
+def _energy(vehicle):
+	return {
+		"service": "getEnergy",
+		"status": "200",
+		"data": {
+			"tankLevel": _energy_level(vehicle["tankLevel"]),
+			"batteryLevel": _energy_level(vehicle["batteryLevel"])
+		}
+	}
+
+def _action_engine(vehicle):
+	return {
+		"service": "actionEngine",
+		"status": "200",
+		"actionResult": {"status": random.choice(["EXECUTED", "FAILED"])}
+	}
+
+SERVICES = {
+	"getVehicleInfoService": _vehicle_info,
+	"getSecurityStatusService": _security_status,
+	"getEnergyService": _energy,
+	"actionEngineService": _action_engine
+}
+
+#Number of arguments taken by each latency distribution
+_LATENCY_ARGS = {"fixed": 1, "uniform": 2, "exponential": 1, "normal": 2, "lognormal": 2}
+
+def parse_latency(spec):
+	"""
+	Turn a latency description into a function returning a delay in seconds
+	:param spec: A number of seconds, a function returning one, or one of "fixed:S",
+	"uniform:LOW,HIGH", "exponential:MEAN", "normal:MEAN,STDDEV" and
+	"lognormal:MEDIAN,SIGMA" (all in seconds)
+	:rtype: latency: Function taking no arguments and returning a delay in seconds
+	"""
+	if (callable(spec)):
+		return spec
+	if (isinstance(spec, (int, float))):
+		return lambda: spec
+	name, _, args = str(spec).partition(':')
+	try:
+		if (not args):
+			value = float(name)
+			return lambda: value
+		values = [float(arg) for arg in args.split(',')]
+	except ValueError:
+		values = None
+	if (values is not None and len(values) == _LATENCY_ARGS.get(name) and min(values) >= 0):
+		low, high = values[0], values[-1]
+		if (name == 'fixed'):
+			return lambda: low
+		if (name == 'uniform' and low <= high):
+			return lambda: random.uniform(low, high)
+		if (name == 'exponential' and low > 0):
+			return lambda: random.expovariate(1.0 / low)
+		if (name == 'normal'):
+			return lambda: max(0.0, random.gauss(low, high))
+		if (name == 'lognormal' and low > 0):
+			mu = math.log(low)
+			return lambda: random.lognormvariate(mu, high)
+	raise ValueError("Invalid latency: " + str(spec))
+
+class _Handler(BaseHTTPRequestHandler):
+	#HTTP/1.1 so that clients can keep their connections alive between requests
+	protocol_version = 'HTTP/1.1'
+	#headers and body go out in separate writes; do not let Nagle hold the body back
+	disable_nagle_algorithm = True
+
+	def do_POST(self):
+		simulator = self.server.simulator
+		service = self.path.strip('/')
+		length = int(self.headers.get('Content-Length') or 0)
+		body = self.rfile.read(length)
+		simulator.record(service)
+
+		delay = simulator.delay(service)
+		if (delay > 0):
+			time.sleep(delay)
+		fault = simulator.fault()
+		if (fault == "timeout"):
+			#never answer; the client has to give up on its own
+			time.sleep(simulator.hang)
+			self.close_connection = True
+			return
+		if (fault == "error"):
+			self._send(500, {"status": "500", "reason": "Internal server error."})
+			return
+
+		if (service not in SERVICES):
+			self._send(404, {"status": "404", "reason": "Service not found."})
+			return
+		try:
+			params = json.loads(body.decode('utf-8'))
+			id = int(params["id"])
+		except (ValueError, KeyError, TypeError):
+			self._send(200, {"status": "400", "reason": "Invalid request."})
+			return
+		vehicle = simulator.vehicle(id)
+		if (vehicle is None):
+			self._send(200, {"status": "404", "reason": "Vehicle id: %d not found." % id})
+			return
+		self._send(200, SERVICES[service](vehicle))
+
+	def _send(self, code, payload):
+		body = json.dumps(payload).encode('utf-8')
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		#keep benchmark and test output quiet
+		pass
+
+class _Server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 1024
+
+class GMSimulator(object):
+	"""
+	A local GM API stub running on a background thread. Its settings can be changed
+	while it runs, e.g. to make it start failing in the middle of a test
+	"""
+
+	def __init__(self, host='127.0.0.1', port=0, latency=0, fleet_size=0, seed=0,
+			error_rate=0.0, timeout_rate=0.0, hang=30.0, service_latency=None):
+		"""
+		:param host: Interface to listen on
+		:param port: Port to listen on, 0 picks a free port
+		:param latency: Delay before answering each request, in any form parse_latency accepts
+		:param fleet_size: Number of generated vehicles served on top of VEHICLES, with
+		IDs starting at FLEET_FIRST_ID
+		:param seed: Seed of the generated fleet
+		:param error_rate: Fraction of requests answered with an HTTP 500
+		:param timeout_rate: Fraction of requests that are never answered
+		:param hang: Seconds a request that is never answered holds its connection
+		:param service_latency: Dictionary of service name -> latency, overriding
+		`latency` for those services
+		"""
+		self.latency = latency
+		self.service_latency = dict(service_latency or {})
+		self.fleet_size = fleet_size
+		self.seed = seed
+		self.error_rate = error_rate
+		self.timeout_rate = timeout_rate
+		self.hang = hang
+		self.server = _Server((host, port), _Handler)
+		self.server.simulator = self
+		self.host, self.port = self.server.server_address[:2]
+		self.lock = threading.Lock()
+		self.hits = {}
+		self.thread = None
+
+	@property
+	def url(self):
+		return 'http://%s:%d' % (self.host, self.port)
+
+	def vehicle(self, id):
+		"""
+		:rtype: vehicle: Static details of a vehicle, or None if it does not exist
+		"""
+		if (id in VEHICLES):
+			return VEHICLES[id]
+		if (FLEET_FIRST_ID <= id < FLEET_FIRST_ID + self.fleet_size):
+			return generate_vehicle(id, self.seed)
+		return None
+
+	def fleet_ids(self):
+		"""
+		:rtype: ids: Every vehicle ID this simulator knows about
+		"""
+		return sorted(VEHICLES) + list(range(FLEET_FIRST_ID, FLEET_FIRST_ID + self.fleet_size))
+
+	def delay(self, service):
+		"""
+		:rtype: delay: Seconds to wait before answering a request to a service
+		"""
+		latency = self.service_latency.get(service, self.latency)
+		if (isinstance(latency, (int, float))):
+			return latency
+		return parse_latency(latency)()
+
+	def fault(self):
+		"""
+		:rtype: fault: "timeout", "error" or None for a request that should be answered
+		"""
+		if (self.timeout_rate and random.random() < self.timeout_rate):
+			return "timeout"
+		if (self.error_rate and random.random() < self.error_rate):
+			return "error"
+		return None
+
+	def record(self, service):
+		with self.lock:
+			self.hits[service] = self.hits.get(service, 0) + 1
+
+	def hit_count(self, service=None):
+		"""
+		Number of requests received, for one service or in total
+		"""
+		with self.lock:
+			if (service is None):
+				return sum(self.hits.values())
+			return self.hits.get(service, 0)
+
+	def reset(self):
+		with self.lock:
+			self.hits = {}
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Local GM API simulator")
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8000)
+	parser.add_argument('--fleet-size', type=int, default=0,
+		help="number of generated vehicles, with ids from %d upwards" % FLEET_FIRST_ID)
+	parser.add_argument('--seed', type=int, default=0, help="seed of the generated fleet")
+	parser.add_argument('--latency', default='0',
+		help="seconds, or fixed:S, uniform:LOW,HIGH, exponential:MEAN, normal:MEAN,SD or lognormal:MEDIAN,SIGMA")
+	parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with a 500")
+	parser.add_argument('--timeout-rate', type=float, default=0.0, help="fraction of requests never answered")
+	parser.add_argument('--hang', type=float, default=30.0, help="seconds an unanswered request is held")
+	args = parser.parse_args()
+
+	try:
+		parse_latency(args.latency)
+	except ValueError as err:
+		parser.error(str(err))
+	simulator = GMSimulator(host=args.host, port=args.port, latency=args.latency, fleet_size=args.fleet_size,
+		seed=args.seed, error_rate=args.error_rate, timeout_rate=args.timeout_rate, hang=args.hang)
+	print("GM API simulator listening on " + simulator.url)
+	simulator.server.serve_forever()
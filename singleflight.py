@@ -0,0 +1,78 @@
+import threading
+
+"""
+This contains a small "single-flight" helper. When several threads ask for the same
+key at the same time, only the first one (the leader) runs the expensive call and
+the rest wait for it and share its result, so the GM API only sees one request.
+"""
+
+class _Call(object):
+	"""
+	An in-flight call that other callers can wait on
+	"""
+	__slots__ = ('event', 'result', 'error', 'waiters')
+
+	def __init__(self):
+		self.event = threading.Event()
+		self.result = None
+		self.error = None
+		self.waiters = 0
+
+class Group(object):
+	"""
+	Coalesces concurrent calls that share a key into a single call
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.calls = {}
+		self.leaders = 0
+		self.shared = 0
+
+	def do(self, key, func):
+		"""
+		Run func() unless a call for the same key is already in flight, in which case
+		wait for that call and return its result (or raise its exception)
+		:param key: Hashable identifier of the call, e.g. (service, id)
+		:param func: Function taking no arguments that performs the call
+		:rtype: result: The value returned by func()
+		"""
+		with self.lock:
+			call = self.calls.get(key)
+			if (call is None):
+				call = _Call()
+				self.calls[key] = call
+				self.leaders += 1
+				leader = True
+			else:
+				call.waiters += 1
+				self.shared += 1
+				leader = False
+
+		if (not leader):
+			call.event.wait()
+			if (call.error is not None):
+				raise call.error
+			return call.result
+
+		try:
+			call.result = func()
+		except Exception as err:
+			call.error = err
+			raise
+		finally:
+			with self.lock:
+				del self.calls[key]
+			call.event.set()
+		return call.result
+
+	def stats(self):
+		"""
+		:rtype: stats: Dictionary with the number of calls made and calls shared
+		"""
+		with self.lock:
+			return {
+				"calls": self.leaders,
+				"shared": self.shared,
+				"in_flight": len(self.calls)
+			}
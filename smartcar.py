@@ -1,11 +1,254 @@
 import requests
 import json
+import threading
+from multiprocessing.pool import ThreadPool
 import utility
+import errors
+import config
+import gmclient
+import cache
+import singleflight
+import decoder
+import metrics
+import circuit
+import ratelimit
+import prefetch
+import vehiclestate
+import vehiclestore
 """
 This contains the functions that parse input from client requests, obtain relevant 
 data from the GM API and return the required data in a clean format to the client
 """
 
+#Shared GM API client; every service call below reuses its pooled connections. It talks to
+#config.GM_API_URL, which can point at a local simulator instead of the real GM API
+client = gmclient.GMClient()
+
+#Time to live (in seconds) of cached results for each read-only endpoint. Vehicle
+#info practically never changes while door and energy status change all the time
+CACHE_TTLS = {
+	"vehicle_info": 3600,
+	"door_status": 5,
+	"energy": 10
+}
+
+#How long (in seconds) past its TTL a cached result may still be served when the GM API
+#service it comes from is failing or its circuit breaker is open
+STALE_IF_ERROR = {
+	"vehicle_info": 86400,
+	"door_status": 60,
+	"energy": 300
+}
+
+#How long (in seconds) past its TTL a cached result is still served straight away while a
+#fresh one is fetched in the background (stale-while-revalidate). Door and energy status
+#can be a few seconds old without the UI minding; vehicle info has a long TTL already
+STALE_WHILE_REVALIDATE = {
+	"vehicle_info": config.SWR_VEHICLE_INFO,
+	"door_status": config.SWR_DOOR_STATUS,
+	"energy": config.SWR_ENERGY
+}
+
+#Shared cache of parsed results, kept as the compact records of vehiclestate.py unless
+#COMPACT_CACHE is turned off; callers must treat returned values as read-only
+response_cache = cache.ResponseCache(CACHE_TTLS, stale_ttls=STALE_IF_ERROR,
+	revalidate_ttls=STALE_WHILE_REVALIDATE, codec=vehiclestate if (config.COMPACT_CACHE) else None)
+
+#Vehicle IDs the GM API recently said it does not know. Lookups of them are answered with a
+#404 straight away until NEGATIVE_CACHE_TTL runs out or they are forgotten with forget_unknown
+unknown_vehicles = cache.NegativeCache(ttl=config.NEGATIVE_CACHE_TTL, max_entries=config.NEGATIVE_CACHE_SIZE)
+
+#Persistent copy of vehicle info shared by every worker process and kept across restarts,
+#or None when VEHICLE_STORE is not set
+vehicle_store = vehiclestore.VehicleStore(config.VEHICLE_STORE) if (config.VEHICLE_STORE) else None
+
+#One circuit breaker per GM API service, which also sets each service's read timeout
+breakers = circuit.Breakers(failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+	reset_timeout=config.CIRCUIT_RESET_TIMEOUT, min_timeout=config.GM_MIN_READ_TIMEOUT,
+	max_timeout=config.GM_READ_TIMEOUT, timeout_multiplier=config.GM_TIMEOUT_MULTIPLIER)
+
+#Rate limit and in-flight limit of each GM API service, shared by every route, the batch
+#functions and the background refreshes
+governors = ratelimit.Governors(rate=config.GM_RATE_LIMIT, burst=config.GM_RATE_BURST,
+	max_in_flight=config.GM_MAX_IN_FLIGHT, queue_timeout=config.GM_QUEUE_TIMEOUT)
+
+def split_upstream_limits(processes):
+	"""
+	Give this process its share of the GM API limits when it is one of `processes`
+	processes calling the GM API (the workers of serve.py and its manager process), each
+	with its own governors, so that together they stay within GM_RATE_LIMIT,
+	GM_RATE_BURST and GM_MAX_IN_FLIGHT
+	:param processes: Number of processes sharing the limits
+	"""
+	global governors
+	#0 means no limit, which stays 0; any other limit leaves each worker at least one call
+	rate = config.GM_RATE_LIMIT / float(processes)
+	burst = max(config.GM_RATE_BURST / float(processes), 1)
+	max_in_flight = max(config.GM_MAX_IN_FLIGHT // processes, 1) if (config.GM_MAX_IN_FLIGHT > 0) else 0
+	governors = ratelimit.Governors(rate=rate, burst=burst, max_in_flight=max_in_flight,
+		queue_timeout=config.GM_QUEUE_TIMEOUT)
+
+#Error message of a GM API response that is not JSON, encoded once
+NOT_JSON = errors.preallocate("The GM API sent a response that is not JSON")
+
+#Errors raised when a GM API service could not give us an answer
+UPSTREAM_ERRORS = (requests.exceptions.RequestException, circuit.CircuitOpenError, ratelimit.ThrottledError)
+
+#Age of the result most recently returned on each thread (see result_age)
+_served = threading.local()
+
+#Background refreshes of stale results: the flight keys being refreshed, and the threads doing it
+_refreshing = set()
+_refresh_lock = threading.Lock()
+_refresh_pool = None
+
+#Coalesces concurrent identical GM API calls so that only one of them goes upstream
+flights = singleflight.Group()
+
+def cache_stats():
+	"""
+	Hit/miss/eviction counters of the response cache, along with how many GM API
+	calls were shared between concurrent callers
+	:rtype: stats: JSON object of cache counters
+	"""
+	stats = response_cache.stats()
+	stats['single_flight'] = flights.stats()
+	stats['circuit_breakers'] = breakers.stats()
+	stats['governors'] = governors.stats()
+	stats['unknown_vehicles'] = unknown_vehicles.stats()
+	if (vehicle_store is not None):
+		stats['vehicle_store'] = vehicle_store.stats()
+	return stats
+
+def _cache_metrics():
+	"""
+	The cache_stats counters in the form metrics.Registry.collect expects
+	"""
+	stats = cache_stats()
+	flight = stats['single_flight']
+	unknown = stats['unknown_vehicles']
+	ret = [
+		("smartcar_cache_hits_total", "counter", "Response cache hits.", stats['hits']),
+		("smartcar_cache_misses_total", "counter", "Response cache misses.", stats['misses']),
+		("smartcar_cache_evictions_total", "counter", "Response cache evictions.", stats['evictions']),
+		("smartcar_cache_expirations_total", "counter", "Expired response cache entries.", stats['expirations']),
+		("smartcar_cache_entries", "gauge", "Entries in the response cache.", stats['entries']),
+		("smartcar_cache_bytes", "gauge", "Approximate size of the response cache.", stats['bytes']),
+		("smartcar_single_flight_calls_total", "counter", "GM API calls made for coalesced lookups.", flight['calls']),
+		("smartcar_single_flight_shared_total", "counter", "Lookups that shared another caller's GM API call.", flight['shared']),
+		("smartcar_cache_stale_hits_total", "counter", "Stale results served while the GM API was failing.", stats['stale_hits']),
+		("smartcar_cache_revalidations_total", "counter", "Stale results served while being refreshed.", stats['revalidations']),
+		("smartcar_circuit_open", "gauge", "Whether the circuit breaker of a GM API service is open (1) or not (0).",
+			[({"service": service}, int(breaker['state'] == circuit.OPEN))
+				for service, breaker in sorted(stats['circuit_breakers'].items())]),
+		("smartcar_upstream_timeout_seconds", "gauge", "Current adaptive read timeout of a GM API service.",
+			[({"service": service}, breaker['timeout']) for service, breaker in sorted(stats['circuit_breakers'].items())]),
+		("smartcar_upstream_in_flight", "gauge", "GM API calls in progress, by service.",
+			[({"service": service}, governor['in_flight']) for service, governor in sorted(stats['governors'].items())]),
+		("smartcar_upstream_queued", "gauge", "GM API calls waiting to be admitted, by service.",
+			[({"service": service}, governor['queued']) for service, governor in sorted(stats['governors'].items())]),
+		("smartcar_negative_cache_hits_total", "counter", "Lookups of unknown vehicles answered without a GM API call.", unknown['hits']),
+		("smartcar_negative_cache_additions_total", "counter", "Vehicles the GM API did not know.", unknown['additions']),
+		("smartcar_negative_cache_removals_total", "counter", "Unknown vehicles forgotten, by reason.",
+			[({"reason": reason}, unknown[reason]) for reason in ("evictions", "expirations", "invalidations")]),
+		("smartcar_negative_cache_entries", "gauge", "Unknown vehicles remembered.", unknown['entries'])
+	]
+	if (vehicle_store is not None):
+		ret.append(("smartcar_vehicle_store_lookups_total", "counter", "Vehicle store lookups by result.",
+			[({"result": result}, stats['vehicle_store'][result]) for result in ("hits", "misses", "errors")]))
+		ret.append(("smartcar_vehicle_store_writes_total", "counter", "Vehicles written to the vehicle store.",
+			stats['vehicle_store']['writes']))
+	return ret
+
+metrics.registry.collect(_cache_metrics)
+
+def result_age():
+	"""
+	How old the result that the last get_vehicle_info, get_door_status, get_energy,
+	get_fuel_range or get_battery_range call on this thread returned is
+	:rtype: age: Seconds since the result was fetched from the GM API (0 if it just was)
+	"""
+	return getattr(_served, 'age', 0)
+
+def refresh(endpoint, id):
+	"""
+	Fetch a fresh result for a cached endpoint from the GM API and cache it, sharing the
+	call with any concurrent lookup of the same vehicle
+	:param endpoint: "vehicle_info", "door_status" or "energy"
+	:param id: Vehicle ID
+	:rtype: ret_data: The fresh result
+	"""
+	service, fetch = _FETCHERS[endpoint]
+	params = _validate({"id": id, "responseType": "JSON"})
+	_check_known(id)
+	return flights.do((service, id), lambda: fetch(params))[0]
+
+def _revalidate(key, fetch):
+	"""
+	Refresh a stale cached result in the background, at most once at a time per key
+	:param key: Single-flight key of the GM API call, e.g. ('getEnergyService', 1234)
+	:param fetch: Function fetching and caching a fresh result
+	"""
+	global _refresh_pool
+	with _refresh_lock:
+		if (key in _refreshing):
+			return
+		_refreshing.add(key)
+		if (_refresh_pool is None):
+			_refresh_pool = ThreadPool(config.REFRESH_THREADS)
+
+	def refresh():
+		try:
+			flights.do(key, fetch)
+		finally:
+			with _refresh_lock:
+				_refreshing.discard(key)
+
+	_refresh_pool.apply_async(refresh)
+
+def _validate(params):
+	"""
+	utility.check_valid_input, timed as the "validate" phase
+	"""
+	start = metrics.now()
+	try:
+		return utility.check_valid_input(params)
+	finally:
+		metrics.phase_seconds.observe(("validate",), metrics.now() - start)
+
+def _check_known(id):
+	"""
+	Fail fast with errors.VehicleNotFound, without a GM API call, for a vehicle the GM API
+	recently did not know
+	"""
+	if (unknown_vehicles.contains(id)):
+		raise errors.VehicleNotFound()
+
+def forget_unknown(ids=None):
+	"""
+	Forget vehicles the GM API did not know, e.g. because they have just been provisioned,
+	so that their next lookup asks the GM API again
+	:param ids: List of vehicle IDs, or None for every vehicle
+	:rtype: count: Number of vehicles forgotten
+	"""
+	if (ids is None):
+		return unknown_vehicles.clear()
+	return unknown_vehicles.discard(ids)
+
+def _shape(parse, r, id):
+	"""
+	Build the result returned to clients from a decoded GM API response, timed as the "shape" phase.
+	A response for a vehicle the GM API does not know is remembered in unknown_vehicles
+	"""
+	start = metrics.now()
+	try:
+		return parse(r)
+	except errors.VehicleNotFound:
+		unknown_vehicles.add(id)
+		raise
+	finally:
+		metrics.phase_seconds.observe(("shape",), metrics.now() - start)
+
 def get_vehicle_info(id):
 	"""
 	Get vehicle information based on ID
@@ -13,71 +256,75 @@ def get_vehicle_info(id):
 	:rtype: ret_data: JSON object containing relevant vehicle details if found
 	"""
 
-	headers = {
-	    'Content-Type': 'application/json'
-	}
-
 	params = {
 		"id": id,
 		"responseType": "JSON"
 	}
 
 	#check for valid input
-	params = utility.check_valid_input(params)
+	params = _validate(params)
+
+	prefetcher.record("vehicle_info", id)
+	cached = response_cache.lookup("vehicle_info", id)
+	if (cached is not None):
+		ret_data, _served.age, stale = cached
+		if (stale):
+			_revalidate(('getVehicleInfoService', id), lambda: _fetch_vehicle_info(params))
+		return ret_data
+
+	_check_known(id)
+	ret_data, _served.age = flights.do(('getVehicleInfoService', id), lambda: _load_vehicle_info(params))
+	return ret_data
+
+def _load_vehicle_info(params):
+	"""
+	Get vehicle info missing from the response cache from the vehicle store if it holds
+	a recent enough copy, and from the GM vehicle info service otherwise
+	:param params: Validated request parameters
+	:rtype: (ret_data, age): As _fetch_vehicle_info
+	"""
+	if (vehicle_store is not None):
+		stored = vehicle_store.get(params['id'])
+		if (stored is not None and stored[1] < config.VEHICLE_STORE_TTL):
+			response_cache.set("vehicle_info", params['id'], stored[0])
+			return stored
+	return _fetch_vehicle_info(params)
+
+def _fetch_vehicle_info(params):
+	"""
+	Performs the POST request to the GM vehicle info service and parses the response
+	:param params: Validated request parameters
+	:rtype: (ret_data, age): JSON object containing relevant vehicle details if found,
+	and its age in seconds (0 unless an older result was served because the GM API is failing)
+	"""
 
 	#perform POST request to GM API to obtain relevant data
-	r = requests.post('http://gmapi.azurewebsites.net/getVehicleInfoService', headers=headers, json=params)
-
-	ret_data = None
-	# proceed with constructing the return object only if we have recieved data correctly
-	if (r.status_code == requests.codes.ok and r.raise_for_status() is None):
-		r  = r.json()
-
-		#Validate that a car with specified id exists
-		if ('data' in r):
-			data = r['data']
-		else:
-			#this will trigger a 404 status code to be returned
-			raise ValueError("404")
-
-		#Grab relevant data if present
-
-		if ('vin' in data):
-			vin = data['vin']['value']
-		else:
-			raise ValueError("No VIN present for this vehicle")
-
-		if ('color' in data):
-			color = data['color']['value']
-		else:
-			raise ValueError("No Color specified for this vehicle")
-
-		door_count = 0
-		if ('fourDoorSedan' in data and 'twoDoorCoupe' in data):
-			if (data['fourDoorSedan']['value'] == 'True'):
-				door_count = 4
-			if (data['twoDoorCoupe']['value'] == 'True'):
-				door_count = 2
-		else:
-			raise ValueError("No door count specified for this vehicle")
-
-		if ('driveTrain' in data):
-			drive_train = data['driveTrain']['value']
-		else:
-			raise ValueError("No drive train specified for this vehicle")
-
-		#return the data we have in a JSON
-		ret_data = {
-			"vin" : vin,
-			"color" : color,
-			"doorCount" : door_count,
-			"driveTrain" : drive_train
-		}
-	else:
-		#Raise an exception for any 4XX or 5XX status code being returned from GM API
-		r.raise_for_status()
+	try:
+		r = _post('getVehicleInfoService', params)
+	except UPSTREAM_ERRORS:
+		#answer with an older result if there is one, rather than an error
+		stale = response_cache.get_stale("vehicle_info", params['id'])
+		if (stale is None and vehicle_store is not None):
+			#however old, the stored copy beats an error; vehicle info hardly ever changes
+			stale = vehicle_store.get(params['id'])
+		if (stale is None):
+			raise
+		return stale
+	ret_data = _shape(parse_vehicle_info, r, params['id'])
+	response_cache.set("vehicle_info", params['id'], ret_data)
+	if (vehicle_store is not None):
+		vehicle_store.put(params['id'], ret_data)
+	return ret_data, 0
+
+def parse_vehicle_info(r):
+	"""
+	Builds the vehicle info returned to clients from a GM vehicle info response
+	:param r: Decoded JSON response of the GM vehicle info service
+	:rtype: ret_data: JSON object containing relevant vehicle details if found
+	"""
+
+	return decoder.VEHICLE_INFO(r)
 
-	return ret_data
 
 def get_door_status(id):
 	"""
@@ -86,58 +333,63 @@ def get_door_status(id):
 	:rtype: ret_data: JSON object containing relevant vehicle details if found
 	"""
 
-	headers = {
-	    'Content-Type': 'application/json'
-	}
-
 	params = {
 		"id": id,
 		"responseType": "JSON"
 	}
 
 	#check for a valid input
-	params = utility.check_valid_input(params)
-
-	r = requests.post('http://gmapi.azurewebsites.net/getSecurityStatusService', headers=headers, json=params)
-
-	ret_data = None
-	# we have what we need and check for 4XX or 5XX status codes
-	if (r.status_code == requests.codes.ok):
-		r  = r.json()
-		if ('data' in r):
-			data = r['data']
-		else:
-			raise ValueError("404")
-
-		ret_data = []
-		if ('doors' in data):
-			if ('values' in data['doors']):
-				values = data['doors']['values']
-				for value in values:
-					if (value['locked']['value'] == "True"):
-						locked = True
-					if (value['locked']['value'] == "False"):
-						locked = False
-					ret_value = {
-						"location" : value['location']['value'],
-						"locked": locked
-					}
-					ret_data.append(ret_value)
-		else:
-			raise ValueError("There are no doors for this vehicle")
-
+	params = _validate(params)
+
+	prefetcher.record("door_status", id)
+	cached = response_cache.lookup("door_status", id)
+	if (cached is not None):
+		ret_data, _served.age, stale = cached
+		if (stale):
+			_revalidate(('getSecurityStatusService', id), lambda: _fetch_door_status(params))
+		return ret_data
+
+	_check_known(id)
+	ret_data, _served.age = flights.do(('getSecurityStatusService', id), lambda: _fetch_door_status(params))
 	return ret_data
 
-def get_fuel_range(id):
+def _fetch_door_status(params):
 	"""
-	Gets fuel range of a vehicle given its ID if applicable (if vehicle is fuel powered)
-	:param id: A unqiue idenitifer to locate a car
+	Performs the POST request to the GM security service and parses the door statuses
+	:param params: Validated request parameters
+	:rtype: (ret_data, age): JSON object containing relevant vehicle details if found,
+	and its age in seconds (0 unless an older result was served because the GM API is failing)
+	"""
+
+	try:
+		r = _post('getSecurityStatusService', params)
+	except UPSTREAM_ERRORS:
+		#answer with an older result if there is one, rather than an error
+		stale = response_cache.get_stale("door_status", params['id'])
+		if (stale is None):
+			raise
+		return stale
+	ret_data = _shape(parse_door_status, r, params['id'])
+	response_cache.set("door_status", params['id'], ret_data)
+	return ret_data, 0
+
+def parse_door_status(r):
+	"""
+	Builds the list of door statuses returned to clients from a GM security response
+	:param r: Decoded JSON response of the GM security service
 	:rtype: ret_data: JSON object containing relevant vehicle details if found
 	"""
 
-	headers = {
-	    'Content-Type': 'application/json'
-	}
+	return decoder.DOOR_STATUS(r)
+
+
+def get_energy(id):
+	"""
+	Gets both the fuel and battery range of a vehicle given its ID. Both come from a single
+	call to the GM energy service, and concurrent calls for the same ID share that call
+	:param id: A unqiue idenitifer to locate a car
+	:rtype: ret_data: JSON object with a "fuel" and a "battery" range, each null if not applicable
+	"""
 
 	params = {
 		"id": id,
@@ -145,70 +397,116 @@ def get_fuel_range(id):
 	}
 
 	#check for a valid input
-	params = utility.check_valid_input(params)
-
-	r = requests.post('http://gmapi.azurewebsites.net/getEnergyService', headers=headers, json=params)
+	params = _validate(params)
+
+	prefetcher.record("energy", id)
+	cached = response_cache.lookup("energy", id)
+	if (cached is not None):
+		ret_data, _served.age, stale = cached
+		if (stale):
+			_revalidate(('getEnergyService', id), lambda: _fetch_energy(params))
+		return ret_data
+
+	_check_known(id)
+	ret_data, _served.age = flights.do(('getEnergyService', id), lambda: _fetch_energy(params))
+	return ret_data
 
-	ret_data = None
-	# we have what we need and check for 4XX or 5XX status codes
-	if (r.status_code == requests.codes.ok):
-		r  = r.json()
-		if ('data' in r):
-			data = r['data']
-		else:
-			raise ValueError("404")
+def _fetch_energy(params):
+	"""
+	Performs the POST request to the GM energy service and parses both energy levels
+	:param params: Validated request parameters
+	:rtype: (ret_data, age): JSON object with a "fuel" and a "battery" range, each null if not applicable,
+	and its age in seconds (0 unless an older result was served because the GM API is failing)
+	"""
 
-		ret_data = {}
+	try:
+		r = _post('getEnergyService', params)
+	except UPSTREAM_ERRORS:
+		#answer with an older result if there is one, rather than an error
+		stale = response_cache.get_stale("energy", params['id'])
+		if (stale is None):
+			raise
+		return stale
+	ret_data = _shape(parse_energy, r, params['id'])
+	response_cache.set("energy", params['id'], ret_data)
+	return ret_data, 0
+
+def parse_energy(r):
+	"""
+	Builds the fuel and battery ranges returned to clients from a GM energy response
+	:param r: Decoded JSON response of the GM energy service
+	:rtype: ret_data: JSON object with a "fuel" and a "battery" range, each null if not applicable
+	"""
 
-		if (data['tankLevel']['value'] != 'null'):
-			ret_data['percent'] = float(data['tankLevel']['value'])
-		else:
-			raise ValueError("404")
-	else:
-		r.raise_for_status()
+	return decoder.ENERGY(r)
 
-	return ret_data
 
-def get_battery_range(id):
+def get_fuel_range(id):
 	"""
-	Gets battery range of a vehicle given its ID if applicable (if vehicle is electric)
+	Gets fuel range of a vehicle given its ID if applicable (if vehicle is fuel powered)
 	:param id: A unqiue idenitifer to locate a car
 	:rtype: ret_data: JSON object containing relevant vehicle details if found
 	"""
 
-	headers = {
-	    'Content-Type': 'application/json'
-	}
-
-	params = {
-		"id": id,
-		"responseType": "JSON"
-	}
-
-	#check for a valid input
-	params = utility.check_valid_input(params)
+	return fuel_range(get_energy(id))
 
-	r = requests.post('http://gmapi.azurewebsites.net/getEnergyService', headers=headers, json=params)
+def fuel_range(energy):
+	"""
+	Picks the fuel range out of the result of get_energy
+	"""
+	if (energy['fuel'] is None):
+		raise errors.VehicleNotFound()
+	return energy['fuel']
 
-	ret_data = None
-	# we have what we need and check for 4XX or 5XX status codes
-	if (r.status_code == requests.codes.ok):
-		r  = r.json()
-		if ('data' in r):
-			data = r['data']
-		else:
-			raise ValueError("404")
+def get_battery_range(id):
+	"""
+	Gets battery range of a vehicle given its ID if applicable (if vehicle is electric)
+	:param id: A unqiue idenitifer to locate a car
+	:rtype: ret_data: JSON object containing relevant vehicle details if found
+	"""
 
-		ret_data = {}
+	return battery_range(get_energy(id))
 
-		if (data['batteryLevel']['value'] != 'null'):
-			ret_data['percent'] = float(data['batteryLevel']['value'])
-		else:
-			raise ValueError("404")
-	else:
-		r.raise_for_status()
+def battery_range(energy):
+	"""
+	Picks the battery range out of the result of get_energy
+	"""
+	if (energy['battery'] is None):
+		raise errors.VehicleNotFound()
+	return energy['battery']
+
+#GM service and fetch function behind each cached endpoint
+_FETCHERS = {
+	"vehicle_info": ('getVehicleInfoService', _fetch_vehicle_info),
+	"door_status": ('getSecurityStatusService', _fetch_door_status),
+	"energy": ('getEnergyService', _fetch_energy)
+}
+
+#Keeps the cached results of the most requested vehicles fresh. It only counts lookups
+#until start_prefetching() is called
+prefetcher = prefetch.Prefetcher(refresh, response_cache.expires_in, budget=config.PREFETCH_BUDGET,
+	interval=config.PREFETCH_INTERVAL, top=config.PREFETCH_TOP)
+
+def use_shared_state(cache, group, unknown):
+	"""
+	Make this process use a response cache, single-flight group and negative cache shared
+	with other processes (see sharedcache.py) instead of its own
+	:param cache: Object with the methods of cache.ResponseCache
+	:param group: Object with the methods of singleflight.Group
+	:param unknown: Object with the methods of cache.NegativeCache
+	"""
+	global response_cache, flights, unknown_vehicles
+	response_cache = cache
+	flights = group
+	unknown_vehicles = unknown
+	prefetcher.expires_in = cache.expires_in
 
-	return ret_data
+def start_prefetching():
+	"""
+	Start refreshing hot vehicles in the background, unless disabled with PREFETCH_ENABLED
+	"""
+	if (config.PREFETCH_ENABLED):
+		prefetcher.start()
 
 """
 Allows user to start/stop a car
@@ -221,10 +519,6 @@ def control_engine(id, action):
 	:rtype: ret_data: JSON object containing relevant vehicle details if found
 	"""
 
-	headers = {
-	    'Content-Type': 'application/json'
-	}
-
 	params = {
 		"id": id,
 		"command" : action,
@@ -232,25 +526,81 @@ def control_engine(id, action):
 	}
 
 	#check for a valid input
-	params = utility.check_valid_input(params)
-
-	r = requests.post('http://gmapi.azurewebsites.net/actionEngineService', headers=headers, json=params)
-
-	ret_data = None
-	# we have what we need and check for 4XX or 5XX status codes
-	if (r.status_code == requests.codes.ok):
-		data  = r.json()
-
-		ret_data = {}
-		if ('actionResult' in data):
-			if (data['actionResult']['status'] == "EXECUTED"):
-				ret_data['status'] = 'success'
-			if (data['actionResult']['status'] == "FAILED"):
-				ret_data['status'] = 'error'
-		else:
-			raise ValueError("404")
-	
+	params = _validate(params)
+
+	_check_known(id)
+	r = _post('actionEngineService', params)
+
+	#starting or stopping the engine changes the vehicle's state, so drop what we have cached
+	response_cache.invalidate(id)
+
+	return _shape(parse_engine_action, r, id)
+
+def parse_engine_action(data):
+	"""
+	Builds the result of an engine command returned to clients from a GM engine response
+	:param data: Decoded JSON response of the GM engine service
+	:rtype: ret_data: JSON object with the status (success|error) of the command
+	"""
+
+	return decoder.ENGINE_ACTION(data)
+
+
+def _post(service, params):
+	"""
+	Performs a POST request to a GM API service and decodes its JSON response. The call
+	goes through the service's circuit breaker, waits to be admitted by its governor and
+	uses its adaptive read timeout
+	:param service: Name of the GM service, e.g. getVehicleInfoService
+	:param params: Validated request parameters
+	:rtype: r: Decoded JSON response
+	"""
+
+	#an open breaker fails fast, without taking one of the governor's slots or tokens
+	breaker = breakers.get(service)
+	try:
+		breaker.allow()
+	except circuit.CircuitOpenError:
+		metrics.upstream_responses.inc((service, "circuit_open"))
+		raise
+
+	governor = governors.get(service)
+	try:
+		governor.acquire()
+	except ratelimit.ThrottledError:
+		breaker.cancel()
+		metrics.upstream_responses.inc((service, "throttled"))
+		raise
+
+	try:
+		start = metrics.now()
+		try:
+			r = client.post(service, params, read_timeout=breaker.timeout)
+		except requests.exceptions.RequestException:
+			metrics.upstream_seconds.observe((service,), metrics.now() - start)
+			metrics.upstream_responses.inc((service, "error"))
+			breaker.failure()
+			raise
+	finally:
+		governor.release()
+	elapsed = metrics.now() - start
+	metrics.upstream_seconds.observe((service,), elapsed)
+	#label values are text, like the "error", "circuit_open" and "throttled" statuses above
+	metrics.upstream_responses.inc((service, str(r.status_code)))
+	#only server side errors count against the service; a 4XX is our problem, not theirs
+	if (r.status_code >= 500):
+		breaker.failure()
 	else:
+		breaker.success(elapsed)
+	#Raise an exception for any 4XX or 5XX status code being returned from GM API
+	if (r.status_code != requests.codes.ok):
 		r.raise_for_status()
 
-	return ret_data
+	start = metrics.now()
+	try:
+		return r.json()
+	except ValueError:
+		#e.g. an HTML error page from something between us and the GM API
+		raise errors.BadUpstreamResponse(NOT_JSON)
+	finally:
+		metrics.phase_seconds.observe(("json_decode",), metrics.now() - start)
@@ -1,7 +1,46 @@
 import unittest
+import json
+import threading
+import time
+import logging
 import requests
 import smartcar
+import cache
+import gmclient
+import singleflight
+import batch
+import ratelimit
+import encoder
+import decoder
+import metrics
+import circuit
+import prefetch
+import vehiclestate
+import vehiclestore
+import os
+import shutil
+import tempfile
+import sharedcache
+import serve
+import changefeed
+import query
+import utility
+import errors
+import config
+import gzip
+import io
+import simulator
+from simulator import GMSimulator
+try:
+	import asyncio
+	import async_smartcar
+	import async_app
+	from aiohttp import web
+except (ImportError, SyntaxError):
+	#the asyncio variant needs Python 3 and aiohttp
+	async_smartcar = None
 from flask import abort
+from werkzeug.serving import make_server
 
 """
 This file extensively tests the various functions written in this project.
@@ -238,6 +277,1719 @@ class TestControlEngine(unittest.TestCase):
 		self.assertEqual(type(ret_obj), dict)
 		self.assertEqual(type(ret_obj['status']), str)
 
+class TestResponseCache(unittest.TestCase):
+	"""
+	Testing the ResponseCache located in cache.py for expiry, eviction and invalidation
+	"""
+
+	def setUp(self):
+		self.now = 1000.0
+		self.cache = cache.ResponseCache({"vehicle_info": 60, "door_status": 5},
+			max_entries=3, clock=lambda: self.now)
+
+	def test_hit_and_expiry(self):
+		self.cache.set("vehicle_info", 1234, {"vin": "123"})
+		self.cache.set("door_status", 1234, [{"location": "frontLeft", "locked": True}])
+		self.assertEqual(self.cache.get("vehicle_info", 1234), {"vin": "123"})
+
+		#door status expires long before vehicle info does
+		self.now += 10
+		self.assertIsNone(self.cache.get("door_status", 1234))
+		self.assertEqual(self.cache.get("vehicle_info", 1234), {"vin": "123"})
+
+		stats = self.cache.stats()
+		self.assertEqual(stats['hits'], 2)
+		self.assertEqual(stats['misses'], 1)
+		self.assertEqual(stats['expirations'], 1)
+
+	def test_uncached_endpoint(self):
+		#endpoints without a TTL are never stored
+		self.cache.set("control_engine", 1234, {"status": "success"})
+		self.assertIsNone(self.cache.get("control_engine", 1234))
+
+	def test_lru_eviction(self):
+		self.cache.set("vehicle_info", 1, {"vin": "1"})
+		self.cache.set("vehicle_info", 2, {"vin": "2"})
+		self.cache.set("vehicle_info", 3, {"vin": "3"})
+		#touch 1 so that 2 becomes the least recently used entry
+		self.cache.get("vehicle_info", 1)
+		self.cache.set("vehicle_info", 4, {"vin": "4"})
+
+		self.assertIsNone(self.cache.get("vehicle_info", 2))
+		self.assertIsNotNone(self.cache.get("vehicle_info", 1))
+		self.assertEqual(self.cache.stats()['evictions'], 1)
+
+	def test_memory_bound(self):
+		small = cache.ResponseCache({"vehicle_info": 60}, max_bytes=100, clock=lambda: self.now)
+		for id in range(10):
+			small.set("vehicle_info", id, {"vin": "x" * 20})
+		self.assertLessEqual(small.stats()['bytes'], 100)
+		self.assertGreater(small.stats()['evictions'], 0)
+		self.assertIsNotNone(small.get("vehicle_info", 9))
+
+	def test_invalidate(self):
+		self.cache.set("vehicle_info", 1234, {"vin": "123"})
+		self.cache.set("door_status", 1234, [])
+		self.cache.set("vehicle_info", 1235, {"vin": "456"})
+		self.cache.invalidate(1234)
+
+		self.assertIsNone(self.cache.get("vehicle_info", 1234))
+		self.assertIsNone(self.cache.get("door_status", 1234))
+		self.assertEqual(self.cache.get("vehicle_info", 1235), {"vin": "456"})
+
+class TestSingleFlight(unittest.TestCase):
+	"""
+	Testing the single-flight Group located in singleflight.py
+	"""
+
+	def test_concurrent_calls_are_shared(self):
+		group = singleflight.Group()
+		release = threading.Event()
+		calls = []
+		results = []
+
+		def slow_call():
+			calls.append(1)
+			release.wait()
+			return {"percent": 50.0}
+
+		def caller():
+			results.append(group.do(('getEnergyService', 1234), slow_call))
+
+		threads = [threading.Thread(target=caller) for _ in range(10)]
+		for thread in threads:
+			thread.start()
+		#wait until every caller is either running or waiting on the call
+		while (group.stats()['shared'] < 9):
+			time.sleep(0.001)
+		release.set()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(results, [{"percent": 50.0}] * 10)
+		self.assertEqual(group.stats()['in_flight'], 0)
+
+	def test_errors_are_shared(self):
+		group = singleflight.Group()
+
+		def failing_call():
+			raise ValueError("404")
+
+		with self.assertRaises(ValueError):
+			group.do(1234, failing_call)
+		#a failed call is not remembered
+		self.assertEqual(group.do(1234, lambda: "ok"), "ok")
+
+class SimulatorTestCase(unittest.TestCase):
+	"""
+	Base class for tests that point smartcar.py at a local GM API simulator
+	instead of the live GM API
+	"""
+	latency = 0
+
+	@classmethod
+	def setUpClass(cls):
+		cls.simulator = GMSimulator(latency=cls.latency).start()
+		cls.live_client = smartcar.client
+		smartcar.client = gmclient.GMClient(base_url=cls.simulator.url)
+
+	@classmethod
+	def tearDownClass(cls):
+		smartcar.client.close()
+		smartcar.client = cls.live_client
+		cls.simulator.stop()
+
+	def setUp(self):
+		smartcar.response_cache.clear()
+		smartcar.unknown_vehicles.clear()
+		smartcar.breakers.reset()
+		self.simulator.reset()
+
+class TestEnergy(SimulatorTestCase):
+	"""
+	Testing that get_energy, get_fuel_range and get_battery_range share GM energy calls
+	"""
+	latency = 0.2
+
+	def test_energy_output(self):
+		ret_obj = smartcar.get_energy(1234)
+		self.assertEqual(type(ret_obj['fuel']['percent']), float)
+		self.assertIsNone(ret_obj['battery'])
+
+		ret_obj = smartcar.get_energy(1235)
+		self.assertIsNone(ret_obj['fuel'])
+		self.assertEqual(type(ret_obj['battery']['percent']), float)
+
+		with self.assertRaises(ValueError):
+			smartcar.get_energy(123)
+
+	def test_fuel_and_battery_share_one_call(self):
+		fuel = smartcar.get_fuel_range(1234)
+		with self.assertRaises(ValueError):
+			smartcar.get_battery_range(1234)
+		self.assertEqual(fuel, smartcar.get_energy(1234)['fuel'])
+		self.assertEqual(self.simulator.hit_count('getEnergyService'), 1)
+
+	def test_concurrent_calls_are_coalesced(self):
+		threads = [threading.Thread(target=smartcar.get_fuel_range, args=(1234,)) for _ in range(10)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(self.simulator.hit_count('getEnergyService'), 1)
+
+class TestSimulator(SimulatorTestCase):
+	"""
+	Testing the generated fleet and the latency and failure injection of the GM API simulator
+	"""
+
+	def tearDown(self):
+		self.simulator.fleet_size = 0
+		self.simulator.error_rate = 0.0
+		self.simulator.timeout_rate = 0.0
+		self.simulator.latency = 0
+		self.simulator.hang = 30.0
+
+	def test_generated_fleet(self):
+		self.simulator.fleet_size = 100
+		first = simulator.FLEET_FIRST_ID
+		self.assertEqual(len(self.simulator.fleet_ids()), 102)
+		self.assertEqual(simulator.generate_vehicle(first + 7), simulator.generate_vehicle(first + 7))
+		self.assertNotEqual(simulator.generate_vehicle(first + 7), simulator.generate_vehicle(first + 7, seed=1))
+
+		ret_obj = smartcar.get_vehicle_info(first + 99)
+		self.assertEqual(ret_obj["vin"], simulator.generate_vehicle(first + 99)["vin"])
+		self.assertIn(ret_obj["doorCount"], [2, 4])
+		self.assertEqual(len(smartcar.get_door_status(first)), smartcar.get_vehicle_info(first)["doorCount"])
+
+		#ids past the end of the fleet do not exist
+		with self.assertRaises(ValueError) as context:
+			smartcar.get_vehicle_info(first + 100)
+		self.assertEqual(str(context.exception), "404")
+
+	def test_parse_latency(self):
+		self.assertEqual(simulator.parse_latency(0.5)(), 0.5)
+		self.assertEqual(simulator.parse_latency("0.25")(), 0.25)
+		self.assertEqual(simulator.parse_latency("fixed:0.1")(), 0.1)
+		for _ in range(100):
+			self.assertTrue(0.1 <= simulator.parse_latency("uniform:0.1,0.2")() <= 0.2)
+			self.assertTrue(simulator.parse_latency("exponential:0.05")() >= 0)
+			self.assertTrue(simulator.parse_latency("normal:0.05,0.1")() >= 0)
+			self.assertTrue(simulator.parse_latency("lognormal:0.05,0.5")() > 0)
+		for spec in ("slow", "uniform:0.1", "exponential:0", "fixed:x"):
+			with self.assertRaises(ValueError):
+				simulator.parse_latency(spec)
+
+	def test_latency(self):
+		self.simulator.latency = "fixed:0.2"
+		start = time.time()
+		smartcar.get_energy(1234)
+		self.assertTrue(time.time() - start >= 0.2)
+
+	def test_errors(self):
+		self.simulator.error_rate = 1.0
+		with self.assertRaises(requests.exceptions.HTTPError):
+			smartcar.get_vehicle_info(1234)
+
+	def test_timeouts(self):
+		self.simulator.timeout_rate = 1.0
+		self.simulator.hang = 1.0
+		client = gmclient.GMClient(base_url=self.simulator.url, read_timeout=0.2)
+		try:
+			with self.assertRaises(requests.exceptions.Timeout):
+				client.post('getVehicleInfoService', {"id": "1234", "responseType": "JSON"})
+		finally:
+			client.close()
+
+class AppTestCase(SimulatorTestCase):
+	"""
+	Base class for tests that serve app.py on a local port, backed by the simulator
+	"""
+
+	@classmethod
+	def setUpClass(cls):
+		super(AppTestCase, cls).setUpClass()
+		import app
+		cls.server = make_server('127.0.0.1', 0, app.app, threaded=True)
+		cls.url = 'http://127.0.0.1:%d' % cls.server.server_port
+		cls.server_thread = threading.Thread(target=cls.server.serve_forever)
+		cls.server_thread.daemon = True
+		cls.server_thread.start()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		super(AppTestCase, cls).tearDownClass()
+
+	def fire(self, path, count):
+		"""
+		Send `count` identical GET requests to the app at the same time
+		:rtype: responses: List of the responses received
+		"""
+		start = threading.Event()
+		responses = []
+
+		def worker():
+			start.wait()
+			responses.append(requests.get(self.url + path))
+
+		threads = [threading.Thread(target=worker) for _ in range(count)]
+		for thread in threads:
+			thread.start()
+		start.set()
+		for thread in threads:
+			thread.join()
+		return responses
+
+class TestCoalescingLoad(AppTestCase):
+	"""
+	Load test firing many concurrent identical requests at the app and checking that
+	the GM API only receives one of them
+	"""
+	latency = 0.5
+
+	def test_vehicle_info(self):
+		responses = self.fire('/vehicles/1234', 20)
+		self.assertEqual([r.status_code for r in responses], [200] * 20)
+		self.assertEqual(len(set(r.content for r in responses)), 1)
+		self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 1)
+
+	def test_door_status(self):
+		responses = self.fire('/vehicles/1234/doors', 20)
+		self.assertEqual([r.status_code for r in responses], [200] * 20)
+		#door locks are random, so identical bodies prove that everyone got the same call
+		self.assertEqual(len(set(r.content for r in responses)), 1)
+		self.assertEqual(self.simulator.hit_count('getSecurityStatusService'), 1)
+
+	def test_unknown_vehicle(self):
+		responses = self.fire('/vehicles/1230', 20)
+		self.assertEqual([r.status_code for r in responses], [404] * 20)
+		self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 1)
+
+class TestBatch(AppTestCase):
+	"""
+	Testing the batch lookup located in batch.py and its /vehicles/batch route
+	"""
+	latency = 0.3
+
+	def test_fetch_batch(self):
+		start = time.time()
+		ret_obj = batch.fetch_batch([1234, 1235, 1230, 1234])
+		elapsed = time.time() - start
+
+		#every lookup runs in parallel, so the batch takes about as long as one GM call
+		self.assertLess(elapsed, 2 * self.latency)
+
+		#duplicate ids are only looked up once, and results keep the requested order
+		self.assertEqual([value['id'] for value in ret_obj], [1234, 1235, 1230])
+		self.assertEqual(ret_obj[0]['info']['vin'], '123123412412')
+		self.assertEqual(len(ret_obj[0]['doors']), 4)
+		self.assertEqual(type(ret_obj[0]['fuel']['percent']), float)
+		self.assertEqual(ret_obj[0]['errors'], {"battery": {"status": 404, "message": "Vehicle not found"}})
+		self.assertEqual(type(ret_obj[1]['battery']['percent']), float)
+		self.assertEqual(sorted(ret_obj[2]['errors']), ["battery", "doors", "fuel", "info"])
+
+	def test_invalid_batch(self):
+		with self.assertRaises(ValueError):
+			batch.fetch_batch([])
+		with self.assertRaises(ValueError):
+			batch.fetch_batch(None)
+		with self.assertRaises(ValueError):
+			batch.fetch_batch(["1234"])
+		with self.assertRaises(ValueError):
+			batch.fetch_batch([1234], ["vin"])
+		with self.assertRaises(ValueError):
+			batch.fetch_batch(list(range(batch.MAX_BATCH_SIZE + 1)))
+
+	def test_batch_route(self):
+		r = requests.post(self.url + '/vehicles/batch', json={"ids": [1234, 1235], "fields": ["info"]})
+		self.assertEqual(r.status_code, 200)
+		data = r.json()
+		self.assertEqual(data[1]['info']['color'], "Forest Green")
+		self.assertNotIn('doors', data[1])
+
+		r = requests.post(self.url + '/vehicles/batch', json={"ids": [1234], "fields": ["engine"]})
+		self.assertEqual(r.status_code, 400)
+
+		r = requests.get(self.url + '/vehicles/batch')
+		self.assertEqual(r.status_code, 405)
+
+	def test_streamed_batch(self):
+		#every vehicle is streamed as one line holding all of its fields
+		r = requests.post(self.url + '/vehicles/batch?format=ndjson', json={"ids": [1234, 1235]}, stream=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.headers['Content-Type'], 'application/x-ndjson')
+		results = [json.loads(line) for line in r.iter_lines()]
+		self.assertEqual(sorted(value['id'] for value in results), [1234, 1235])
+		for value in results:
+			fields = set(value) | set(value['errors'])
+			self.assertEqual(fields - set(["id", "errors"]), set(batch.FIELDS))
+
+		#the Accept header selects the same mode
+		r = requests.post(self.url + '/vehicles/batch', json={"ids": [1234], "fields": ["info"]},
+			headers={"Accept": "application/x-ndjson"})
+		self.assertEqual(r.headers['Content-Type'], 'application/x-ndjson')
+		self.assertEqual(json.loads(r.text.strip())['info']['doorCount'], 4)
+
+		#invalid batches are still rejected before anything is streamed
+		r = requests.post(self.url + '/vehicles/batch?format=ndjson', json={"ids": []})
+		self.assertEqual(r.status_code, 400)
+
+	def test_iter_batch_order(self):
+		#results come back in the order they finish, not the order they were asked for
+		smartcar.response_cache.set("vehicle_info", 1235, {"vin": "cached"})
+		results = list(batch.iter_batch([1234, 1235], ["info"]))
+		self.assertEqual([value['id'] for value in results], [1235, 1234])
+
+class TestTokenBucket(unittest.TestCase):
+	"""
+	Testing the TokenBucket rate limiter located in ratelimit.py
+	"""
+
+	def setUp(self):
+		self.now = 0.0
+		self.bucket = ratelimit.TokenBucket(rate=10, burst=5, clock=lambda: self.now, sleep=self.sleep)
+
+	def sleep(self, seconds):
+		self.now += seconds
+
+	def test_burst_then_rate(self):
+		#a full bucket allows a burst, then tokens come back at the given rate
+		for _ in range(5):
+			self.assertTrue(self.bucket.try_acquire())
+		self.assertFalse(self.bucket.try_acquire())
+		self.now += 0.1
+		self.assertTrue(self.bucket.try_acquire())
+		self.assertFalse(self.bucket.try_acquire())
+
+	def test_acquire_waits(self):
+		for _ in range(5):
+			self.bucket.acquire()
+		self.bucket.acquire()
+		self.assertAlmostEqual(self.now, 0.1)
+
+	def test_acquire_timeout(self):
+		for _ in range(5):
+			self.bucket.acquire()
+		self.assertFalse(self.bucket.acquire(timeout=0.05))
+		self.assertTrue(self.bucket.acquire(timeout=0.2))
+
+class TestDecoder(unittest.TestCase):
+	"""
+	Testing the compiled GM response decoders located in decoder.py
+	"""
+
+	def setUp(self):
+		self.vehicle = dict(simulator.VEHICLES[1234])
+
+	def payload(self, service):
+		return simulator.SERVICES[service](self.vehicle)
+
+	def test_vehicle_info(self):
+		ret_obj = decoder.VEHICLE_INFO(self.payload("getVehicleInfoService"))
+		self.assertEqual(ret_obj, {"vin": "123123412412", "color": "Metallic Silver",
+			"doorCount": 4, "driveTrain": "v8"})
+
+		payload = self.payload("getVehicleInfoService")
+		del payload["data"]["driveTrain"]
+		with self.assertRaises(ValueError) as context:
+			decoder.VEHICLE_INFO(payload)
+		self.assertEqual(str(context.exception), "No drive train specified for this vehicle")
+
+		#responses without data are for unknown vehicles
+		with self.assertRaises(ValueError) as context:
+			decoder.VEHICLE_INFO({"status": "404", "reason": "Vehicle id: 1230 not found."})
+		self.assertEqual(str(context.exception), "404")
+
+		#other failures the GM API reports in the body of an HTTP 200 are not
+		for status in ("400", "500"):
+			with self.assertRaises(errors.BadUpstreamResponse):
+				decoder.VEHICLE_INFO({"status": status, "reason": "Invalid request."})
+
+	def test_door_status(self):
+		self.vehicle["doors"] = ["door%d" % i for i in range(500)]
+		payload = self.payload("getSecurityStatusService")
+		ret_obj = decoder.DOOR_STATUS(payload)
+		self.assertEqual(len(ret_obj), 500)
+		for value, raw in zip(ret_obj, payload["data"]["doors"]["values"]):
+			self.assertEqual(value["location"], raw["location"]["value"])
+			self.assertEqual(value["locked"], raw["locked"]["value"] == "True")
+
+		#a door without a lock status, or with an unexpected one, is reported
+		payload["data"]["doors"]["values"][42]["locked"]["value"] = "Maybe"
+		with self.assertRaises(ValueError):
+			decoder.DOOR_STATUS(payload)
+		del payload["data"]["doors"]["values"][42]["locked"]
+		with self.assertRaises(ValueError) as context:
+			decoder.DOOR_STATUS(payload)
+		self.assertEqual(str(context.exception), "No lock status specified for a door")
+
+		#no values means no doors, but no doors object at all is an error
+		del payload["data"]["doors"]["values"]
+		self.assertEqual(decoder.DOOR_STATUS(payload), [])
+		del payload["data"]["doors"]
+		with self.assertRaises(ValueError):
+			decoder.DOOR_STATUS(payload)
+
+	def test_energy_and_engine(self):
+		ret_obj = decoder.ENERGY(self.payload("getEnergyService"))
+		self.assertEqual(type(ret_obj["fuel"]["percent"]), float)
+		self.assertIsNone(ret_obj["battery"])
+
+		self.assertEqual(decoder.ENGINE_ACTION({"actionResult": {"status": "EXECUTED"}}), {"status": "success"})
+		self.assertEqual(decoder.ENGINE_ACTION({"actionResult": {"status": "FAILED"}}), {"status": "error"})
+		with self.assertRaises(ValueError):
+			decoder.ENGINE_ACTION({"status": "404"})
+
+class TestResponseEncoder(unittest.TestCase):
+	"""
+	Testing the ResponseEncoder located in encoder.py
+	"""
+
+	def setUp(self):
+		self.encoder = encoder.ResponseEncoder(min_compress_size=100)
+		self.ret = [{"location": "frontLeft", "locked": True}] * 20
+
+	def test_encode(self):
+		#compact output is the default and round trips to the same result
+		body = self.encoder.encode(self.ret)
+		self.assertNotIn(b" ", body)
+		self.assertEqual(json.loads(body.decode('utf-8')), self.ret)
+		#pretty output matches what the routes used to send
+		self.assertEqual(self.encoder.encode(self.ret, pretty=True), json.dumps(self.ret, indent=4).encode('utf-8'))
+
+	def test_accept_encoding(self):
+		weights = encoder.parse_accept_encoding("gzip;q=0.5, br, identity;q=0")
+		self.assertEqual(weights, {"gzip": 0.5, "br": 1.0, "identity": 0.0})
+		self.assertEqual(encoder.parse_accept_encoding(None), {})
+
+	def test_compress(self):
+		body = self.encoder.encode(self.ret)
+		compressed, coding = self.encoder.compress(body, "gzip")
+		self.assertEqual(coding, "gzip")
+		self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(compressed)).read(), body)
+
+		#refused codings, missing headers and small bodies are left alone
+		self.assertEqual(self.encoder.compress(body, "gzip;q=0"), (body, None))
+		self.assertEqual(self.encoder.compress(body, None), (body, None))
+		self.assertEqual(self.encoder.compress(b"{}", "gzip"), (b"{}", None))
+
+class TestEncodedResponses(AppTestCase):
+	"""
+	Testing the content type, pretty-printing and compression of the app's responses
+	"""
+
+	def test_json_response(self):
+		r = requests.get(self.url + '/vehicles/1234/doors', headers={"Accept-Encoding": "identity"})
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.headers['Content-Type'], 'application/json')
+		self.assertNotIn("Content-Encoding", r.headers)
+		self.assertNotIn(" ", r.text)
+
+		r = requests.get(self.url + '/vehicles/1234/doors?pretty=1')
+		self.assertEqual(r.text, json.dumps(r.json(), indent=4))
+
+	def test_compressed_response(self):
+		r = requests.post(self.url + '/vehicles/batch', json={"ids": list(range(1, 40))},
+			headers={"Accept-Encoding": "gzip"})
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+		self.assertEqual(len(r.json()), 39)
+
+class TestMetrics(AppTestCase):
+	"""
+	Testing the counters and histograms located in metrics.py and the /metrics route
+	"""
+
+	def test_histogram(self):
+		histogram = metrics.Histogram("test_seconds", "Test.", ("phase",), buckets=(0.1, 1.0))
+		histogram.observe(("a",), 0.05)
+		histogram.observe(("a",), 0.5)
+		histogram.observe(("a",), 5)
+		lines = histogram.render()
+		self.assertIn('test_seconds_bucket{phase="a",le="0.1"} 1', lines)
+		self.assertIn('test_seconds_bucket{phase="a",le="1.0"} 2', lines)
+		self.assertIn('test_seconds_bucket{phase="a",le="+Inf"} 3', lines)
+		self.assertIn('test_seconds_count{phase="a"} 3', lines)
+		self.assertEqual(histogram.count(("a",)), 3)
+
+	def test_counter(self):
+		counter = metrics.Counter("test_total", "Test.", ("status",))
+		counter.inc(("200",))
+		counter.inc(("200",), 2)
+		counter.inc(('say "hi"',))
+		self.assertEqual(counter.value(("200",)), 3)
+		self.assertEqual(counter.render()[2:], ['test_total{status="200"} 3', 'test_total{status="say \\"hi\\""} 1'])
+
+	def test_metrics_route(self):
+		upstream = metrics.upstream_responses.value(("getVehicleInfoService", "200"))
+		route = metrics.http_responses.value(("GET", "/vehicles/<int:id>", 200))
+		not_found = metrics.http_responses.value(("GET", "/vehicles/<int:id>", 404))
+		validate = metrics.phase_seconds.count(("validate",))
+
+		self.assertEqual(requests.get(self.url + '/vehicles/1234').status_code, 200)
+		self.assertEqual(requests.get(self.url + '/vehicles/1').status_code, 404)
+
+		self.assertEqual(metrics.upstream_responses.value(("getVehicleInfoService", "200")), upstream + 2)
+		self.assertEqual(metrics.http_responses.value(("GET", "/vehicles/<int:id>", 200)), route + 1)
+		self.assertEqual(metrics.http_responses.value(("GET", "/vehicles/<int:id>", 404)), not_found + 1)
+		self.assertEqual(metrics.phase_seconds.count(("validate",)), validate + 2)
+
+		r = requests.get(self.url + '/metrics')
+		self.assertEqual(r.status_code, 200)
+		self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+		self.assertIn('smartcar_http_request_seconds_count{method="GET",route="/vehicles/<int:id>"}', r.text)
+		self.assertIn('smartcar_phase_seconds_bucket{phase="shape",le="+Inf"}', r.text)
+		self.assertIn('smartcar_upstream_responses_total{service="getVehicleInfoService",status="200"}', r.text)
+		self.assertIn('smartcar_cache_hits_total', r.text)
+
+	def test_upstream_errors(self):
+		errors = metrics.upstream_responses.value(("getEnergyService", "500"))
+		self.simulator.error_rate = 1.0
+		try:
+			with self.assertRaises(requests.exceptions.HTTPError):
+				smartcar.get_energy(1234)
+		finally:
+			self.simulator.error_rate = 0.0
+		self.assertEqual(metrics.upstream_responses.value(("getEnergyService", "500")), errors + 1)
+
+class TestCircuitBreaker(AppTestCase):
+	"""
+	Testing the circuit breakers and adaptive timeouts located in circuit.py against a
+	GM API simulator that fails or hangs on demand
+	"""
+
+	def setUp(self):
+		super(TestCircuitBreaker, self).setUp()
+		self.live_breakers = smartcar.breakers
+		smartcar.breakers = circuit.Breakers(failure_threshold=3, reset_timeout=0.5, min_timeout=0.1, max_timeout=2)
+
+	def tearDown(self):
+		smartcar.breakers = self.live_breakers
+		self.simulator.error_rate = 0.0
+		self.simulator.timeout_rate = 0.0
+		self.simulator.hang = 30.0
+
+	def test_state_machine(self):
+		self.now = 1000.0
+		breaker = circuit.CircuitBreaker("test", failure_threshold=2, reset_timeout=10, clock=lambda: self.now)
+		breaker.allow()
+		breaker.failure()
+		breaker.allow()
+		breaker.failure()
+		self.assertEqual(breaker.state, circuit.OPEN)
+		with self.assertRaises(circuit.CircuitOpenError) as context:
+			breaker.allow()
+		self.assertEqual(context.exception.retry_after, 10)
+
+		#after the cool-down a single trial call goes through
+		self.now += 10
+		breaker.allow()
+		self.assertEqual(breaker.state, circuit.HALF_OPEN)
+		with self.assertRaises(circuit.CircuitOpenError):
+			breaker.allow()
+		#a failed trial opens the breaker again, a successful one closes it
+		breaker.failure()
+		self.assertEqual(breaker.state, circuit.OPEN)
+		self.now += 10
+		breaker.allow()
+		breaker.success(0.01)
+		self.assertEqual(breaker.state, circuit.CLOSED)
+		breaker.allow()
+
+	def test_adaptive_timeout(self):
+		breaker = circuit.CircuitBreaker("test", min_timeout=0.1, max_timeout=10, timeout_multiplier=3)
+		self.assertEqual(breaker.timeout, 10)
+		for _ in range(100):
+			breaker.success(0.05)
+		self.assertAlmostEqual(breaker.timeout, 0.15)
+		breaker.failure()
+		self.assertAlmostEqual(breaker.timeout, 0.3)
+
+	def test_fail_fast(self):
+		self.simulator.error_rate = 1.0
+		for _ in range(3):
+			with self.assertRaises(requests.exceptions.HTTPError):
+				smartcar.get_door_status(1234)
+		with self.assertRaises(circuit.CircuitOpenError):
+			smartcar.get_door_status(1234)
+		self.assertEqual(self.simulator.hit_count(), 3)
+
+		r = requests.get(self.url + '/vehicles/1234/doors')
+		self.assertEqual(r.status_code, 503)
+		self.assertEqual(r.headers['Retry-After'], '1')
+		self.assertEqual(self.simulator.hit_count(), 3)
+
+		#other services have their own breaker
+		self.simulator.error_rate = 0.0
+		self.assertEqual(requests.get(self.url + '/vehicles/1234').status_code, 200)
+
+		#once the service recovers, the trial call closes the breaker
+		time.sleep(0.5)
+		self.assertEqual(requests.get(self.url + '/vehicles/1234/doors').status_code, 200)
+		self.assertEqual(smartcar.breakers.get('getSecurityStatusService').state, circuit.CLOSED)
+
+	def test_upstream_failure_routes(self):
+		#a failed lookup is the same JSON error on its own and in a batch
+		self.simulator.error_rate = 1.0
+		r = requests.get(self.url + '/vehicles/1234/doors')
+		self.assertEqual(r.status_code, 502)
+		self.assertEqual(r.headers['Content-Type'], 'application/json')
+		r_batch = requests.post(self.url + '/vehicles/batch', json={"ids": [1234], "fields": ["doors"]})
+		self.assertEqual(r_batch.json()[0]['errors']['doors'], r.json())
+
+		self.simulator.error_rate = 0.0
+		self.simulator.timeout_rate = 1.0
+		self.simulator.hang = 1.0
+		smartcar.breakers.get('actionEngineService').timeout = 0.1
+		r = requests.post(self.url + '/vehicles/1234/engine', json={"action": "START"})
+		self.assertEqual(r.status_code, 504)
+		self.assertEqual(r.json(), {"status": 504, "message": "The GM API did not answer in time"})
+
+	def test_hung_service(self):
+		#learn the normal latency of the engine service, which is never cached
+		for _ in range(20):
+			smartcar.control_engine(1234, "START")
+		self.assertAlmostEqual(smartcar.breakers.get('actionEngineService').timeout, 0.1)
+
+		self.simulator.timeout_rate = 1.0
+		self.simulator.hang = 3.0
+		start = time.time()
+		for _ in range(3):
+			with self.assertRaises(requests.exceptions.Timeout):
+				smartcar.control_engine(1234, "START")
+		with self.assertRaises(circuit.CircuitOpenError):
+			smartcar.control_engine(1234, "START")
+		#0.1 + 0.2 + 0.4 seconds of timeouts rather than 3 hung calls
+		self.assertLess(time.time() - start, 1.5)
+
+	def test_stale_results(self):
+		ret_obj = smartcar.get_vehicle_info(1234)
+		self.simulator.error_rate = 1.0
+		#an hour and a half later the cached vehicle info has expired
+		smartcar.response_cache.clock = lambda: time.time() + 5400
+		try:
+			self.assertEqual(smartcar.get_vehicle_info(1234), ret_obj)
+			for _ in range(3):
+				smartcar.get_vehicle_info(1234)
+			self.assertEqual(smartcar.breakers.get('getVehicleInfoService').state, circuit.OPEN)
+			r = requests.get(self.url + '/vehicles/1234')
+			self.assertEqual(r.status_code, 200)
+			self.assertEqual(r.json(), ret_obj)
+
+			#nothing cached to fall back on
+			self.assertEqual(requests.get(self.url + '/vehicles/1235').status_code, 503)
+		finally:
+			smartcar.response_cache.clock = time.time
+
+class TestStaleWhileRevalidate(AppTestCase):
+	"""
+	Testing that stale door and energy results are served at once and refreshed in the background
+	"""
+
+	def tearDown(self):
+		smartcar.response_cache.clock = time.time
+		self.simulator.latency = 0
+
+	def wait_for_refresh(self, service, hits):
+		for _ in range(100):
+			if (self.simulator.hit_count(service) >= hits and not smartcar._refreshing):
+				return
+			time.sleep(0.01)
+
+	def test_lookup(self):
+		self.now = 1000.0
+		response_cache = cache.ResponseCache({"door_status": 5}, clock=lambda: self.now,
+			revalidate_ttls={"door_status": 10})
+		response_cache.set("door_status", 1234, [])
+		self.now += 2
+		self.assertEqual(response_cache.lookup("door_status", 1234), ([], 2, False))
+		self.now += 10
+		self.assertEqual(response_cache.lookup("door_status", 1234), ([], 12, True))
+		self.assertIsNone(response_cache.get("door_status", 1234))
+		self.now += 5
+		self.assertIsNone(response_cache.lookup("door_status", 1234))
+		self.assertEqual(response_cache.stats()["revalidations"], 1)
+
+	def test_stale_served_and_refreshed(self):
+		ret_obj = smartcar.get_door_status(1234)
+		self.assertEqual(smartcar.result_age(), 0)
+		self.simulator.latency = 0.5
+
+		#6 seconds later the result is past its 5 second TTL but within the window
+		smartcar.response_cache.clock = lambda: time.time() + 6
+		start = time.time()
+		self.assertEqual(smartcar.get_door_status(1234), ret_obj)
+		self.assertLess(time.time() - start, 0.25)
+		self.assertAlmostEqual(smartcar.result_age(), 6, places=1)
+
+		#the refresh replaces the cached result with a fresh one
+		self.wait_for_refresh('getSecurityStatusService', 2)
+		time.sleep(0.6)
+		self.assertEqual(self.simulator.hit_count('getSecurityStatusService'), 2)
+		smartcar.get_door_status(1234)
+		self.assertLess(smartcar.result_age(), 1)
+
+	def test_age_header(self):
+		r = requests.get(self.url + '/vehicles/1234/fuel')
+		self.assertEqual(r.headers['Age'], '0')
+		self.assertEqual(requests.get(self.url + '/vehicles/1234/battery').status_code, 404)
+		smartcar.response_cache.clock = lambda: time.time() + 15
+		r = requests.get(self.url + '/vehicles/1234/fuel')
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.headers['Age'], '15')
+		self.assertNotIn('Age', requests.post(self.url + '/vehicles/1234/engine', json={"action": "START"}).headers)
+
+		#past the window the result is fetched again before answering
+		self.wait_for_refresh('getEnergyService', 2)
+		smartcar.response_cache.clear()
+		smartcar.response_cache.set("energy", 1234, {"fuel": {"percent": 1.0}, "battery": None})
+		smartcar.response_cache.clock = lambda: time.time() + 50
+		r = requests.get(self.url + '/vehicles/1234/fuel')
+		self.assertEqual(r.headers['Age'], '0')
+		self.assertNotEqual(r.json(), {"percent": 1.0})
+
+class TestPrefetch(SimulatorTestCase):
+	"""
+	Testing the hot key tracking and background refreshes located in prefetch.py
+	"""
+
+	def setUp(self):
+		super(TestPrefetch, self).setUp()
+		self.live_prefetcher = smartcar.prefetcher
+		smartcar.prefetcher = prefetch.Prefetcher(smartcar.refresh, smartcar.response_cache.expires_in,
+			budget=3, interval=1, top=2)
+
+	def tearDown(self):
+		smartcar.prefetcher.stop()
+		smartcar.prefetcher = self.live_prefetcher
+
+	def test_count_min_sketch(self):
+		sketch = prefetch.CountMinSketch(width=64, depth=4, seed=1)
+		for id in range(200):
+			for _ in range(id % 5):
+				sketch.add(id)
+		for id in range(200):
+			self.assertGreaterEqual(sketch.estimate(id), id % 5)
+		self.assertEqual(sketch.add("new"), sketch.estimate("new"))
+		sketch.decay()
+		self.assertLessEqual(sketch.estimate(199), 4)
+
+		#keys that share a counter in one row rarely share one in another row
+		sketch = prefetch.CountMinSketch(width=2048, depth=4)
+		indexes = [sketch._indexes(("energy", id)) for id in range(20000)]
+		first = {}
+		for index in indexes:
+			first.setdefault(index[0], []).append(index)
+		pairs = [(a, b) for group in first.values() for i, a in enumerate(group) for b in group[i + 1:]]
+		shared = [a for a, b in pairs if (a[1] == b[1] or a[2] == b[2] or a[3] == b[3])]
+		self.assertLess(len(shared), len(pairs) * 0.01)
+
+	def test_hottest(self):
+		prefetcher = prefetch.Prefetcher(None, lambda endpoint, id: None, top=2)
+		for id, count in ((1, 5), (2, 1), (3, 10), (4, 3)):
+			for _ in range(count):
+				prefetcher.record("energy", id)
+		self.assertEqual(prefetcher.hottest(), [("energy", 3), ("energy", 1)])
+
+	def test_refreshes_hot_keys(self):
+		for _ in range(5):
+			smartcar.get_vehicle_info(1234)
+			smartcar.get_energy(1235)
+		smartcar.get_door_status(1234)
+		self.assertEqual(smartcar.prefetcher.hottest(), [("vehicle_info", 1234), ("energy", 1235)])
+
+		#vehicle info is cached for an hour, so only energy is due; it expires within 2 rounds
+		smartcar.response_cache.clock = lambda: time.time() + 9
+		try:
+			self.simulator.reset()
+			self.assertEqual(smartcar.prefetcher.run_once(), 1)
+		finally:
+			smartcar.response_cache.clock = time.time
+		self.assertEqual(self.simulator.hit_count('getEnergyService'), 1)
+		self.assertEqual(self.simulator.hit_count(), 1)
+
+		#after an engine command drops a vehicle's results, they are fetched again
+		smartcar.control_engine(1234, "START")
+		self.simulator.reset()
+		smartcar.prefetcher.run_once()
+		self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 1)
+		smartcar.get_vehicle_info(1234)
+		self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 1)
+
+	def test_budget(self):
+		for id in (1234, 1235):
+			for endpoint in ("vehicle_info", "door_status", "energy"):
+				smartcar.prefetcher.record(endpoint, id)
+		smartcar.prefetcher.top = 6
+		#3 calls per second, with a burst of one round's worth
+		self.assertEqual(smartcar.prefetcher.run_once(), 3)
+		self.assertEqual(self.simulator.hit_count(), 3)
+		self.assertEqual(smartcar.prefetcher.run_once(), 0)
+
+	def test_unknown_vehicles_are_forgotten(self):
+		smartcar.prefetcher.record("vehicle_info", 1)
+		smartcar.prefetcher.run_once()
+		self.assertEqual(smartcar.prefetcher.hottest(), [])
+
+	def test_background_thread(self):
+		smartcar.prefetcher = prefetch.Prefetcher(smartcar.refresh, smartcar.response_cache.expires_in,
+			budget=10, interval=0.05, top=2)
+		smartcar.prefetcher.record("door_status", 1234)
+		smartcar.prefetcher.start()
+		for _ in range(100):
+			if (smartcar.response_cache.expires_in("door_status", 1234) is not None):
+				break
+			time.sleep(0.01)
+		smartcar.prefetcher.stop()
+		self.assertIsNotNone(smartcar.response_cache.expires_in("door_status", 1234))
+
+class TestVehicleState(SimulatorTestCase):
+	"""
+	Testing the compact cache records located in vehiclestate.py
+	"""
+
+	def test_round_trip(self):
+		#every result must come back from its record exactly as smartcar.py built it
+		for id in [1234, 1235]:
+			for endpoint, get in [("vehicle_info", smartcar.get_vehicle_info),
+					("door_status", smartcar.get_door_status), ("energy", smartcar.get_energy)]:
+				value = get(id)
+				record = vehiclestate.pack(endpoint, value)
+				self.assertIsInstance(record, vehiclestate.Record)
+				self.assertEqual(vehiclestate.unpack(record), value)
+				self.assertEqual(json.dumps(vehiclestate.unpack(record), sort_keys=True), json.dumps(value, sort_keys=True))
+
+	def test_door_locks(self):
+		doors = [{"location": "frontLeft", "locked": True}, {"location": "frontRight", "locked": False},
+			{"location": "backLeft", "locked": False}, {"location": "backRight", "locked": True}]
+		record = vehiclestate.pack("door_status", doors)
+		self.assertEqual(record.locks, 0b1001)
+		self.assertEqual(record.unpack(), doors)
+		self.assertEqual(vehiclestate.pack("door_status", []).unpack(), [])
+
+	def test_shared_strings(self):
+		#vehicles with the same doors and colors share a single copy of them
+		first = vehiclestate.pack("door_status", [{"location": "front" + "Left", "locked": True}])
+		second = vehiclestate.pack("door_status", [{"location": "".join(["front", "Left"]), "locked": False}])
+		self.assertIs(first.locations, second.locations)
+		first = vehiclestate.pack("vehicle_info", {"vin": "1", "color": "Metallic" + "Silver", "doorCount": 4, "driveTrain": "v8"})
+		second = vehiclestate.pack("vehicle_info", {"vin": "2", "color": "".join(["Metallic", "Silver"]), "doorCount": 4, "driveTrain": "v8"})
+		self.assertIs(first.color, second.color)
+
+	def test_interner_limit(self):
+		interner = vehiclestate.Interner(limit=1)
+		self.assertIs(interner("a" * 3), interner("".join(["a", "aa"])))
+		value = "".join(["b", "bb"])
+		self.assertIs(interner(value), value)
+		self.assertEqual(len(interner.values), 1)
+
+	def test_unexpected_shape(self):
+		#values that do not have the expected shape are kept as they are
+		self.assertEqual(vehiclestate.pack("vehicle_info", {"vin": "1"}), {"vin": "1"})
+		self.assertEqual(vehiclestate.pack("energy", None), None)
+		self.assertEqual(vehiclestate.pack("control_engine", {"status": "success"}), {"status": "success"})
+		self.assertEqual(vehiclestate.unpack({"vin": "1"}), {"vin": "1"})
+
+	def test_cache_codec(self):
+		compact = cache.ResponseCache({"energy": 60}, codec=vehiclestate)
+		value = {"fuel": None, "battery": {"percent": 50.3}}
+		compact.set("energy", 1234, value)
+		self.assertIsInstance(compact.entries[("energy", 1234)].value, vehiclestate.Energy)
+		self.assertEqual(compact.get("energy", 1234), value)
+		self.assertEqual(compact.lookup("energy", 1234)[0], value)
+
+class TestVehicleStore(SimulatorTestCase):
+	"""
+	Testing the persistent vehicle info store located in vehiclestore.py
+	"""
+
+	def setUp(self):
+		super(TestVehicleStore, self).setUp()
+		self.now = 1000.0
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, "vehicles.db")
+		self.store = vehiclestore.VehicleStore(self.path, clock=lambda: self.now)
+		self.live_store = smartcar.vehicle_store
+		smartcar.vehicle_store = self.store
+
+	def tearDown(self):
+		smartcar.vehicle_store = self.live_store
+		self.simulator.error_rate = 0.0
+		self.store.close()
+		shutil.rmtree(self.directory)
+
+	def test_put_and_get(self):
+		info = {"vin": "123123412412", "color": "Metallic Silver", "doorCount": 4, "driveTrain": "v8"}
+		self.assertIsNone(self.store.get(1234))
+		self.store.put(1234, info)
+		self.now += 30
+		self.assertEqual(self.store.get(1234), (info, 30))
+		self.assertEqual(len(self.store), 1)
+		stats = self.store.stats()
+		self.assertEqual((stats['hits'], stats['misses'], stats['writes']), (1, 1, 1))
+
+		#other processes opening the same file see what was stored
+		other = vehiclestore.VehicleStore(self.path)
+		self.assertEqual(other.get(1234)[0], info)
+		other.close()
+
+	def test_warm_restart(self):
+		info = smartcar.get_vehicle_info(1234)
+		self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 1)
+
+		#a restart empties the response cache, but not the store
+		smartcar.response_cache.clear()
+		self.assertEqual(smartcar.get_vehicle_info(1234), info)
+		self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 1)
+		#and the result is cached again
+		self.assertEqual(smartcar.response_cache.get("vehicle_info", 1234), info)
+
+	def test_expired_copy(self):
+		info = smartcar.get_vehicle_info(1234)
+		smartcar.response_cache.clear()
+		self.now += smartcar.config.VEHICLE_STORE_TTL
+		self.assertEqual(smartcar.get_vehicle_info(1234), info)
+		self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 2)
+
+		#an expired copy is still served while the GM API is failing
+		smartcar.response_cache.clear()
+		self.now += smartcar.config.VEHICLE_STORE_TTL
+		self.simulator.error_rate = 1.0
+		self.assertEqual(smartcar.get_vehicle_info(1234), info)
+		self.assertEqual(smartcar.result_age(), smartcar.config.VEHICLE_STORE_TTL)
+
+	def test_export_and_import(self):
+		for id in [1234, 1235]:
+			smartcar.get_vehicle_info(id)
+		snapshot = os.path.join(self.directory, "fleet.ndjson")
+		with open(snapshot, 'w') as out:
+			self.assertEqual(self.store.export(out), 2)
+
+		other = vehiclestore.VehicleStore(os.path.join(self.directory, "other.db"))
+		with open(snapshot) as source:
+			self.assertEqual(other.load(source), 2)
+		self.assertEqual(list(other.items()), list(self.store.items()))
+
+		#an invalid snapshot is rejected as a whole
+		other.clear()
+		with open(snapshot) as source:
+			lines = source.readlines()
+		with self.assertRaises(ValueError):
+			other.load([lines[0], '{"id": 1}'])
+		for id in ['"abc"', '1.5', '{}', '"12"']:
+			with self.assertRaises(ValueError) as context:
+				other.load([lines[0], lines[1].replace('"id": 1235', '"id": ' + id)])
+			self.assertEqual(str(context.exception), "Invalid vehicle id on line 2 of the snapshot")
+		self.assertEqual(len(other), 0)
+		other.close()
+
+class TestSharedCache(SimulatorTestCase):
+	"""
+	Testing the state shared between the worker processes of serve.py, located in
+	sharedcache.py
+	"""
+	latency = 0.2
+
+	def test_flight_table(self):
+		table = sharedcache.FlightTable(timeout=5)
+		self.assertEqual(table.join("key"), (sharedcache.LEADER, None))
+		results = []
+		waiters = [threading.Thread(target=lambda: results.append(table.join("key"))) for _ in range(3)]
+		for waiter in waiters:
+			waiter.start()
+		time.sleep(0.1)
+		table.end("key", {"vin": "123"}, True)
+		for waiter in waiters:
+			waiter.join()
+		self.assertEqual(results, [(sharedcache.DONE, {"vin": "123"})] * 3)
+		self.assertEqual(table.stats(), {"calls": 1, "shared": 3, "in_flight": 0})
+
+		#waiters of a failed call make it themselves
+		table.join("key")
+		waiter = threading.Thread(target=lambda: results.append(table.join("key")))
+		waiter.start()
+		time.sleep(0.1)
+		table.end("key", None, False)
+		waiter.join()
+		self.assertEqual(results[-1], (sharedcache.FAILED, None))
+
+	def test_abandoned_call(self):
+		#a call whose leader died is taken over once it times out
+		self.now = 1000.0
+		table = sharedcache.FlightTable(timeout=5, clock=lambda: self.now)
+		table.join("key")
+		self.now += 5
+		self.assertEqual(table.join("key"), (sharedcache.LEADER, None))
+
+	def test_workers(self):
+		logging.getLogger('werkzeug').setLevel(logging.ERROR)
+		server = serve.Server('127.0.0.1', 0, workers=3).start()
+		#the manager process calls the GM API for the change feed, so it has a share of the limits
+		self.assertEqual(server.shares, 4)
+		#the workers inherit the server and the shared state, so they are forked whatever the default
+		if (hasattr(sharedcache.fork, 'get_start_method')):
+			self.assertEqual(sharedcache.fork.get_start_method(), 'fork')
+		try:
+			responses = []
+			def get():
+				responses.append(requests.get(server.url + '/vehicles/1234'))
+			clients = [threading.Thread(target=get) for _ in range(9)]
+			for client in clients:
+				client.start()
+			for client in clients:
+				client.join()
+			self.assertEqual([r.status_code for r in responses], [200] * 9)
+			self.assertEqual(len(set([r.content for r in responses])), 1)
+			#concurrent lookups in every worker made a single GM API call
+			self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 1)
+
+			#and later lookups in any worker are cache hits
+			for _ in range(6):
+				self.assertEqual(requests.get(server.url + '/vehicles/1234').status_code, 200)
+			self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 1)
+			stats = requests.get(server.url + '/cache/stats').json()
+			self.assertEqual(stats['entries'], 1)
+			self.assertGreaterEqual(stats['hits'], 6)
+
+			#every worker serves the one change feed, so a cursor from one is valid in all of them
+			cursor = requests.get(server.url + '/vehicles/1234/changes').json()['cursor']
+			for _ in range(6):
+				r = requests.get(server.url + '/vehicles/1234/changes?timeout=0.05&cursor=' + cursor)
+				self.assertEqual(r.json()['cursor'].split('-')[0], cursor.split('-')[0])
+		finally:
+			server.stop()
+
+class TestGovernor(AppTestCase):
+	"""
+	Testing the per service admission control (rate limit and in-flight limit) located
+	in ratelimit.py
+	"""
+
+	def setUp(self):
+		super(TestGovernor, self).setUp()
+		self.live_governors = smartcar.governors
+
+	def tearDown(self):
+		smartcar.governors = self.live_governors
+		self.simulator.latency = 0
+
+	def test_in_flight_limit(self):
+		governor = ratelimit.Governor("test", rate=0, max_in_flight=2, queue_timeout=0.1)
+		governor.acquire()
+		governor.acquire()
+		rejected = metrics.upstream_rejections.value(("test", "concurrency"))
+		with self.assertRaises(ratelimit.ThrottledError):
+			governor.acquire()
+		self.assertEqual(metrics.upstream_rejections.value(("test", "concurrency")), rejected + 1)
+
+		#a queued call is admitted as soon as a slot frees up
+		admitted = []
+		waiter = threading.Thread(target=lambda: admitted.append(governor.acquire()))
+		waiter.start()
+		time.sleep(0.02)
+		self.assertEqual(governor.stats()['queued'], 1)
+		governor.release()
+		waiter.join()
+		self.assertEqual(len(admitted), 1)
+		self.assertEqual(governor.stats(), {"in_flight": 2, "queued": 0, "admitted": 3, "rejected": 1})
+
+	def test_rate_limit(self):
+		governor = ratelimit.Governor("test", rate=10, burst=2, max_in_flight=0, queue_timeout=0.05)
+		governor.acquire()
+		governor.acquire()
+		#the next token comes in 100ms, after the deadline
+		with self.assertRaises(ratelimit.ThrottledError):
+			governor.acquire()
+		#a longer deadline waits for it
+		governor.queue_timeout = 1
+		self.assertGreater(governor.acquire(), 0.05)
+
+	def test_throttled_routes(self):
+		smartcar.governors = ratelimit.Governors(rate=0, max_in_flight=1, queue_timeout=0.05)
+		self.simulator.latency = 0.3
+		self.assertEqual(requests.get(self.url + '/vehicles/1234/doors').status_code, 200)
+
+		#with one call in flight at a time, concurrent lookups of other vehicles are shed
+		start = threading.Event()
+		responses = []
+		def get(id):
+			start.wait()
+			responses.append(requests.get(self.url + '/vehicles/%d' % id))
+		threads = [threading.Thread(target=get, args=(id,)) for id in [1234, 1235]]
+		for thread in threads:
+			thread.start()
+		start.set()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(sorted([r.status_code for r in responses]), [200, 503])
+		throttled = [r for r in responses if (r.status_code == 503)][0]
+		self.assertIn("busy", throttled.text)
+		self.assertEqual(throttled.headers['Retry-After'], '1')
+		self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 1)
+
+	def test_breaker_checked_first(self):
+		smartcar.governors = ratelimit.Governors(rate=0, max_in_flight=1, queue_timeout=0.05)
+		breaker = smartcar.breakers.get('getEnergyService')
+		for _ in range(breaker.failure_threshold):
+			breaker.failure()
+		#an open breaker fails fast without being admitted by the governor
+		with self.assertRaises(circuit.CircuitOpenError):
+			smartcar.get_energy(1234)
+		self.assertEqual(smartcar.governors.get('getEnergyService').stats()['admitted'], 0)
+
+		#a trial call that is throttled leaves the trial to the next call
+		breaker.opened_at -= breaker.reset_timeout
+		smartcar.governors.get('getEnergyService').acquire()
+		with self.assertRaises(ratelimit.ThrottledError):
+			smartcar.get_energy(1234)
+		smartcar.governors.get('getEnergyService').release()
+		smartcar.get_energy(1234)
+		self.assertEqual(breaker.state, circuit.CLOSED)
+
+	def test_split_between_workers(self):
+		smartcar.split_upstream_limits(4)
+		governor = smartcar.governors.get('getEnergyService')
+		self.assertEqual((governor.bucket.rate, governor.bucket.burst, governor.max_in_flight),
+			(config.GM_RATE_LIMIT / 4.0, config.GM_RATE_BURST / 4.0, config.GM_MAX_IN_FLIGHT // 4))
+
+class TestConditionalRequests(AppTestCase):
+	"""
+	Testing the ETag, Last-Modified and 304 Not Modified handling of the vehicle routes in app.py
+	"""
+
+	def setUp(self):
+		super(TestConditionalRequests, self).setUp()
+		import app
+		app.encoded_bodies.clear()
+
+	def test_not_modified(self):
+		r = requests.get(self.url + '/vehicles/1234')
+		self.assertEqual(r.status_code, 200)
+		etag = r.headers['ETag']
+		self.assertTrue(etag.startswith('W/"'))
+		self.assertIn('Last-Modified', r.headers)
+
+		encodes = metrics.phase_seconds.count(("encode",))
+		r = requests.get(self.url + '/vehicles/1234', headers={'If-None-Match': etag})
+		self.assertEqual(r.status_code, 304)
+		self.assertEqual(r.content, b"")
+		self.assertEqual(r.headers['ETag'], etag)
+		#the unchanged result was neither fetched nor encoded again
+		self.assertEqual(metrics.phase_seconds.count(("encode",)), encodes)
+		self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 1)
+
+		#a client without the current version gets the whole body, without it being encoded again
+		r = requests.get(self.url + '/vehicles/1234', headers={'If-None-Match': 'W/"other"'})
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.json()['vin'], '123123412412')
+		self.assertEqual(metrics.phase_seconds.count(("encode",)), encodes)
+
+		r = requests.get(self.url + '/vehicles/1234', headers={'If-Modified-Since': r.headers['Last-Modified']})
+		self.assertEqual(r.status_code, 304)
+
+	def test_changed_result(self):
+		r = requests.get(self.url + '/vehicles/1234/doors')
+		etag = r.headers['ETag']
+		smartcar.response_cache.set("door_status", 1234, [{"location": "frontLeft", "locked": False}])
+		r = requests.get(self.url + '/vehicles/1234/doors', headers={'If-None-Match': etag})
+		self.assertEqual(r.status_code, 200)
+		self.assertNotEqual(r.headers['ETag'], etag)
+		self.assertEqual(r.json(), [{"location": "frontLeft", "locked": False}])
+
+		#each route and representation has its own ETag
+		fuel = requests.get(self.url + '/vehicles/1234/fuel').headers['ETag']
+		energy = requests.get(self.url + '/vehicles/1234/energy').headers['ETag']
+		self.assertNotEqual(fuel, energy)
+		r = requests.get(self.url + '/vehicles/1234/fuel?pretty=1', headers={'If-None-Match': fuel})
+		self.assertEqual(r.status_code, 304)
+
+	def test_stable_tag(self):
+		first = {"vin": "123", "color": "Red", "doorCount": 4, "driveTrain": "v8"}
+		second = {"driveTrain": "v8", "doorCount": 4, "color": "Red", "vin": "123"}
+		self.assertEqual(encoder.result_tag(first), encoder.result_tag(second))
+		self.assertNotEqual(encoder.result_tag(first), encoder.result_tag(dict(first, color="Blue")))
+
+class TestChangeFeed(AppTestCase):
+	"""
+	Testing the shared poller located in changefeed.py and the /vehicles/changes routes of app.py
+	"""
+
+	def setUp(self):
+		super(TestChangeFeed, self).setUp()
+		import app
+		self.app = app
+		self.live_feed = app.change_feed
+		self.doors = {1234: [{"location": "frontLeft", "locked": True}], 1235: []}
+		self.energy = {1234: {"fuel": {"percent": 30}, "battery": None}, 1235: {"fuel": None, "battery": {"percent": 80}}}
+		self.fetches = []
+
+		def source(values):
+			def fetch(id):
+				self.fetches.append(id)
+				if (id not in values):
+					raise errors.VehicleNotFound()
+				return values[id]
+			return fetch
+
+		self.feed = changefeed.ChangeFeed([("doors", source(self.doors), source(self.doors)),
+			("energy", source(self.energy), source(self.energy))], interval=0.05, log_size=3)
+
+	def tearDown(self):
+		self.app.change_feed = self.live_feed
+
+	def test_changes(self):
+		cursor, changes = self.feed.wait([1234], None, 0)
+		self.assertEqual([change.to_json() for change in changes], [{"id": 1234, "doors": self.doors[1234]},
+			{"id": 1234, "energy": self.energy[1234]}])
+
+		#nothing changed, so waiting times out empty
+		self.feed.poll_once()
+		self.assertEqual(self.feed.wait([1234], cursor, 0), (cursor, []))
+
+		#only what changed is logged
+		self.energy[1234] = {"fuel": {"percent": 29}, "battery": None}
+		self.feed.poll_once()
+		cursor, changes = self.feed.wait([1234], cursor, 0)
+		self.assertEqual([change.to_json() for change in changes], [{"id": 1234, "energy": {"fuel": {"percent": 29}, "battery": None}}])
+		self.assertEqual(self.feed.wait([1234], cursor, 0), (cursor, []))
+
+		#a waiting subscriber is woken up by the next change
+		self.doors[1234] = [{"location": "frontLeft", "locked": False}]
+		threading.Timer(0.05, self.feed.poll_once).start()
+		started = time.time()
+		cursor, changes = self.feed.wait([1234], cursor, 5)
+		self.assertLess(time.time() - started, 1)
+		self.assertEqual(changes[0].to_json(), {"id": 1234, "doors": [{"location": "frontLeft", "locked": False}]})
+
+	def test_stale_cursor(self):
+		cursor, changes = self.feed.wait([1234, 1235], None, 0)
+		self.feed.poll_once()
+		#more changes than the log holds: the subscriber gets the current state again
+		for percent in range(5):
+			self.energy[1235] = {"fuel": None, "battery": {"percent": percent}}
+			self.feed.poll_once()
+		cursor, changes = self.feed.wait([1234, 1235], cursor, 0)
+		self.assertEqual(len(changes), 4)
+		self.assertEqual(changes[3].to_json(), {"id": 1235, "energy": {"fuel": None, "battery": {"percent": 4}}})
+		#as does a cursor of another feed
+		self.assertEqual(len(self.feed.wait([1234], "other-1", 0)[1]), 2)
+
+	def test_single_poller(self):
+		#every subscriber of a vehicle shares the same poll, and vehicles nobody asks for are dropped
+		self.now = 1000.0
+		self.feed.clock = lambda: self.now
+		for _ in range(3):
+			self.feed.wait([1234], None, 0)
+		del self.fetches[:]
+		self.feed.poll_once()
+		self.assertEqual(self.fetches, [1234, 1234])
+		self.now += self.feed.linger
+		self.assertEqual(self.feed.poll_once(), 0)
+		self.assertEqual(self.feed.stats()['vehicles'], 0)
+
+	def test_routes(self):
+		self.app.change_feed = self.feed
+		r = requests.get(self.url + '/vehicles/changes?ids=1234,1235')
+		self.assertEqual(r.status_code, 200)
+		data = r.json()
+		self.assertEqual(len(data['changes']), 4)
+
+		self.energy[1235] = {"fuel": None, "battery": {"percent": 79}}
+		r = requests.get(self.url + '/vehicles/changes?ids=1234,1235&timeout=5&cursor=' + data['cursor'])
+		self.assertEqual(r.json()['changes'], [{"id": 1235, "energy": {"fuel": None, "battery": {"percent": 79}}}])
+
+		r = requests.get(self.url + '/vehicles/1234/changes?timeout=0.1&cursor=' + r.json()['cursor'])
+		self.assertEqual(r.json()['changes'], [])
+
+		self.assertEqual(requests.get(self.url + '/vehicles/changes?ids=abc').status_code, 400)
+		self.assertEqual(requests.get(self.url + '/vehicles/changes').status_code, 400)
+		self.assertEqual(requests.get(self.url + '/vehicles/1236/changes').status_code, 404)
+
+		#the feed of app.py polls smartcar.py
+		cursor, changes = self.live_feed.snapshot([1234])
+		self.assertEqual([change.to_json() for change in changes], [{"id": 1234, "doors": smartcar.get_door_status(1234)},
+			{"id": 1234, "energy": smartcar.get_energy(1234)}])
+
+	def test_event_stream(self):
+		self.app.change_feed = self.feed
+		r = requests.get(self.url + '/vehicles/1234/changes', headers={'Accept': 'text/event-stream'}, stream=True)
+		self.assertEqual(r.headers['Content-Type'].split(';')[0], 'text/event-stream')
+		lines = r.iter_lines(chunk_size=1)
+		self.assertTrue(next(lines).startswith(b"id: "))
+		self.assertEqual(next(lines), b"event: doors")
+		self.assertEqual(json.loads(next(lines)[len(b"data: "):]), {"id": 1234, "doors": self.doors[1234]})
+		r.close()
+
+class TestFieldSelection(AppTestCase):
+	"""
+	Testing the field selection of /vehicles/<id>?fields= located in query.py
+	"""
+
+	def tearDown(self):
+		self.simulator.latency = 0
+
+	def test_plan(self):
+		self.assertEqual(query.plan(["vin", "battery", "color"]), ["vehicle_info", "energy"])
+		self.assertEqual(query.plan(["fuel", "battery"]), ["energy"])
+		self.assertEqual(query.parse_fields("doors, vin,doors"), ["doors", "vin"])
+		with self.assertRaises(ValueError):
+			query.parse_fields("vin,speed")
+
+	def test_only_needed_services(self):
+		r = requests.get(self.url + '/vehicles/1234?fields=vin,driveTrain')
+		self.assertEqual(r.json(), {"vin": "123123412412", "driveTrain": "v8"})
+		self.assertEqual(self.simulator.hit_count(), 1)
+		self.assertEqual(self.simulator.hit_count('getVehicleInfoService'), 1)
+
+		r = requests.get(self.url + '/vehicles/1235?fields=battery,fuel')
+		self.assertEqual(r.json(), smartcar.get_energy(1235))
+		self.assertEqual(self.simulator.hit_count('getEnergyService'), 1)
+		self.assertEqual(self.simulator.hit_count('getSecurityStatusService'), 0)
+
+	def test_merged_concurrently(self):
+		self.simulator.latency = 0.3
+		started = time.time()
+		r = requests.get(self.url + '/vehicles/1234?fields=vin,doors,fuel')
+		elapsed = time.time() - started
+		self.assertEqual(r.status_code, 200)
+		self.assertLess(elapsed, 0.8)
+		self.assertEqual(r.json(), {"vin": smartcar.get_vehicle_info(1234)["vin"],
+			"doors": smartcar.get_door_status(1234), "fuel": smartcar.get_energy(1234)["fuel"]})
+		self.assertEqual(self.simulator.hit_count(), 3)
+		#each selection has its own ETag
+		etag = r.headers['ETag']
+		self.assertNotEqual(requests.get(self.url + '/vehicles/1234?fields=vin').headers['ETag'], etag)
+		r = requests.get(self.url + '/vehicles/1234?fields=vin,doors,fuel', headers={'If-None-Match': etag})
+		self.assertEqual(r.status_code, 304)
+
+	def test_not_behind_batches(self):
+		#a field selection does not queue behind a batch that takes every batch worker
+		release = threading.Event()
+		busy = [batch.pool().apply_async(release.wait) for _ in range(batch.MAX_CONCURRENCY)]
+		try:
+			results = []
+			lookup = threading.Thread(target=lambda: results.append(query.fetch_fields(1234, ["vin", "doors", "fuel"])))
+			lookup.start()
+			lookup.join(5)
+			self.assertEqual(sorted(results[0][0]), ["doors", "fuel", "vin"])
+		finally:
+			release.set()
+			for call in busy:
+				call.get()
+
+	def test_errors(self):
+		r = requests.get(self.url + '/vehicles/1234?fields=vin,speed')
+		self.assertEqual(r.status_code, 400)
+		self.assertIn("speed is not a valid field", r.text)
+		self.assertEqual(requests.get(self.url + '/vehicles/1234?fields=').status_code, 400)
+		self.assertEqual(requests.get(self.url + '/vehicles/1236?fields=vin,doors').status_code, 404)
+
+class TestValidation(AppTestCase):
+	"""
+	Testing the validators located in utility.py and the errors located in errors.py
+	"""
+
+	def test_validators(self):
+		self.assertEqual(utility.check_valid_input({"id": 1234, "command": u"STOP"}), {"id": 1234, "command": "STOP_VEHICLE"})
+		with self.assertRaises(errors.InvalidInput) as context:
+			utility.check_valid_input({"id": 12.5})
+		self.assertEqual(context.exception.description, "Please provide a valid option for the vehicle ID. 12.5 is not a valid option")
+		with self.assertRaises(errors.InvalidInput) as context:
+			utility.check_valid_input({"id": 1234, "command": ["START"]})
+		self.assertEqual(context.exception.status, 400)
+		with self.assertRaises(errors.InvalidInput):
+			utility.check_valid_input({"id": True})
+		with self.assertRaises(errors.InvalidInput) as context:
+			utility.check_valid_input({"id": 1234, "command": None})
+		self.assertIs(context.exception.body, errors._bodies[utility.MISSING_ACTION])
+
+	def test_errors(self):
+		err = errors.VehicleNotFound()
+		self.assertIsInstance(err, ValueError)
+		self.assertEqual((err.status, err.body, str(err)), (404, b"Vehicle not found", "404"))
+		self.assertEqual(errors.InvalidInput(u"caf\xe9").body, b"caf\xc3\xa9")
+		self.assertEqual(batch.error_status(err), {"status": 404, "message": "Vehicle not found"})
+		payload = simulator.SERVICES["getVehicleInfoService"](dict(simulator.VEHICLES[1234]))
+		del payload["data"]["vin"]
+		with self.assertRaises(errors.BadUpstreamResponse) as context:
+			decoder.VEHICLE_INFO(payload)
+		self.assertEqual(context.exception.status, 502)
+
+		#values the GM API should not have sent are its fault, not the client's
+		payload = simulator.SERVICES["getEnergyService"](dict(simulator.VEHICLES[1234]))
+		payload["data"]["tankLevel"]["value"] = "full"
+		with self.assertRaises(errors.BadUpstreamResponse):
+			decoder.ENERGY(payload)
+		self.assertEqual(batch.error_status(ValueError("could not convert string to float")),
+			{"status": 502, "message": "The GM API could not be reached"})
+
+	def test_not_json(self):
+		class Reply(object):
+			status_code = 200
+			def json(self):
+				raise ValueError("No JSON object could be decoded")
+		class Client(object):
+			def post(self, service, params, read_timeout=None):
+				return Reply()
+		live_client = smartcar.client
+		smartcar.client = Client()
+		try:
+			r = requests.get(self.url + '/vehicles/1234')
+		finally:
+			smartcar.client = live_client
+		self.assertEqual(r.status_code, 502)
+		self.assertEqual(r.text, "The GM API sent a response that is not JSON")
+
+	def test_rejected_before_upstream(self):
+		import app
+		r = requests.post(self.url + '/vehicles/1234/engine', data="START")
+		self.assertEqual(r.status_code, 400)
+		self.assertEqual(r.text, utility.MISSING_ACTION)
+		r = requests.post(self.url + '/vehicles/1234/engine', json={"action": "LAUNCH"})
+		self.assertEqual((r.status_code, r.headers['Content-Type']), (400, 'text/plain; charset=utf-8'))
+		self.assertEqual(r.text, "Please provide a valid input for the action (START|STOP). LAUNCH is not a valid input")
+		r = requests.post(self.url + '/vehicles/batch', json={"ids": list(range(batch.MAX_BATCH_SIZE + 1))})
+		self.assertEqual((r.status_code, r.text), (400, batch.BATCH_TOO_LARGE))
+		self.assertEqual(requests.get(self.url + '/vehicles/changes?ids=1,x').text, app.INVALID_IDS)
+		self.assertEqual(self.simulator.hit_count(), 0)
+
+		r = requests.get(self.url + '/vehicles/1234/battery')
+		self.assertEqual((r.status_code, r.text), (404, "Vehicle not found"))
+
+class TestNegativeCache(AppTestCase):
+	"""
+	Testing the negative cache of unknown vehicles located in cache.py
+	"""
+
+	def test_bounded_with_ttl(self):
+		self.now = 1000.0
+		unknown = cache.NegativeCache(ttl=60, max_entries=3, clock=lambda: self.now)
+		for id in (1, 2, 3):
+			unknown.add(id)
+			self.now += 10
+		self.assertTrue(unknown.contains(1))
+		#the oldest ID is dropped to make room
+		unknown.add(4)
+		self.assertFalse(unknown.contains(1))
+		self.assertTrue(unknown.contains(2))
+		#2 was added at 1010, so it is forgotten at 1070 along with anything older
+		self.now = 1070.0
+		self.assertFalse(unknown.contains(2))
+		self.assertEqual(unknown.stats()['entries'], 2)
+		self.assertEqual(unknown.discard([3, 5]), 1)
+		self.assertEqual(unknown.stats(), {"hits": 2, "misses": 2, "additions": 4, "evictions": 1,
+			"expirations": 1, "invalidations": 1, "entries": 1})
+
+		disabled = cache.NegativeCache(ttl=0)
+		disabled.add(1)
+		self.assertFalse(disabled.contains(1))
+
+	def test_unknown_vehicle_not_fetched_again(self):
+		hits = smartcar.unknown_vehicles.stats()['hits']
+		for _ in range(3):
+			self.assertEqual(requests.get(self.url + '/vehicles/1230').status_code, 404)
+		self.assertEqual(requests.get(self.url + '/vehicles/1230/doors').status_code, 404)
+		self.assertEqual(requests.post(self.url + '/vehicles/1230/engine', json={"action": "START"}).status_code, 404)
+		self.assertEqual(self.simulator.hit_count(), 1)
+		self.assertEqual(smartcar.unknown_vehicles.stats()['hits'], hits + 4)
+		self.assertIn("smartcar_negative_cache_hits_total %d" % (hits + 4), requests.get(self.url + '/metrics').text)
+
+		#a vehicle without a battery is not an unknown vehicle
+		self.assertEqual(requests.get(self.url + '/vehicles/1234/battery').status_code, 404)
+		self.assertEqual(requests.get(self.url + '/vehicles/1234').status_code, 200)
+		self.assertFalse(smartcar.unknown_vehicles.contains(1234))
+
+	def test_failure_in_body_not_cached(self):
+		with self.assertRaises(errors.BadUpstreamResponse):
+			smartcar._shape(smartcar.parse_vehicle_info, {"status": "400", "reason": "Invalid request."}, 1234)
+		self.assertFalse(smartcar.unknown_vehicles.contains(1234))
+		self.assertEqual(requests.get(self.url + '/vehicles/1234').status_code, 200)
+
+	def test_forget_provisioned(self):
+		with self.assertRaises(errors.VehicleNotFound):
+			smartcar.get_energy(1230)
+		self.assertTrue(smartcar.unknown_vehicles.contains(1230))
+		r = requests.delete(self.url + '/cache/unknown/1230')
+		self.assertEqual(r.json(), {"forgotten": 1})
+		with self.assertRaises(errors.VehicleNotFound):
+			smartcar.get_energy(1230)
+		self.assertEqual(self.simulator.hit_count('getEnergyService'), 2)
+		self.assertEqual(requests.delete(self.url + '/cache/unknown').json(), {"forgotten": 1})
+		self.assertEqual(smartcar.cache_stats()['unknown_vehicles']['entries'], 0)
+
+class TestEngineBatch(AppTestCase):
+	"""
+	Testing the bulk engine commands located in batch.py and the /vehicles/engine route
+	"""
+
+	def test_invalid_commands(self):
+		with self.assertRaises(ValueError):
+			batch.check_engine_batch([])
+		with self.assertRaises(ValueError):
+			batch.check_engine_batch([{"id": 1234, "action": "START"}, {"id": 1235, "action": "start"}])
+		with self.assertRaises(ValueError):
+			batch.check_engine_batch([{"id": "1234", "action": "START"}])
+		with self.assertRaises(ValueError):
+			batch.check_engine_batch([{"id": 1234, "action": "START"}, {"id": 1234, "action": "STOP"}])
+
+		#nothing is sent to the GM API when any command is invalid
+		r = requests.post(self.url + '/vehicles/engine', json={"commands": [
+			{"id": 1234, "action": "START"},
+			{"id": 1235, "action": "stop"}
+		]})
+		self.assertEqual(r.status_code, 400)
+		self.assertIn("Command 1: Please provide a valid input for the action (START|STOP). stop is not a valid input", r.text)
+		self.assertEqual(self.simulator.hit_count('actionEngineService'), 0)
+
+	def test_bulk_engine(self):
+		r = requests.post(self.url + '/vehicles/engine', json={"commands": [
+			{"id": 1234, "action": "START"},
+			{"id": 1235, "action": "STOP"},
+			{"id": 1230, "action": "START"}
+		]}, stream=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.headers['Content-Type'], 'application/x-ndjson')
+
+		results = {}
+		for line in r.iter_lines():
+			value = json.loads(line)
+			results[value['id']] = value
+		self.assertEqual(sorted(results), [1230, 1234, 1235])
+		self.assertIn(results[1234]['status'], ['success', 'error'])
+		self.assertEqual(results[1235]['action'], "STOP")
+		self.assertEqual(results[1230]['error']['status'], 404)
+		self.assertEqual(self.simulator.hit_count('actionEngineService'), 3)
+
+@unittest.skipIf(async_smartcar is None, "requires Python 3 and aiohttp")
+class TestAsyncRoutes(SimulatorTestCase):
+	"""
+	Testing that async_smartcar.py and async_app.py match the responses and error
+	semantics of smartcar.py and app.py
+	"""
+
+	@classmethod
+	def setUpClass(cls):
+		super(TestAsyncRoutes, cls).setUpClass()
+		cls.live_async_client = async_smartcar.client
+		async_smartcar.client = async_smartcar.AsyncGMClient(base_url=cls.simulator.url)
+
+		#serve async_app.py from an event loop running on a background thread
+		cls.loop = asyncio.new_event_loop()
+		cls.runner = web.AppRunner(async_app.create_app())
+		cls.loop.run_until_complete(cls.runner.setup())
+		site = web.TCPSite(cls.runner, '127.0.0.1', 0)
+		cls.loop.run_until_complete(site.start())
+		cls.url = 'http://127.0.0.1:%d' % cls.runner.addresses[0][1]
+		cls.loop_thread = threading.Thread(target=cls.loop.run_forever)
+		cls.loop_thread.daemon = True
+		cls.loop_thread.start()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.run_async(cls.runner.cleanup())
+		cls.loop.call_soon_threadsafe(cls.loop.stop)
+		cls.loop_thread.join()
+		cls.loop.close()
+		async_smartcar.client = cls.live_async_client
+		super(TestAsyncRoutes, cls).tearDownClass()
+
+	@classmethod
+	def run_async(cls, call):
+		return asyncio.run_coroutine_threadsafe(call, cls.loop).result()
+
+	def test_functions(self):
+		self.assertEqual(self.run_async(async_smartcar.get_vehicle_info(1235)), smartcar.get_vehicle_info(1235))
+		self.assertEqual(len(self.run_async(async_smartcar.get_door_status(1234))), 4)
+		self.assertEqual(type(self.run_async(async_smartcar.get_fuel_range(1234))['percent']), float)
+		self.assertIn(self.run_async(async_smartcar.control_engine(1234, "START"))['status'], ['success', 'error'])
+
+		with self.assertRaises(ValueError):
+			self.run_async(async_smartcar.get_vehicle_info(123))
+		with self.assertRaises(ValueError):
+			self.run_async(async_smartcar.get_battery_range(1234))
+		with self.assertRaises(ValueError):
+			self.run_async(async_smartcar.control_engine(1234, "start"))
+
+	def test_routes(self):
+		r = requests.get(self.url + '/vehicles/1234')
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.json()['doorCount'], 4)
+
+		r = requests.get(self.url + '/vehicles/1235/battery')
+		self.assertEqual(r.status_code, 200)
+
+		#unknown vehicles and missing energy sources are 404s
+		r = requests.get(self.url + '/vehicles/1230/doors')
+		self.assertEqual(r.status_code, 404)
+		r = requests.get(self.url + '/vehicles/1235/fuel')
+		self.assertEqual(r.status_code, 404)
+
+		#bad input is a 400 carrying the validation message
+		r = requests.post(self.url + '/vehicles/1235/engine', json={"action" : "stop"})
+		self.assertEqual(r.status_code, 400)
+		self.assertIn("stop is not a valid input", r.text)
+
+		#methods that app.py does not allow are denied
+		r = requests.post(self.url + '/vehicles/1234')
+		self.assertEqual(r.status_code, 405)
+		r = requests.get(self.url + '/vehicles/1234/engine')
+		self.assertEqual(r.status_code, 405)
+
+	def test_upstream_failures(self):
+		live_breakers = smartcar.breakers
+		smartcar.breakers = circuit.Breakers(failure_threshold=2, reset_timeout=30, min_timeout=0.1, max_timeout=2)
+		failures = metrics.upstream_responses.value(("getSecurityStatusService", "500"))
+		self.simulator.error_rate = 1.0
+		try:
+			#failed GM API calls are the same JSON errors as in app.py, and count against the breaker
+			r = requests.get(self.url + '/vehicles/1234/doors')
+			self.assertEqual(r.status_code, 502)
+			self.assertEqual(r.json(), {"status": 502, "message": "The GM API could not be reached"})
+			with self.assertRaises(requests.exceptions.HTTPError):
+				self.run_async(async_smartcar.get_door_status(1234))
+			self.assertEqual(metrics.upstream_responses.value(("getSecurityStatusService", "500")), failures + 2)
+
+			r = requests.get(self.url + '/vehicles/1234/doors')
+			self.assertEqual(r.status_code, 503)
+			self.assertEqual(r.headers['Retry-After'], '30')
+			self.assertEqual(self.simulator.hit_count(), 2)
+		finally:
+			self.simulator.error_rate = 0.0
+			smartcar.breakers = live_breakers
+
+	def test_admission(self):
+		governor = async_smartcar.AsyncGovernor("test", rate=0, max_in_flight=1, queue_timeout=0.05)
+		self.run_async(governor.acquire())
+		with self.assertRaises(ratelimit.ThrottledError):
+			self.run_async(governor.acquire())
+		#a call cancelled while it waits takes no slot with it
+		governor.queue_timeout = 5
+		waiter = asyncio.run_coroutine_threadsafe(governor.acquire(), self.loop)
+		time.sleep(0.01)
+		waiter.cancel()
+		self.loop.call_soon_threadsafe(governor.release)
+		self.assertLess(self.run_async(governor.acquire()), 0.01)
+
+		live_governors, live_breakers = smartcar.governors, smartcar.breakers
+		smartcar.governors = ratelimit.Governors(rate=0, max_in_flight=1, queue_timeout=5)
+		smartcar.breakers = circuit.Breakers(failure_threshold=1, reset_timeout=0)
+		self.simulator.latency = 0.3
+		try:
+			#the trial call of a half-open breaker is given back when it is cancelled
+			smartcar.breakers.get('actionEngineService').failure()
+			call = asyncio.run_coroutine_threadsafe(async_smartcar.control_engine(1234, "START"), self.loop)
+			time.sleep(0.1)
+			call.cancel()
+			time.sleep(0.05)
+			self.assertEqual(smartcar.breakers.get('actionEngineService').state, circuit.HALF_OPEN)
+			self.simulator.latency = 0
+			self.assertIn(self.run_async(async_smartcar.control_engine(1234, "START"))['status'], ['success', 'error'])
+			self.assertEqual(smartcar.breakers.get('actionEngineService').state, circuit.CLOSED)
+		finally:
+			smartcar.governors, smartcar.breakers = live_governors, live_breakers
+			self.simulator.latency = 0
 
 class TestGetPostRequests(unittest.TestCase):
 	"""
@@ -1,30 +1,70 @@
+import errors
+
 """
 This contains utility functions that are used in functions in smartcar.py.
 They are primarily being used to assist with data parsing/verification
 """
 
+try:
+	unicode
+except NameError:
+	#Python 3 (used by async_smartcar.py) has a single string type
+	unicode = str
+
+#Types accepted as text input
+STRING_TYPES = (str, unicode)
+
+#Engine actions clients can send and the GM API command for each
+ACTIONS = {
+	"START": "START_VEHICLE",
+	"STOP": "STOP_VEHICLE"
+}
+
+#Fixed error messages, encoded once
+MISSING_ID = errors.preallocate("Please provide a valid option for the vehicle ID.")
+MISSING_ACTION = errors.preallocate("Please provide a value input for the action (START|STOP)")
+INVALID_ID = "Please provide a valid option for the vehicle ID. %s is not a valid option"
+INVALID_ACTION = "Please provide a valid input for the action (START|STOP). %s is not a valid input"
+
+def check_id(value):
+	"""
+	:param value: Vehicle ID given by a client
+	:rtype: id: The vehicle ID, if it is an integer
+	"""
+	if (type(value) is int):
+		return value
+	if (value is None):
+		raise errors.InvalidInput(MISSING_ID)
+	raise errors.InvalidInput(INVALID_ID % (value,))
+
+def check_command(value):
+	"""
+	:param value: Engine action given by a client (START|STOP)
+	:rtype: command: The GM API command for the action
+	"""
+	try:
+		return ACTIONS[value]
+	except (KeyError, TypeError):
+		#TypeError for values that cannot be looked up at all, e.g. lists
+		pass
+	if (value is None):
+		raise errors.InvalidInput(MISSING_ACTION)
+	raise errors.InvalidInput(INVALID_ACTION % (value,))
+
+#The validator of each parameter that has one, in the order they are checked
+VALIDATORS = (
+	("id", check_id),
+	("command", check_command)
+)
+
 def check_valid_input(params):
 	"""
 	To check if inputs for an API request is of the correct form and
-	returns relevant params that are ready to be passed to GM API
+	returns relevant params that are ready to be passed to GM API.
+	Raises errors.InvalidInput for the first parameter that is not
 	"""
-	#Check for valid ID input
-	if ("id" in params):
-		if (params['id'] is None):
-			raise ValueError("Please provide a valid option for the vehicle ID.")
-		if (type(params['id']) != int):
-			raise ValueError("Please provide a valid option for the vehicle ID. " + params['id'] + " is not a valid option")
-	#Check for valid command input
-	if ("command" in params):
-		if (params['command'] is None):
-			raise ValueError("Please provide a value input for the action (START|STOP)")
-		elif (type(params['command']) != str and type(params['command']) != unicode):
-			raise ValueError("Please provide a valid input for the action (START|STOP). " + str(params['command']) + " is not a valid input")
-		elif (params['command'] == 'START'):
-			params["command"] = "START_VEHICLE"
-		elif (params['command'] == 'STOP'):
-			params["command"] = "STOP_VEHICLE"
-		else:
-			raise ValueError("Please provide a valid input for the action (START|STOP). " + params['command'] + " is not a valid input")
-
-	return params
\ No newline at end of file
+	for name, check in VALIDATORS:
+		if (name in params):
+			params[name] = check(params[name])
+
+	return params
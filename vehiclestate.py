@@ -0,0 +1,138 @@
+"""
+This contains the compact records the response cache keeps vehicle state in. The
+results built by smartcar.py are plain dicts and lists (a dict with string keys per
+vehicle, a list of dicts per door), which is a lot of memory per vehicle once
+hundreds of thousands of vehicles are cached. Each record class here holds the same
+data in __slots__ instead:
+
+* strings that repeat across vehicles (colors, drive trains, door locations) are
+  interned, so every vehicle shares a single copy of each
+* the door locations of a vehicle are an interned tuple, so all vehicles with the
+  same doors share it too, and the lock states are the bits of a single int
+
+Records are turned back into the exact JSON shapes of smartcar.py on the way out.
+"""
+
+class Interner(object):
+	"""
+	Hands out a single shared copy of each distinct value. Once `limit` distinct values
+	have been seen, new ones are returned as they are, so that values which turn out
+	not to repeat (e.g. a free-form field) cannot grow the table without bound
+	"""
+
+	def __init__(self, limit=10000):
+		self.limit = limit
+		self.values = {}
+
+	def __call__(self, value):
+		ret = self.values.get(value)
+		if (ret is None):
+			if (len(self.values) >= self.limit):
+				return value
+			#setdefault keeps the first copy if two threads intern the same value at once
+			ret = self.values.setdefault(value, value)
+		return ret
+
+#Shared by every record, since the same location strings appear in several places
+interned = Interner()
+
+class Record(object):
+	"""
+	Base class of the compact records. Each one is built from a result with pack and
+	turned back into the JSON shape returned by smartcar.py with unpack
+	"""
+	__slots__ = ()
+
+class VehicleInfo(Record):
+	"""
+	The result of smartcar.get_vehicle_info
+	"""
+	__slots__ = ('vin', 'color', 'door_count', 'drive_train')
+
+	def __init__(self, vin, color, door_count, drive_train):
+		self.vin = vin
+		self.color = interned(color)
+		self.door_count = door_count
+		self.drive_train = interned(drive_train)
+
+	@classmethod
+	def pack(cls, value):
+		return cls(value["vin"], value["color"], value["doorCount"], value["driveTrain"])
+
+	def unpack(self):
+		return {"vin": self.vin, "color": self.color, "doorCount": self.door_count, "driveTrain": self.drive_train}
+
+class DoorStatus(Record):
+	"""
+	The result of smartcar.get_door_status. Bit i of `locks` is set when door i is locked
+	"""
+	__slots__ = ('locations', 'locks')
+
+	def __init__(self, locations, locks):
+		self.locations = interned(tuple([interned(location) for location in locations]))
+		self.locks = locks
+
+	@classmethod
+	def pack(cls, value):
+		locks = 0
+		for index, door in enumerate(value):
+			if (door["locked"]):
+				locks |= 1 << index
+		return cls([door["location"] for door in value], locks)
+
+	def unpack(self):
+		locks = self.locks
+		return [{"location": location, "locked": bool(locks >> index & 1)}
+			for index, location in enumerate(self.locations)]
+
+class Energy(Record):
+	"""
+	The result of smartcar.get_energy, with None for a level that does not apply
+	"""
+	__slots__ = ('fuel', 'battery')
+
+	def __init__(self, fuel, battery):
+		self.fuel = fuel
+		self.battery = battery
+
+	@classmethod
+	def pack(cls, value):
+		fuel, battery = value["fuel"], value["battery"]
+		return cls(None if (fuel is None) else fuel["percent"], None if (battery is None) else battery["percent"])
+
+	def unpack(self):
+		return {
+			"fuel": None if (self.fuel is None) else {"percent": self.fuel},
+			"battery": None if (self.battery is None) else {"percent": self.battery}
+		}
+
+#Record class for each cached endpoint of smartcar.py
+RECORDS = {
+	"vehicle_info": VehicleInfo,
+	"door_status": DoorStatus,
+	"energy": Energy
+}
+
+def pack(endpoint, value):
+	"""
+	Turn a result into its compact record
+	:param endpoint: Name of the endpoint the result belongs to
+	:param value: The result in the JSON shape returned by smartcar.py
+	:rtype: stored: The record, or the value itself if the endpoint has no record class
+	or the value does not have the expected shape
+	"""
+	record = RECORDS.get(endpoint)
+	if (record is None):
+		return value
+	try:
+		return record.pack(value)
+	except (KeyError, TypeError, AttributeError):
+		return value
+
+def unpack(stored):
+	"""
+	Turn what pack returned back into the result in its JSON shape
+	"""
+	if (isinstance(stored, Record)):
+		return stored.unpack()
+	return stored
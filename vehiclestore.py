@@ -0,0 +1,243 @@
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+"""
+This contains the persistent store of vehicle info (VIN, color, door count and drive
+train). Vehicle info practically never changes, yet the response cache only lives as
+long as the process, so every restart and every worker process used to fetch it all
+from the GM API again. The store keeps it on disk in a SQLite database, one row per
+vehicle keyed on the vehicle id (the table's primary key, so lookups go through its
+index). The database is opened in WAL mode with a memory-mapped read path, so the
+worker processes of one host can share a single file: reads come straight out of the
+page cache and never block on a worker writing.
+
+Fleet snapshots can be exported to and imported from newline-delimited JSON, one
+vehicle per line:
+
+`python vehiclestore.py vehicles.db export fleet.ndjson`
+
+`python vehiclestore.py vehicles.db import fleet.ndjson`
+"""
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS vehicle_info (
+	id INTEGER PRIMARY KEY,
+	vin TEXT NOT NULL,
+	color TEXT NOT NULL,
+	door_count INTEGER NOT NULL,
+	drive_train TEXT NOT NULL,
+	stored_at REAL NOT NULL
+)"""
+
+UPSERT = ("INSERT OR REPLACE INTO vehicle_info (id, vin, color, door_count, drive_train, stored_at) "
+	"VALUES (?, ?, ?, ?, ?, ?)")
+
+SELECT = "SELECT vin, color, door_count, drive_train, stored_at FROM vehicle_info WHERE id = ?"
+
+def _row(id, value, stored_at):
+	return (id, value["vin"], value["color"], value["doorCount"], value["driveTrain"], stored_at)
+
+class VehicleStore(object):
+	"""
+	A thread safe store of vehicle info backed by a SQLite file. Each thread gets its
+	own connection, since SQLite connections cannot be shared between threads
+	"""
+
+	def __init__(self, path, mmap_size=64 * 1024 * 1024, clock=time.time):
+		"""
+		:param path: Path of the database file, created if it does not exist
+		:param mmap_size: Bytes of the file SQLite reads through a memory map
+		:param clock: Function returning the current time in seconds
+		"""
+		self.path = path
+		self.mmap_size = mmap_size
+		self.clock = clock
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.writes = 0
+		self.errors = 0
+		self._connect().execute(SCHEMA)
+
+	def _connect(self):
+		connection = getattr(self.local, 'connection', None)
+		if (connection is None):
+			#autocommit mode; writes that must go together use an explicit transaction
+			connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+			connection.execute("PRAGMA journal_mode=WAL")
+			connection.execute("PRAGMA synchronous=NORMAL")
+			connection.execute("PRAGMA mmap_size=%d" % self.mmap_size)
+			self.local.connection = connection
+		return connection
+
+	def _count(self, name):
+		with self.lock:
+			setattr(self, name, getattr(self, name) + 1)
+
+	def get(self, id):
+		"""
+		Look up the stored info of a vehicle. A store that cannot be read counts as a
+		miss, so that requests fall back to the GM API rather than fail
+		:param id: Vehicle ID
+		:rtype: (value, age): The vehicle info in the JSON shape of smartcar.get_vehicle_info
+		and its age in seconds, or None if it is not stored
+		"""
+		try:
+			row = self._connect().execute(SELECT, (id,)).fetchone()
+		except sqlite3.Error:
+			self._count('errors')
+			return None
+		if (row is None):
+			self._count('misses')
+			return None
+		self._count('hits')
+		vin, color, door_count, drive_train, stored_at = row
+		value = {"vin": vin, "color": color, "doorCount": door_count, "driveTrain": drive_train}
+		return value, max(self.clock() - stored_at, 0)
+
+	def put(self, id, value):
+		"""
+		Store the info of a vehicle, replacing what was stored for it before. Failures
+		are counted but not raised, since the store is only ever a copy of the GM API
+		:param id: Vehicle ID
+		:param value: The vehicle info in the JSON shape of smartcar.get_vehicle_info
+		"""
+		try:
+			self._connect().execute(UPSERT, _row(id, value, self.clock()))
+		except (sqlite3.Error, KeyError, TypeError):
+			self._count('errors')
+		else:
+			self._count('writes')
+
+	def put_many(self, vehicles):
+		"""
+		Store the info of many vehicles in a single transaction
+		:param vehicles: Iterable of (id, value) pairs
+		:rtype: count: Number of vehicles stored
+		"""
+		now = self.clock()
+		connection = self._connect()
+		count = 0
+		connection.execute("BEGIN")
+		try:
+			for id, value in vehicles:
+				connection.execute(UPSERT, _row(id, value, now))
+				count += 1
+		except Exception:
+			connection.execute("ROLLBACK")
+			raise
+		connection.execute("COMMIT")
+		with self.lock:
+			self.writes += count
+		return count
+
+	def delete(self, id):
+		self._connect().execute("DELETE FROM vehicle_info WHERE id = ?", (id,))
+
+	def clear(self):
+		self._connect().execute("DELETE FROM vehicle_info")
+
+	def __len__(self):
+		return self._connect().execute("SELECT COUNT(*) FROM vehicle_info").fetchone()[0]
+
+	def items(self):
+		"""
+		:rtype: vehicles: Iterator of (id, value) pairs of every stored vehicle, by id
+		"""
+		cursor = self._connect().execute("SELECT id, vin, color, door_count, drive_train FROM vehicle_info ORDER BY id")
+		for id, vin, color, door_count, drive_train in cursor:
+			yield id, {"vin": vin, "color": color, "doorCount": door_count, "driveTrain": drive_train}
+
+	def export(self, out):
+		"""
+		Write a snapshot of every stored vehicle as newline-delimited JSON
+		:param out: File object to write to
+		:rtype: count: Number of vehicles written
+		"""
+		count = 0
+		for id, value in self.items():
+			line = dict(value)
+			line["id"] = id
+			out.write(json.dumps(line, sort_keys=True) + "\n")
+			count += 1
+		return count
+
+	def load(self, lines):
+		"""
+		Import a snapshot written by export, replacing the stored info of the vehicles it holds
+		:param lines: Iterable of lines of newline-delimited JSON, e.g. a file object
+		:rtype: count: Number of vehicles imported
+		"""
+		def vehicles():
+			for number, line in enumerate(lines, 1):
+				if (not line.strip()):
+					continue
+				try:
+					vehicle = json.loads(line)
+					id = vehicle["id"]
+				except (ValueError, KeyError, TypeError):
+					raise ValueError("Invalid vehicle on line %d of the snapshot" % number)
+				#SQLite would fail on other ids with errors of its own, or quietly convert them (e.g. "12")
+				if (type(id) is not int):
+					raise ValueError("Invalid vehicle id on line %d of the snapshot" % number)
+				yield id, vehicle
+		try:
+			return self.put_many(vehicles())
+		except (KeyError, TypeError):
+			raise ValueError("Invalid vehicle in the snapshot")
+
+	def stats(self):
+		"""
+		:rtype: stats: Dictionary with the hit, miss, write and error counters
+		"""
+		with self.lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"writes": self.writes,
+				"errors": self.errors
+			}
+
+	def close(self):
+		"""
+		Close the connection of the calling thread
+		"""
+		connection = getattr(self.local, 'connection', None)
+		if (connection is not None):
+			connection.close()
+			self.local.connection = None
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Export or import fleet snapshots of a vehicle info store")
+	parser.add_argument('path', help="database file of the store")
+	parser.add_argument('command', choices=["export", "import", "count"])
+	parser.add_argument('snapshot', nargs='?', default='-',
+		help="newline-delimited JSON file to write or read (default: stdout/stdin)")
+	args = parser.parse_args(argv)
+
+	store = VehicleStore(args.path)
+	if (args.command == "count"):
+		print(len(store))
+	elif (args.command == "export"):
+		out = sys.stdout if (args.snapshot == '-') else open(args.snapshot, 'w')
+		try:
+			count = store.export(out)
+		finally:
+			if (out is not sys.stdout):
+				out.close()
+		sys.stderr.write("Exported %d vehicles\n" % count)
+	else:
+		source = sys.stdin if (args.snapshot == '-') else open(args.snapshot)
+		try:
+			count = store.load(source)
+		finally:
+			if (source is not sys.stdin):
+				source.close()
+		sys.stderr.write("Imported %d vehicles\n" % count)
+
+if __name__ == '__main__':
+	main()